@@ -1,28 +1,150 @@
 #bookstore/admin.py
 #by Rolph Recto
 
+import hashlib
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Sum
+from django.db.models.query import QuerySet
+from bookstore.cache import get_bookstore_cache
 from bookstore.models import Author, Book, Review
+from bookstore.search import get_search_backend
+
+
+def get_count_threshold():
+    """primary key above which a table is too large to count on every
+    changelist page"""
+    return getattr(settings, 'BOOKSTORE_ADMIN_COUNT_THRESHOLD', 100000)
+
+
+def get_count_timeout():
+    """seconds the changelist counts of a large table are cached for"""
+    return getattr(settings, 'BOOKSTORE_ADMIN_COUNT_TIMEOUT', 60)
+
+
+class LargeTableQuerySet(QuerySet):
+    """QuerySet class for the changelists of large tables: the unfiltered
+    count comes from precomputed totals where there are some, and other
+    counts are cached for a while once the table is large"""
+
+    def precomputed_count(self):
+        """the number of rows in the table, without counting them; None if
+        it isn't kept anywhere"""
+        return None
+
+    def is_large(self):
+        #the highest primary key bounds the number of rows, and is read from
+        #the end of the primary key index
+        highest = list(self.model._default_manager.using(self.db)
+            .order_by('-pk').values_list('pk', flat=True)[:1])
+        return bool(highest) and highest[0] > get_count_threshold()
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        if not self.query.where:
+            total = self.precomputed_count()
+            if total is not None:
+                return total
+        if not self.is_large():
+            return super(LargeTableQuerySet, self).count()
+        cache = get_bookstore_cache()
+        key = 'bookstore:admin-count:%s:%s' % (self.db, hashlib.md5(
+            unicode(self.query).encode('utf-8')).hexdigest())
+        count = cache.get(key)
+        if count is None:
+            count = super(LargeTableQuerySet, self).count()
+            cache.set(key, count, get_count_timeout())
+        return count
+
+
+class ReviewQuerySet(LargeTableQuerySet):
+    """QuerySet class for the review changelist"""
 
+    def precomputed_count(self):
+        #every book keeps its own review count
+        return Book.objects.using(self.db).aggregate(
+            total=Sum('review_count'))['total'] or 0
 
-class AuthorAdmin(admin.ModelAdmin):
+
+class IndexedSearchChangeList(ChangeList):
+    """ChangeList class answering the search box from the search index (see
+    bookstore/search.py) instead of LIKE scans of the search_fields; with
+    'pk' among them, a number is looked up as a primary key"""
+
+    def get_query_set(self, request):
+        search_fields, self.search_fields = self.search_fields, ()
+        try:
+            queryset = super(IndexedSearchChangeList, self).get_query_set(
+                request)
+        finally:
+            self.search_fields = search_fields
+        query = self.query.strip()
+        if query.isdigit() and 'pk' in search_fields:
+            return queryset.filter(pk=int(query))
+        if query:
+            queryset = get_search_backend().filter_queryset(queryset, query)
+        return queryset
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """ModelAdmin class whose changelist counts go through a
+    LargeTableQuerySet (or the queryset_class)"""
+    queryset_class = LargeTableQuerySet
+
+    def queryset(self, request):
+        return super(LargeTableAdmin, self).queryset(request)._clone(
+            klass=self.queryset_class)
+
+
+class IndexedSearchAdmin(LargeTableAdmin):
+    """ModelAdmin class whose search uses the search index"""
+
+    def get_changelist(self, request, **kwargs):
+        return IndexedSearchChangeList
+
+
+class AuthorAdmin(IndexedSearchAdmin):
     """ModelAdmin class for Author model"""
     list_display = ('pk', 'last_name', 'first_name', )
+    #searched by id, or through the index by name
     search_fields = ('pk', 'first_name', 'last_name',)
 
 
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(IndexedSearchAdmin):
     """ModelAdmin class for Book model"""
-    list_display = ('pk', 'title', 'author', 'publication_year',)
-    search_fields = ('title',)
+    list_display = ('pk', 'title', 'author', 'publication_year',
+        'review_count',)
+    #searched through the index, by title and author name
+    search_fields = ('title', 'author__first_name', 'author__last_name',)
+    readonly_fields = Book.AGGREGATE_FIELDS
     ordering = ('publication_year', 'title',)
+    #a text box for the author's id rather than a select of every author
+    raw_id_fields = ('author',)
+
+    def queryset(self, request):
+        #the author of every row in the same query
+        return super(BookAdmin, self).queryset(request).select_related(
+            'author')
 
 
-class ReviewAdmin(admin.ModelAdmin):
+class ReviewAdmin(LargeTableAdmin):
     """"ModelAdmin class for Review model"""
     list_display = ('pk', 'user', 'book', 'rating', 'timestamp')
+    #the years and months come from the monthly rollups (see the
+    #admin/bookstore/review/change_list.html template)
     date_hierarchy = 'timestamp'
     ordering = ('timestamp',)
+    queryset_class = ReviewQuerySet
+    #text boxes for ids rather than selects of every user and book
+    raw_id_fields = ('user', 'book')
+
+    def queryset(self, request):
+        #the user and book of every row in the same query
+        return super(ReviewAdmin, self).queryset(request).select_related(
+            'user', 'book')
 
 
 admin.site.register(Author, AuthorAdmin)
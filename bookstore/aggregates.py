@@ -0,0 +1,252 @@
+#bookstore/aggregates.py
+#Rolph Recto
+
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from bookstore.models import Book, BookMonthlyRating, Review
+from bookstore.signals import reviews_bulk_changed
+
+
+def rating_field(rating):
+    """name of the Book histogram column counting reviews with this rating"""
+    return 'rating_%d_count' % rating
+
+
+def apply_rating_delta(book_id, rating, delta):
+    """add (delta=1) or remove (delta=-1) one review's rating from a book's
+    aggregates with a single UPDATE, so concurrent writers don't race"""
+    field = rating_field(rating)
+    updates = {
+        'review_count': F('review_count') + delta,
+        'rating_sum': F('rating_sum') + delta * rating,
+        field: F(field) + delta,
+    }
+    Book.objects.filter(pk=book_id).update(**updates)
+
+
+def rebuild_book_aggregates(book_ids=None):
+    """recompute the rating aggregates from the Review table, either for the
+    given books or for every book; returns the number of books updated"""
+    books = Book.objects.all()
+    reviews = Review.objects.all()
+    if book_ids is not None:
+        book_ids = list(book_ids)
+        books = books.filter(pk__in=book_ids)
+        reviews = reviews.filter(book__in=book_ids)
+
+    #one GROUP BY over the reviews gives every (book, rating) count
+    totals = {}
+    rows = (reviews.order_by().values_list('book', 'rating')
+        .annotate(Count('pk')))
+    for book_id, rating, count in rows:
+        values = totals.setdefault(book_id, dict(
+            [(name, 0) for name in Book.AGGREGATE_FIELDS]))
+        values['review_count'] += count
+        values['rating_sum'] += rating * count
+        values[rating_field(rating)] += count
+
+    with transaction.commit_on_success():
+        zeros = dict([(name, 0) for name in Book.AGGREGATE_FIELDS])
+        updated = books.update(**zeros)
+        for book_id, values in totals.items():
+            Book.objects.filter(pk=book_id).update(**values)
+
+    return updated
+
+
+def review_month(timestamp):
+    """first day of the month of a review's timestamp, in the site's time
+    zone"""
+    if timezone.is_aware(timestamp):
+        timestamp = timezone.localtime(timestamp)
+    return datetime.date(timestamp.year, timestamp.month, 1)
+
+
+def apply_month_delta(book_id, month, rating, delta, count=1):
+    """add (delta=1) or remove (delta=-1) count reviews with this rating
+    sum from a book's month, creating the month on its first review"""
+    rows = BookMonthlyRating.objects.filter(book=book_id, month=month)
+    updates = {
+        'review_count': F('review_count') + delta * count,
+        'rating_sum': F('rating_sum') + delta * rating,
+    }
+    if rows.update(**updates):
+        if delta < 0:
+            #months without reviews aren't stored
+            rows.filter(review_count=0).delete()
+    elif delta > 0:
+        BookMonthlyRating.objects.get_or_create(book_id=book_id, month=month)
+        rows.update(**updates)
+
+
+def rebuild_monthly_ratings(book_ids=None, chunk_size=10000):
+    """recompute the monthly rollups from the Review table, either for the
+    given books or for every book; the months are bucketed in Python, in the
+    site's time zone, over the reviews read a chunk at a time. Returns the
+    number of months stored."""
+    reviews = Review.objects.all()
+    months = BookMonthlyRating.objects.all()
+    if book_ids is not None:
+        book_ids = list(book_ids)
+        reviews = reviews.filter(book__in=book_ids)
+        months = months.filter(book__in=book_ids)
+
+    #(book id, month) -> [review count, rating sum]
+    totals = {}
+    last = 0
+    while True:
+        rows = list(reviews.filter(pk__gt=last).order_by('pk')
+            .values_list('pk', 'book', 'timestamp', 'rating')[:chunk_size])
+        for pk, book_id, timestamp, rating in rows:
+            values = totals.setdefault((book_id, review_month(timestamp)),
+                [0, 0])
+            values[0] += 1
+            values[1] += rating
+        if len(rows) < chunk_size:
+            break
+        last = rows[-1][0]
+
+    with transaction.commit_on_success():
+        months.delete()
+        BookMonthlyRating.objects.bulk_create([BookMonthlyRating(
+                book_id=book_id, month=month, review_count=count,
+                rating_sum=ratings)
+            for (book_id, month), (count, ratings) in totals.items()])
+    return len(totals)
+
+
+def get_monthly_window():
+    """the most months in a book's monthly series"""
+    return getattr(settings, 'BOOKSTORE_MONTHLY_WINDOW', 24)
+
+
+def shift_month(month, months):
+    """the first day of the month months after (or before) the given one"""
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def monthly_ratings(book_id):
+    """the book's monthly series, oldest first, as dicts of the month, review
+    count, rating sum and average rating; it covers at most the window of
+    months up to the last review, the months without any filled in with
+    zeros"""
+    window = get_monthly_window()
+    stored = dict((month, (count, ratings)) for month, count, ratings
+        in BookMonthlyRating.objects.filter(book=book_id).order_by('-month')
+            .values_list('month', 'review_count', 'rating_sum')[:window])
+    series = []
+    if not stored:
+        return series
+    last = max(stored)
+    month = max(min(stored), shift_month(last, 1 - window))
+    while month <= last:
+        count, ratings = stored.get(month, (0, 0))
+        series.append({
+            'month': month,
+            'review_count': count,
+            'rating_sum': ratings,
+            'average_rating': float(ratings) / count if count else None,
+        })
+        month = shift_month(month, 1)
+    return series
+
+
+@receiver(pre_save, sender=Review)
+def remember_review_rating(sender, instance, raw, **kwargs):
+    """record the stored book, rating, timestamp and user of a review that is
+    being edited"""
+    instance._stored_rating = None
+    instance._stored_timestamp = None
+    instance._stored_user_id = None
+    if raw or instance.pk is None:
+        return
+    stored = list(Review.objects.filter(pk=instance.pk)
+        .values_list('book', 'rating', 'timestamp', 'user')[:1])
+    if stored:
+        book_id, rating, timestamp, user_id = stored[0]
+        instance._stored_rating = (book_id, rating)
+        instance._stored_timestamp = timestamp
+        instance._stored_user_id = user_id
+
+
+@receiver(post_save, sender=Review)
+def update_rating_aggregates(sender, instance, raw, **kwargs):
+    """move the review's rating into the book aggregates"""
+    if raw:
+        return
+    stored = getattr(instance, '_stored_rating', None)
+    current = (instance.book_id, instance.rating)
+    if stored == current:
+        return
+    if stored is not None:
+        apply_rating_delta(stored[0], stored[1], -1)
+    apply_rating_delta(current[0], current[1], 1)
+
+
+@receiver(post_delete, sender=Review)
+def remove_rating_aggregates(sender, instance, **kwargs):
+    """take a deleted review's rating out of the book aggregates"""
+    apply_rating_delta(instance.book_id, instance.rating, -1)
+
+
+@receiver(post_save, sender=Review)
+def update_monthly_ratings(sender, instance, raw, **kwargs):
+    """move the review's rating into the book's month"""
+    if raw:
+        return
+    stored = getattr(instance, '_stored_rating', None)
+    current = (instance.book_id, review_month(instance.timestamp),
+        instance.rating)
+    if stored is not None:
+        stored = (stored[0], review_month(instance._stored_timestamp),
+            stored[1])
+        if stored == current:
+            return
+        apply_month_delta(stored[0], stored[1], stored[2], -1)
+    apply_month_delta(current[0], current[1], current[2], 1)
+
+
+@receiver(post_delete, sender=Review)
+def remove_monthly_ratings(sender, instance, **kwargs):
+    """take a deleted review's rating out of the book's month"""
+    apply_month_delta(instance.book_id, review_month(instance.timestamp),
+        instance.rating, -1)
+
+
+@receiver(reviews_bulk_changed)
+def update_bulk_aggregates(sender, book_ids, created=None, **kwargs):
+    """update the books once for a whole batch of review writes: new reviews
+    are added in with one UPDATE per book, anything else is recounted"""
+    if created is None:
+        rebuild_book_aggregates(book_ids)
+        rebuild_monthly_ratings(book_ids)
+        return
+
+    deltas = {}
+    for review in created:
+        values = deltas.setdefault(review.book_id, dict(
+            [(name, 0) for name in Book.AGGREGATE_FIELDS]))
+        values['review_count'] += 1
+        values['rating_sum'] += review.rating
+        values[rating_field(review.rating)] += 1
+    for book_id, values in deltas.items():
+        Book.objects.filter(pk=book_id).update(**dict((name, F(name) + value)
+            for name, value in values.items() if value))
+
+    #and one UPDATE per (book, month)
+    months = {}
+    for review in created:
+        values = months.setdefault((review.book_id,
+            review_month(review.timestamp)), [0, 0])
+        values[0] += 1
+        values[1] += review.rating
+    for (book_id, month), (count, ratings) in months.items():
+        apply_month_delta(book_id, month, ratings, 1, count)
@@ -0,0 +1,265 @@
+#bookstore/api.py
+#Rolph Recto
+
+import hashlib
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Count, Max, Sum
+from django.http import (HttpResponse, HttpResponseBadRequest,
+    HttpResponseForbidden)
+from django.shortcuts import get_object_or_404
+from django.utils.encoding import force_text
+from django.views.decorators.http import condition
+from django.views.generic.base import View
+
+from bookstore.aggregates import monthly_ratings
+from bookstore.forms import ReviewForm
+from bookstore.ingest import ReviewQueueFull, submit_review
+from bookstore.models import Book, Review
+from bookstore.views import (BookListView, BookReviewListView,
+    UserReviewListView)
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+class ConditionalResponseMixin(object):
+    """View mixin answering conditional GETs: the ETag comes from a cheap
+    aggregate query, so a client whose copy is current gets a 304 without the
+    page being fetched or rendered. There's no Last-Modified: the newest
+    timestamps don't move when a row is deleted."""
+
+    #aggregates (name -> aggregate) of the validator queryset whose values
+    #change whenever the response would
+    validator_queryset = None
+    validator_aggregates = None
+
+    def get_validator_queryset(self):
+        if self.validator_queryset is None:
+            raise ImproperlyConfigured('%s is missing a validator_queryset. '
+                'Define %s.validator_queryset, or override '
+                '%s.get_validator_queryset().' %
+                ((self.__class__.__name__,) * 3))
+        return self.validator_queryset.all()
+
+    def get_validator_values(self):
+        """values that change whenever the response would"""
+        if not self.validator_aggregates:
+            raise ImproperlyConfigured('%s is missing the '
+                'validator_aggregates. Define %s.validator_aggregates, or '
+                'override %s.get_validator_values().' %
+                ((self.__class__.__name__,) * 3))
+        return sorted(self.get_validator_queryset().aggregate(
+            **self.validator_aggregates).items())
+
+    def get_etag(self):
+        if not hasattr(self, '_etag'):
+            #the query string selects fields and pages, so it's part of the tag
+            tag = repr((self.request.get_full_path(),
+                self.get_validator_values()))
+            self._etag = hashlib.md5(tag.encode('utf-8')).hexdigest()
+        return self._etag
+
+    def dispatch(self, request, *args, **kwargs):
+        dispatch = super(ConditionalResponseMixin, self).dispatch
+        return condition(
+            etag_func=lambda request, *args, **kwargs: self.get_etag(),
+        )(dispatch)(request, *args, **kwargs)
+
+
+class JSONListMixin(object):
+    """ListView mixin rendering the page of objects as JSON, with the fields
+    chosen by ?fields=a,b and next/previous links carrying the page cursor"""
+    http_method_names = ['get', 'head']
+    #field name -> function of the object giving the field's value
+    json_fields = {}
+    default_fields = ()
+    #columns the JSON fields read, loaded in place of the template's columns
+    json_columns = ()
+
+    def get_fields(self):
+        requested = self.request.GET.get('fields')
+        if not requested:
+            return list(self.default_fields)
+        return [name for name in requested.split(',') if name]
+
+    def get(self, request, *args, **kwargs):
+        unknown = [name for name in self.get_fields()
+            if name not in self.json_fields]
+        if unknown:
+            return HttpResponseBadRequest(json.dumps({
+                'error': 'Unknown field(s): %s' % ', '.join(unknown)}),
+                content_type='application/json')
+        return super(JSONListMixin, self).get(request, *args, **kwargs)
+
+    def get_queryset(self):
+        return super(JSONListMixin, self).get_queryset().only(
+            *self.json_columns)
+
+    def get_page_link(self, cursor):
+        if cursor is None:
+            return None
+        query = self.request.GET.copy()
+        query[self.cursor_kwarg] = cursor
+        return self.request.build_absolute_uri(
+            '%s?%s' % (self.request.path, query.urlencode()))
+
+    def get_json_data(self, context):
+        """the JSON document besides the results and page links"""
+        return {}
+
+    def render_to_response(self, context, **response_kwargs):
+        fields = self.get_fields()
+        page = context['page_obj']
+        data = self.get_json_data(context)
+        data.update({
+            'results': [dict((name, self.json_fields[name](obj))
+                for name in fields) for obj in context['object_list']],
+            'next': self.get_page_link(page.next_cursor),
+            'previous': self.get_page_link(page.previous_cursor),
+        })
+        return HttpResponse(json.dumps(data),
+            content_type='application/json')
+
+
+class ReviewsAPIMixin(ConditionalResponseMixin, JSONListMixin):
+    """Shared parts of the review list endpoints"""
+    #the count changes on deletes, the newest modified stamp on edits
+    validator_aggregates = {'count': Count('pk'), 'newest': Max('timestamp'),
+        'modified': Max('modified')}
+
+    def get_validator_queryset(self):
+        return Review.objects.filter(**self.get_subject_filter(self.subject))
+
+    def get_json_data(self, context):
+        return {
+            'review_count': context['review_count'],
+            'average_rating': context['average_rating'],
+        }
+
+
+class BookReviewListAPIView(ReviewsAPIMixin, BookReviewListView):
+    """JSON list of the reviews of a book"""
+    json_fields = {
+        'id': lambda review: review.pk,
+        'user': lambda review: review.user_id,
+        'username': lambda review: review.user.username,
+        'rating': lambda review: review.rating,
+        'review_message': lambda review: review.review_message,
+        'timestamp': lambda review: _isoformat(review.timestamp),
+    }
+    default_fields = ('id', 'username', 'rating', 'review_message',
+        'timestamp')
+    json_columns = ('timestamp', 'rating', 'review_message', 'user__username')
+    show_recommendations = False
+    show_rating_history = False
+    #the JSON pages choose their fields and size
+    use_bundle = False
+
+
+class UserReviewListAPIView(ReviewsAPIMixin, UserReviewListView):
+    """JSON list of the reviews written by a user"""
+    json_fields = {
+        'id': lambda review: review.pk,
+        'book': lambda review: review.book_id,
+        'book_title': lambda review: review.book.title,
+        'rating': lambda review: review.rating,
+        'review_message': lambda review: review.review_message,
+        'timestamp': lambda review: _isoformat(review.timestamp),
+    }
+    default_fields = ('id', 'book', 'book_title', 'rating', 'review_message',
+        'timestamp')
+    json_columns = ('timestamp', 'rating', 'review_message', 'book__title')
+    #the JSON list is paged, never streamed
+    stream_kwarg = None
+    show_recommendations = False
+
+
+class BookListAPIView(ConditionalResponseMixin, JSONListMixin, BookListView):
+    """JSON list of the books, by title"""
+    json_fields = {
+        'id': lambda book: book.pk,
+        'title': lambda book: book.title,
+        'author': lambda book: force_text(book.author),
+        'publication_year': lambda book: book.publication_year,
+        'review_count': lambda book: book.review_count,
+        'average_rating': lambda book: book.average_rating,
+    }
+    default_fields = ('id', 'title', 'author', 'publication_year',
+        'review_count', 'average_rating')
+    json_columns = ('title', 'publication_year', 'review_count', 'rating_sum',
+        'author__first_name', 'author__last_name')
+
+    #the aggregate columns change with every review write, and an author
+    #rename touches the modified stamp of the author's books
+    validator_queryset = Book.objects.all()
+    validator_aggregates = {'count': Count('pk'), 'modified': Max('modified'),
+        'reviews': Sum('review_count'), 'ratings': Sum('rating_sum')}
+
+    def get_json_data(self, context):
+        return {'book_count': context['book_count']}
+
+
+class BookRatingsAPIView(ConditionalResponseMixin, View):
+    """JSON rating histogram and monthly review series of a book, read from
+    its precomputed rollups with two indexed queries"""
+    http_method_names = ['get', 'head']
+
+    def get_data(self):
+        if not hasattr(self, '_data'):
+            book = get_object_or_404(Book.objects.only('title',
+                *Book.AGGREGATE_FIELDS), pk=self.kwargs['book_id'])
+            self._data = {
+                'book': book.pk,
+                'title': book.title,
+                'review_count': book.review_count,
+                'average_rating': book.average_rating,
+                'histogram': [{'rating': rating, 'review_count': count}
+                    for rating, count in book.rating_histogram()],
+                'monthly': [dict(month, month=month['month'].strftime('%Y-%m'))
+                    for month in monthly_ratings(book.pk)],
+            }
+        return self._data
+
+    def get_validator_values(self):
+        #the rollups are small, so the document itself is the validator
+        return json.dumps(self.get_data(), sort_keys=True)
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(json.dumps(self.get_data()),
+            content_type='application/json')
+
+
+class ReviewSubmitAPIView(View):
+    """Queue a review of a book by the logged in user: 202 once it's queued
+    (it's written within moments, batched with others), 503 with a
+    Retry-After header when the queue is full"""
+    http_method_names = ['post']
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_authenticated():
+            return HttpResponseForbidden(json.dumps({
+                'error': 'Log in to review books.'}),
+                content_type='application/json')
+        book = get_object_or_404(Book.objects.only('pk'),
+            pk=self.kwargs['book_id'])
+        form = ReviewForm(request.POST)
+        if not form.is_valid():
+            errors = dict((name, [force_text(error) for error in field_errors])
+                for name, field_errors in form.errors.items())
+            return HttpResponseBadRequest(json.dumps({'errors': errors}),
+                content_type='application/json')
+        review = form.save(commit=False)
+        review.user = request.user
+        review.book = book
+        try:
+            submit_review(review)
+        except ReviewQueueFull as e:
+            response = HttpResponse(json.dumps({'error': e.args[0]}),
+                status=503, content_type='application/json')
+            response['Retry-After'] = '1'
+            return response
+        return HttpResponse(json.dumps({'queued': True}), status=202,
+            content_type='application/json')
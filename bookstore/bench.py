@@ -0,0 +1,453 @@
+#bookstore/bench.py
+#Rolph Recto
+
+import bisect
+import datetime
+import json
+import platform
+import random
+import resource
+import time
+
+import django
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.urlresolvers import (NoReverseMatch, RegexURLResolver,
+    reverse)
+from django.db import connection, transaction
+from django.db.models import Count
+from django.template import Context
+from django.template.loaders import cached
+from django.template.loaders.app_directories import Loader
+from django.test.client import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from bookstore import (aggregates, leaderboards, recommendations,
+    userstats)
+from bookstore.cache import get_bookstore_cache
+from bookstore.instrumentation import percentile
+from bookstore.models import Author, Book, Review
+from bookstore.routing import PrefixURLResolver, cached_reverse
+from bookstore.search import FTS5SearchBackend, get_search_backend
+
+#session engines the login benchmark compares
+SESSION_ENGINES = ('db', 'cached_db', 'signed_cookies')
+#number of reviews of the named data set scales
+SCALES = {
+    '10k': 10000,
+    '100k': 100000,
+    '1m': 1000000,
+    '10m': 10000000,
+}
+#rows per INSERT when generating data
+GENERATE_BATCH = 5000
+#words the generated review messages are made of
+WORDS = ('''book story read reading characters plot ending writing prose
+    novel author chapter pages slow boring gripping beautiful sad funny dark
+    war love sea river city family friend journey classic modern style voice
+    dialogue moving honest brilliant dull long short again recommend
+    masterpiece''').split()
+#URL names not benchmarked: logging out would end the benchmark's session,
+#and reviews are only POSTed
+SKIP_URLS = ('logout', 'api_review_submit')
+#URLconf arguments the routing benchmark resolves, so it needs no data
+ROUTING_SAMPLES = {
+    'book_id': [42],
+    'author_id': [7],
+    'decade': [1920],
+    'user_id': [1234],
+    'username': ['reader1234'],
+    'board': ['top_rated', 'most_reviewed'],
+    'kind': ['reviews', 'books'],
+    'format': ['csv', 'json'],
+}
+#query strings the URLs are benchmarked with
+QUERY_STRINGS = {
+    'search': 'q=gripping+story',
+}
+
+
+def _timed(func, repeat):
+    """best wall time of repeat calls to func, in seconds"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def benchmark_templates(rows=1000, repeat=5):
+    """time rendering the book review list with rows in-memory reviews, the
+    way it was rendered before template caching (parsed from disk, every row
+    rendered) and after (compiled template kept in memory, row fragments
+    served from the cache); returns {mode: milliseconds per 1,000 rows}"""
+    author = Author(pk=1, first_name='Ernest', last_name='Hemingway')
+    book = Book(pk=1, title='A Farewell to Arms', author=author,
+        review_count=rows, rating_sum=rows * 3)
+    now = timezone.now()
+    reviews = [Review(pk=i + 1, book=book, rating=i % 5 + 1, timestamp=now,
+            modified=now, review_message='Review %d ' % i * 20,
+            user=User(pk=i + 1, username='reader%d' % i))
+        for i in range(rows)]
+    name = 'bookstore/book_review_list.html'
+
+    def render(template):
+        template.render(Context({
+            'book': book,
+            'review_list': reviews,
+            'review_count': rows,
+            'average_rating': 3.0,
+            'user': AnonymousUser(),
+        }))
+
+    def uncached():
+        #reparse the template from disk, and give every row a new stamp so
+        #none of the fragments can be served from the cache
+        stamp = timezone.now()
+        for review in reviews:
+            review.modified = stamp
+        template, origin = Loader().load_template(name)
+        render(template)
+
+    loader = cached.Loader((
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ))
+
+    def warm():
+        template, origin = loader.load_template(name)
+        render(template)
+
+    results = {'uncached': _timed(uncached, repeat)}
+    warm()
+    results['cached'] = _timed(warm, repeat)
+    return dict((mode, seconds * 1000 * 1000.0 / rows)
+        for mode, seconds in results.items())
+
+
+class ZipfSampler(object):
+    """Draws ranks 0 to count - 1 with probability proportional to
+    1 / (rank + 1) ** exponent, so a few ranks are drawn far more often than
+    the rest"""
+
+    def __init__(self, count, exponent, random):
+        self.random = random
+        self.cumulative = []
+        total = 0.0
+        for rank in range(count):
+            total += 1.0 / (rank + 1) ** exponent
+            self.cumulative.append(total)
+
+    def __call__(self):
+        point = self.random.random() * self.cumulative[-1]
+        return min(bisect.bisect_left(self.cumulative, point),
+            len(self.cumulative) - 1)
+
+
+def benchmark_logins(logins=50, engines=SESSION_ENGINES):
+    """POST logins successful logins through the test client, one after
+    another, with each session engine; also with the database engine and the
+    password checked twice per login, the way the login view used to. Returns
+    {mode: logins per second}, which on one thread is per core."""
+    user, created = User.objects.get_or_create(username='benchmark-login')
+    user.set_password('benchmark')
+    user.save()
+    credentials = {'username': 'benchmark-login', 'password': 'benchmark'}
+    path = reverse('bookstore:login')
+
+    def run(engine, authenticate_twice=False):
+        with override_settings(SESSION_ENGINE='django.contrib.sessions.'
+                'backends.' + engine):
+            start = time.time()
+            for i in range(logins):
+                if authenticate_twice:
+                    authenticate(**credentials)
+                #a new client, so each login makes a new session
+                response = Client().post(path, credentials)
+                if response.status_code != 302:
+                    raise ValueError('Login failed with status %d' %
+                        response.status_code)
+            return logins / (time.time() - start)
+
+    results = {'db, authenticated twice': run('db', True)}
+    for engine in engines:
+        results[engine] = run(engine)
+    return results
+
+
+def parse_scale(scale):
+    """the number of reviews of a named scale ('10k', '1m', ...) or number"""
+    if scale in SCALES:
+        return SCALES[scale]
+    try:
+        return int(scale)
+    except ValueError:
+        raise ValueError('Unknown scale %r' % scale)
+
+
+def _insert(model, objects):
+    for start in range(0, len(objects), GENERATE_BATCH):
+        model.objects.bulk_create(objects[start:start + GENERATE_BATCH])
+
+
+def generate_data(reviews=10000, seed=0, exponent=1.1):
+    """fill the (empty) database with a synthetic catalogue of the given
+    number of reviews; books and users are picked with Zipfian popularity,
+    so a few books and readers have most of the reviews. The same seed gives
+    the same data. Returns the {model name: count} generated."""
+    generator = random.Random(seed)
+    counts = {
+        'authors': max(1, reviews // 500),
+        'books': max(1, reviews // 50),
+        'users': max(1, reviews // 20),
+        'reviews': reviews,
+    }
+    base = {}
+    for name, model in (('authors', Author), ('books', Book),
+            ('users', User), ('reviews', Review)):
+        base[name] = (model.objects.order_by('-pk')
+            .values_list('pk', flat=True)[:1] or [0])[0] + 1
+
+    now = timezone.now()
+    with transaction.commit_on_success():
+        _insert(Author, [Author(pk=base['authors'] + i, first_name='Author',
+            last_name='%d' % i) for i in range(counts['authors'])])
+        #each book gets a true quality its ratings scatter around
+        quality = [generator.uniform(1.5, 5) for i in range(counts['books'])]
+        _insert(Book, [Book(pk=base['books'] + i, title='Book %d' % i,
+                author_id=base['authors'] + generator.randrange(
+                    counts['authors']),
+                publication_year=generator.randint(1900, 2013), modified=now)
+            for i in range(counts['books'])])
+        _insert(User, [User(pk=base['users'] + i,
+                username='reader%d' % (base['users'] + i), password='!',
+                last_login=now, date_joined=now)
+            for i in range(counts['users'])])
+
+        pick_book = ZipfSampler(counts['books'], exponent, generator)
+        pick_user = ZipfSampler(counts['users'], exponent, generator)
+        batch = []
+        for i in range(reviews):
+            book = pick_book()
+            rating = int(round(generator.gauss(quality[book], 1)))
+            batch.append(Review(pk=base['reviews'] + i,
+                book_id=base['books'] + book,
+                user_id=base['users'] + pick_user(),
+                rating=min(5, max(1, rating)),
+                timestamp=now - datetime.timedelta(
+                    seconds=generator.randrange(5 * 365 * 24 * 3600)),
+                modified=now,
+                review_message=' '.join(generator.choice(WORDS)
+                    for j in range(generator.randint(5, 40)))))
+            if len(batch) >= GENERATE_BATCH:
+                Review.objects.bulk_create(batch)
+                batch = []
+        Review.objects.bulk_create(batch)
+
+    #the data derived from reviews, rebuilt once rather than row by row
+    aggregates.rebuild_book_aggregates()
+    aggregates.rebuild_monthly_ratings()
+    userstats.rebuild_user_stats()
+    backend = get_search_backend()
+    if isinstance(backend, FTS5SearchBackend):
+        with transaction.commit_on_success():
+            backend.rebuild()
+    leaderboards.rebuild_leaderboards()
+    #the pure Python build grows with the square of the busiest readers'
+    #review counts, so it only runs on small data sets
+    if recommendations.numpy is not None or reviews <= 20000:
+        recommendations.build_neighbors()
+    return counts
+
+
+def _sample_kwargs():
+    """candidate values of the URLconf arguments, from the busiest book and
+    reader, so the heaviest pages are the ones measured"""
+    book = (Book.objects.order_by('-review_count', 'pk')
+        .values_list('pk', 'author', 'publication_year')[:1])
+    user = (Review.objects.values_list('user').annotate(count=Count('pk'))
+        .order_by('-count')[:1])
+    book_id, author_id, year = book[0] if book else (1, 1, 1920)
+    user_id = user[0][0] if user else 1
+    usernames = User.objects.filter(pk=user_id).values_list('username',
+        flat=True)
+    return {
+        'book_id': [book_id],
+        'author_id': [author_id],
+        'decade': [(year or 1920) // 10 * 10],
+        'user_id': [user_id],
+        'username': list(usernames) or ['reader'],
+        'board': ['top_rated', 'most_reviewed'],
+        'kind': ['reviews', 'books'],
+        'format': ['csv', 'json'],
+    }
+
+
+def benchmark_urls(samples=None):
+    """[(label, path)] of every bookstore URL pattern, with sample values
+    (by default from the busiest book and reader)"""
+    from bookstore.urls import urlpatterns
+    if samples is None:
+        samples = _sample_kwargs()
+    urls = []
+    for pattern in urlpatterns:
+        if not pattern.name or pattern.name in SKIP_URLS:
+            continue
+        names = sorted(pattern.regex.groupindex)
+        name = 'bookstore:%s' % pattern.name
+        path = None
+        #try the candidate values until they fit the pattern
+        for i in range(max([len(samples[group]) for group in names] or [1])):
+            kwargs = dict((group, samples[group][min(i,
+                len(samples[group]) - 1)]) for group in names)
+            try:
+                path = reverse(name, kwargs=kwargs)
+                break
+            except NoReverseMatch:
+                pass
+        if path is None:
+            continue
+        label = name + ''.join('(%s)' % group for group in names)
+        if pattern.name in QUERY_STRINGS:
+            path += '?' + QUERY_STRINGS[pattern.name]
+        if path not in [url for label_, url in urls]:
+            urls.append((label, path))
+    return urls
+
+
+def benchmark_routing(calls=10000, repeat=5):
+    """time resolving every bookstore URL with the linear resolver and the
+    prefix-indexed one, and reversing the URL names without arguments with
+    reverse() and memoized; returns {mode: operations per second}"""
+    from bookstore.urls import urlpatterns
+    paths = [path[len('/bookstore/'):]
+        for label, path in benchmark_urls(ROUTING_SAMPLES)]
+    paths = [path.split('?', 1)[0] for path in paths]
+    names = sorted(set('bookstore:%s' % pattern.name
+        for pattern in urlpatterns
+        if pattern.name and not pattern.regex.groupindex))
+    resolvers = {
+        'resolve, linear': RegexURLResolver(r'^', 'bookstore.urls'),
+        'resolve, prefix index': PrefixURLResolver(r'^', 'bookstore.urls'),
+    }
+
+    def rate(func, items):
+        def run():
+            for i in range(calls):
+                func(items[i % len(items)])
+        func(items[0])
+        return calls / _timed(run, repeat)
+
+    results = {}
+    for mode, resolver in resolvers.items():
+        results[mode] = rate(resolver.resolve, paths)
+    results['reverse'] = rate(reverse, names)
+    results['reverse, memoized'] = rate(cached_reverse, names)
+    return results
+
+
+def _peak_memory_kb():
+    #kilobytes on Linux; the high-water mark of the whole process, so it's
+    #only reported once per run
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark_views(repeat=20, cached=False):
+    """GET every bookstore URL repeat times through the test client, as a
+    staff user, with the page cache emptied before each request unless
+    cached; returns {label: {path, status, p50_ms, p90_ms, p99_ms,
+    queries}}"""
+    staff, created = User.objects.get_or_create(username='benchmark-staff',
+        defaults={'is_staff': True})
+    staff.is_staff = True
+    staff.set_password('benchmark')
+    staff.save()
+    client = Client()
+    client.login(username='benchmark-staff', password='benchmark')
+    cache = get_bookstore_cache()
+
+    results = {}
+    for label, path in benchmark_urls():
+        timings = []
+        for i in range(repeat):
+            if not cached:
+                cache.clear()
+            old_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            start = time.time()
+            try:
+                response = client.get(path)
+                if response.streaming:
+                    for chunk in response.streaming_content:
+                        pass
+                elapsed = time.time() - start
+                #the test client resets the query log at the request start
+                queries = len(connection.queries)
+            finally:
+                connection.use_debug_cursor = old_debug_cursor
+            timings.append(elapsed * 1000)
+        timings.sort()
+        results[label] = {
+            'path': path,
+            'status': response.status_code,
+            'p50_ms': percentile(timings, 50),
+            'p90_ms': percentile(timings, 90),
+            'p99_ms': percentile(timings, 99),
+            'queries': queries,
+        }
+    return results
+
+
+def run_view_benchmarks(reviews, seed=0, repeat=20, cached=False):
+    """generate the data set and benchmark the views on it; returns the JSON
+    document of the run"""
+    start = time.time()
+    counts = generate_data(reviews, seed)
+    generate_seconds = time.time() - start
+    return {
+        'meta': {
+            'reviews': reviews,
+            'seed': seed,
+            'repeat': repeat,
+            'cached': cached,
+            'counts': counts,
+            'generate_seconds': generate_seconds,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'date': timezone.now().isoformat(),
+        },
+        'views': benchmark_views(repeat, cached),
+        'peak_memory_kb': _peak_memory_kb(),
+    }
+
+
+def compare_results(old, new, threshold=0.2):
+    """the regressions of run new against run old: views whose median time
+    grew by more than threshold (a fraction), or which issue more queries;
+    returns a list of messages"""
+    regressions = []
+    for label, result in sorted(new['views'].items()):
+        before = old['views'].get(label)
+        if before is None:
+            continue
+        if result['p50_ms'] > before['p50_ms'] * (1 + threshold):
+            regressions.append('%s: median %.1f ms, was %.1f ms' % (label,
+                result['p50_ms'], before['p50_ms']))
+        if result['queries'] > before['queries']:
+            regressions.append('%s: %d queries, was %d' % (label,
+                result['queries'], before['queries']))
+    return regressions
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
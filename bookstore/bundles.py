@@ -0,0 +1,116 @@
+#bookstore/bundles.py
+#Rolph Recto
+
+from django.conf import settings
+from django.contrib.auth.models import User
+
+from bookstore.aggregates import monthly_ratings
+from bookstore.cache import get_bookstore_cache, get_with_versions
+from bookstore.models import Author, Book, Review
+from bookstore.pagination import encode_cursor
+from bookstore.recommendations import readers_also_liked
+from bookstore.routers import current_replica
+
+#bumped whenever the layout of the blob changes, so bundles cached by older
+#code are rebuilt rather than misread
+BUNDLE_FORMAT = 1
+#the review columns kept, in order
+REVIEW_COLUMNS = ('pk', 'timestamp', 'rating', 'review_message', 'modified',
+    'user', 'user__username')
+#the newest reviews are listed first; see BookReviewListView
+REVIEW_ORDERING = ('-timestamp', '-pk')
+
+
+def get_bundle_timeout():
+    """seconds a book's bundle is kept; it's rebuilt sooner whenever the book
+    or its reviews change. A reviewer's new username shows once both the
+    bundle and the cached page (CachedResponseMixin.cache_timeout) expire."""
+    return getattr(settings, 'BOOKSTORE_BUNDLE_TIMEOUT', 60 * 5)
+
+
+def bundle_scopes(book_id):
+    """the cache scopes whose versions a book's bundle was built at"""
+    return ['book:%s' % book_id, 'recommendations']
+
+
+def _bundle_key(book_id):
+    return 'bookstore:bundle:%s' % book_id
+
+
+def _field_names(model):
+    return [field.attname for field in model._meta.fields]
+
+
+class BookBundle(object):
+    """What the first page of a book's reviews shows: the book and its
+    author, its newest reviews, monthly ratings and "readers also liked"
+    books, rebuilt from the compact blob of plain values that's cached"""
+
+    def __init__(self, blob):
+        (bundle_format, versions, page_size, book_values, author_values, rows,
+            has_more, monthly, also_liked) = blob
+        self.page_size = page_size
+        self.book = Book(*book_values)
+        self.book.author = Author(*author_values)
+        self.reviews = []
+        for (pk, timestamp, rating, review_message, modified, user_id,
+                username) in rows:
+            review = Review(pk=pk, book_id=self.book.pk, timestamp=timestamp,
+                rating=rating, review_message=review_message,
+                modified=modified)
+            review.book = self.book
+            review.user = User(pk=user_id, username=username)
+            self.reviews.append(review)
+        self.next_cursor = None
+        if has_more:
+            last = self.reviews[-1]
+            self.next_cursor = encode_cursor('n', [last.timestamp, last.pk])
+        self.monthly_ratings = monthly
+        self.also_liked = []
+        for pk, title, first_name, last_name in also_liked:
+            book = Book(pk=pk, title=title)
+            book.author = Author(first_name=first_name, last_name=last_name)
+            self.also_liked.append(book)
+
+
+def build_book_bundle(book_id, page_size, versions):
+    """the blob of plain values a BookBundle is made from, with the versions
+    of the bundle's scopes it's built at, or None if there is no such book;
+    four queries"""
+    books = list(Book.objects.filter(pk=book_id).select_related('author')[:1])
+    if not books:
+        return None
+    book = books[0]
+    rows = list(Review.objects.filter(book=book_id).order_by(*REVIEW_ORDERING)
+        .values_list(*REVIEW_COLUMNS)[:page_size + 1])
+    also_liked = [(other.pk, other.title, other.author.first_name,
+            other.author.last_name)
+        for other in readers_also_liked(book)]
+    return (BUNDLE_FORMAT, versions, page_size,
+        tuple(getattr(book, name) for name in _field_names(Book)),
+        tuple(getattr(book.author, name) for name in _field_names(Author)),
+        rows[:page_size], len(rows) > page_size, monthly_ratings(book_id),
+        also_liked)
+
+
+def get_book_bundle(book_id, page_size):
+    """the book's bundle, from one cache lookup (the blob and the versions it
+    must have been built at are fetched together) unless the book or its
+    reviews changed since; then it's rebuilt, and cached if it was read from
+    the primary. None if there is no such book."""
+    cache = get_bookstore_cache()
+    key = _bundle_key(book_id)
+    blob, versions = get_with_versions(key, bundle_scopes(book_id), cache)
+    if (blob is not None and blob[0] == BUNDLE_FORMAT and
+            list(blob[1]) == versions and blob[2] == page_size):
+        return BookBundle(blob)
+    #built at the versions read before building, so a change made meanwhile
+    #makes it stale at once
+    blob = build_book_bundle(book_id, page_size, versions)
+    if blob is None:
+        return None
+    #a replica may lag behind the versions, and the bundle is shared with
+    #the clients reading their own writes from the primary
+    if current_replica() is None:
+        cache.set(key, blob, get_bundle_timeout())
+    return BookBundle(blob)
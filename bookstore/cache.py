@@ -0,0 +1,187 @@
+#bookstore/cache.py
+#Rolph Recto
+
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+
+from bookstore.models import Author, Book, Review, UserReviewStats
+from bookstore.routers import current_replica
+from bookstore.signals import reviews_bulk_changed
+
+#version tokens outlive the pages cached under them
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get_bookstore_cache():
+    """the cache backend used for bookstore pages"""
+    return get_cache(getattr(settings, 'BOOKSTORE_CACHE', 'default'))
+
+
+def _version_key(scope):
+    return 'bookstore:version:%s' % scope
+
+
+def _new_version():
+    #a fresh random token rather than a counter, so a version key that gets
+    #evicted can never come back with a value an old page was cached under
+    return uuid.uuid4().hex[:12]
+
+
+def get_versions(scopes, cache=None):
+    """current version tokens of the given scopes (eg. 'book:1'), fetched in
+    one round trip"""
+    cache = cache or get_bookstore_cache()
+    keys = [_version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    missing = dict((key, _new_version()) for key in keys
+        if key not in versions)
+    if missing:
+        cache.set_many(missing, VERSION_TIMEOUT)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def get_with_versions(key, scopes, cache=None):
+    """(value cached under the key or None, current version tokens of the
+    scopes), usually fetched together in one round trip"""
+    cache = cache or get_bookstore_cache()
+    keys = [_version_key(scope) for scope in scopes]
+    found = cache.get_many([key] + keys)
+    if all(version_key in found for version_key in keys):
+        versions = [found[version_key] for version_key in keys]
+    else:
+        versions = get_versions(scopes, cache)
+    return found.get(key), versions
+
+
+def invalidate(*scopes):
+    """give the scopes new versions, orphaning everything cached under the
+    old ones"""
+    if scopes:
+        get_bookstore_cache().set_many(dict((_version_key(scope),
+            _new_version()) for scope in scopes), VERSION_TIMEOUT)
+
+
+class CachedResponseMixin(object):
+    """View mixin that caches the rendered page of a GET request. The key
+    covers the URL, the visitor (user_nav.html shows who is logged in) and the
+    versions of the view's cache scopes, which the model signals below bump
+    whenever something shown on the page changes. Pages read from a replica
+    aren't stored."""
+    cache_timeout = 60 * 5
+    #the scopes whose data the page shows
+    cache_scopes = None
+
+    def get_cache_scopes(self):
+        """the scopes whose data the page shows"""
+        if self.cache_scopes is None:
+            raise ImproperlyConfigured('%s is missing the cache_scopes. '
+                'Define %s.cache_scopes, or override '
+                '%s.get_cache_scopes().' % ((self.__class__.__name__,) * 3))
+        return list(self.cache_scopes)
+
+    def get_response_cache_key(self):
+        request = self.request
+        if request.user.is_authenticated():
+            visitor = 'user%d' % request.user.pk
+        else:
+            visitor = 'anonymous'
+        scopes = self.get_cache_scopes()
+        url = hashlib.md5(request.get_full_path().encode('utf-8')).hexdigest()
+        return 'bookstore:page:%s:%s:%s:%s' % (self.__class__.__name__,
+            url, visitor, '.'.join(get_versions(scopes)))
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super(CachedResponseMixin, self).dispatch(request, *args,
+                **kwargs)
+
+        cache = get_bookstore_cache()
+        key = self.get_response_cache_key()
+        cached = cache.get(key)
+        if cached is not None:
+            content_type, content = cached
+            response = HttpResponse(content, content_type=content_type)
+        else:
+            response = super(CachedResponseMixin, self).dispatch(request,
+                *args, **kwargs)
+            #a page read from a replica may predate the versions in its key,
+            #and would be served after the replica caught up
+            if (response.status_code == 200 and not response.streaming and
+                    current_replica() is None):
+                def store(response):
+                    cache.set(key, (response['Content-Type'],
+                        response.content), self.cache_timeout)
+                if hasattr(response, 'add_post_render_callback'):
+                    response.add_post_render_callback(store)
+                else:
+                    store(response)
+
+        patch_vary_headers(response, ('Cookie',))
+        return response
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review_pages(sender, instance, **kwargs):
+    """a review shows up on its book's page, its user's page and (through the
+    average rating) the book list"""
+    scopes = ['books', 'book:%s' % instance.book_id,
+        'user:%s' % instance.user_id]
+    #an edit may have moved the review from another book
+    stored = getattr(instance, '_stored_rating', None)
+    if stored is not None and stored[0] != instance.book_id:
+        scopes.append('book:%s' % stored[0])
+    #or from another user
+    stored_user_id = getattr(instance, '_stored_user_id', None)
+    if stored_user_id is not None and stored_user_id != instance.user_id:
+        scopes.append('user:%s' % stored_user_id)
+    invalidate(*scopes)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def invalidate_book_pages(sender, instance, **kwargs):
+    """the book's title is shown on the pages of everyone who reviewed it"""
+    user_ids = (Review.objects.filter(book=instance).order_by()
+        .values_list('user', flat=True).distinct())
+    invalidate('books', 'book:%s' % instance.pk,
+        *['user:%s' % user_id for user_id in user_ids])
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+def invalidate_author_pages(sender, instance, **kwargs):
+    """the author's name is shown in the book list, on each book page and on
+    the pages of the users it's the favourite author of"""
+    books = Book.objects.filter(author=instance)
+    book_ids = list(books.values_list('pk', flat=True))
+    user_ids = (UserReviewStats.objects.filter(favorite_author=instance)
+        .values_list('user', flat=True))
+    invalidate('books', *(['book:%s' % book_id for book_id in book_ids] +
+        ['user:%s' % user_id for user_id in user_ids]))
+    #the cached book list fragments are keyed on the book's modified stamp
+    if kwargs.get('signal') is post_save:
+        books.update(modified=timezone.now())
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_pages(sender, instance, **kwargs):
+    invalidate('user:%s' % instance.pk)
+
+
+@receiver(reviews_bulk_changed)
+def invalidate_bulk_pages(sender, book_ids, user_ids, **kwargs):
+    invalidate('books', *(['book:%s' % book_id for book_id in book_ids] +
+        ['user:%s' % user_id for user_id in user_ids]))
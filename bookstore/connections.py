@@ -0,0 +1,147 @@
+#bookstore/connections.py
+#Rolph Recto
+
+import os
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import close_connection, connections, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+#applied to every new SQLite connection: WAL lets readers carry on while a
+#writer commits, and NORMAL sync is safe with WAL (a crash may lose the last
+#commits, never corrupt the file)
+DEFAULT_SQLITE_PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    #milliseconds a writer waits for the lock before "database is locked"
+    ('busy_timeout', 5000),
+    #negative sizes are in KB
+    ('cache_size', -16000),
+    ('temp_store', 'MEMORY'),
+)
+
+#the connections kept open between requests, by every thread
+_held = weakref.WeakSet()
+_lock = threading.Lock()
+
+
+def get_max_age():
+    """seconds a connection is reused for before it's reopened: 0 closes it
+    at the end of every request, None keeps it for good"""
+    return getattr(settings, 'BOOKSTORE_CONN_MAX_AGE', 0)
+
+
+def get_pool_size():
+    """the most connections a process keeps open between requests"""
+    return getattr(settings, 'BOOKSTORE_CONN_POOL_SIZE', 10)
+
+
+def get_health_checks():
+    """whether a kept connection is pinged before a request uses it"""
+    return getattr(settings, 'BOOKSTORE_CONN_HEALTH_CHECKS', True)
+
+
+def get_sqlite_pragmas():
+    return getattr(settings, 'BOOKSTORE_SQLITE_PRAGMAS',
+        DEFAULT_SQLITE_PRAGMAS)
+
+
+def _discard(connection):
+    """forget the connection, closing it unless it belongs to the process
+    this one was forked from"""
+    with _lock:
+        _held.discard(connection)
+    opened = getattr(connection, '_bookstore_opened', None)
+    if opened is not None and opened[1] != os.getpid():
+        #closing would end the parent's session on the shared socket
+        connection.connection = None
+        return
+    try:
+        connection.close()
+    except Exception:
+        #a broken connection is dropped all the same
+        connection.connection = None
+
+
+def _stale(connection):
+    """whether the connection was opened by another process or has outlived
+    the maximum age"""
+    opened = getattr(connection, '_bookstore_opened', None)
+    max_age = get_max_age()
+    return (opened is None or opened[1] != os.getpid() or
+        (max_age is not None and time.time() - opened[0] >= max_age))
+
+
+def release_connection(connection):
+    """at the end of a request, keep the connection open for the next one if
+    it's young enough and the pool has room, else close it; returns whether
+    it was kept"""
+    if connection.connection is None:
+        with _lock:
+            _held.discard(connection)
+        return False
+    if _stale(connection):
+        _discard(connection)
+        return False
+    with _lock:
+        if connection not in _held and len(_held) >= get_pool_size():
+            full = True
+        else:
+            _held.add(connection)
+            full = False
+    if full:
+        _discard(connection)
+        return False
+    return True
+
+
+def check_connection(connection):
+    """at the start of a request, drop a kept connection that was opened by
+    the parent of a forked worker, has outlived the maximum age or fails its
+    health check; the next query opens a new one. Returns whether the
+    connection can be used."""
+    if connection.connection is None:
+        return False
+    if _stale(connection):
+        _discard(connection)
+        return False
+    if get_health_checks():
+        try:
+            connection.connection.cursor().execute('SELECT 1')
+        except Exception:
+            _discard(connection)
+            return False
+    return True
+
+
+#Django closes every connection when a request finishes; this module decides
+#instead
+request_finished.disconnect(close_connection)
+
+
+@receiver(request_finished)
+def release_connections(**kwargs):
+    for alias in connections:
+        #an unfinished transaction mustn't leak into the next request
+        transaction.abort(alias)
+        release_connection(connections[alias])
+
+
+@receiver(request_started)
+def check_connections(**kwargs):
+    for connection in connections.all():
+        check_connection(connection)
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    connection._bookstore_opened = (time.time(), os.getpid())
+    if connection.vendor == 'sqlite':
+        cursor = connection.connection.cursor()
+        for name, value in get_sqlite_pragmas():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
@@ -0,0 +1,167 @@
+#bookstore/export.py
+#Rolph Recto
+
+import csv
+import datetime
+import json
+from collections import OrderedDict
+from StringIO import StringIO
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from bookstore.models import Book, Review
+
+
+class ExportError(Exception):
+    """Raised for an export that can't be run as asked"""
+    pass
+
+
+#kind -> (model, ((column header, values_list lookup), ...), filters allowed);
+#the primary key comes first, it's what the chunks are ordered and resumed on
+EXPORTS = {
+    'reviews': (Review, (
+        ('id', 'pk'),
+        ('timestamp', 'timestamp'),
+        ('rating', 'rating'),
+        ('review_message', 'review_message'),
+        ('book_id', 'book'),
+        ('book_title', 'book__title'),
+        ('publication_year', 'book__publication_year'),
+        ('author_id', 'book__author'),
+        ('author_first_name', 'book__author__first_name'),
+        ('author_last_name', 'book__author__last_name'),
+        ('user_id', 'user'),
+        ('username', 'user__username'),
+    ), ('since', 'until', 'book', 'user')),
+    'books': (Book, (
+        ('id', 'pk'),
+        ('title', 'title'),
+        ('publication_year', 'publication_year'),
+        ('author_id', 'author'),
+        ('author_first_name', 'author__first_name'),
+        ('author_last_name', 'author__last_name'),
+        ('review_count', 'review_count'),
+        ('rating_sum', 'rating_sum'),
+    ), ('book',)),
+}
+FORMATS = ('csv', 'jsonl')
+
+
+def parse_moment(value, end=False):
+    """a datetime from a 'YYYY-MM-DD' date or an ISO datetime; a date stands
+    for the start of the day, or with end the start of the next day"""
+    if isinstance(value, datetime.datetime):
+        moment = value
+    else:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                raise ExportError('Invalid date %r' % value)
+            if end:
+                day += datetime.timedelta(days=1)
+            moment = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, timezone.get_default_timezone())
+    return moment
+
+
+def export_queryset(kind, since=None, until=None, book=None, user=None):
+    """the rows of the export as a queryset of value tuples"""
+    if kind not in EXPORTS:
+        raise ExportError('Unknown export %r' % kind)
+    model, columns, allowed = EXPORTS[kind]
+    filters = dict((name, value) for name, value in (('since', since),
+        ('until', until), ('book', book), ('user', user))
+        if value not in (None, ''))
+    for name in filters:
+        if name not in allowed:
+            raise ExportError('The %s export has no %s filter' % (kind, name))
+
+    queryset = model.objects.all()
+    try:
+        if 'since' in filters:
+            queryset = queryset.filter(timestamp__gte=parse_moment(since))
+        if 'until' in filters:
+            #a date includes the whole day
+            queryset = queryset.filter(
+                timestamp__lt=parse_moment(until, end=True))
+        if 'book' in filters:
+            queryset = queryset.filter(**{
+                'pk' if model is Book else 'book': int(book)})
+        if 'user' in filters:
+            queryset = queryset.filter(user=int(user))
+    except ValueError:
+        raise ExportError('Invalid filter value')
+    return queryset.values_list(*[lookup for header, lookup in columns])
+
+
+def export_chunks(kind, after=None, chunk_size=1000, **filters):
+    """iterate over the rows of the export as lists of up to chunk_size value
+    tuples, in primary key order and starting after the pk after; each chunk
+    is its own query, so memory use doesn't grow with the table"""
+    #bad filters are reported now, not once the output has started
+    if after is not None:
+        try:
+            after = int(after)
+        except ValueError:
+            raise ExportError('Invalid primary key %r' % after)
+    return _chunks(export_queryset(kind, **filters), after, chunk_size)
+
+
+def _chunks(queryset, last, chunk_size):
+    while True:
+        chunk = queryset
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        rows = list(chunk.order_by('pk')[:chunk_size])
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][0]
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _json(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def render_export(kind, chunks, format):
+    """iterate over the chunks rendered as CSV (with a header line) or JSONL,
+    one string per chunk"""
+    if format not in FORMATS:
+        raise ExportError('Unknown format %r' % format)
+    headers = [header for header, lookup in EXPORTS[kind][1]]
+    return (_render_csv if format == 'csv' else _render_jsonl)(headers,
+        chunks)
+
+
+def _render_csv(headers, chunks):
+    buffer = StringIO()
+    csv.writer(buffer).writerow(headers)
+    yield buffer.getvalue()
+    for rows in chunks:
+        buffer = StringIO()
+        csv.writer(buffer).writerows([[_text(value) for value in row]
+            for row in rows])
+        yield buffer.getvalue()
+
+
+def _render_jsonl(headers, chunks):
+    for rows in chunks:
+        yield ''.join(json.dumps(OrderedDict(zip(headers, [_json(value)
+            for value in row]))) + '\n' for row in rows)
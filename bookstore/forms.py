@@ -4,15 +4,26 @@
 from django import forms
 from django.contrib.auth import authenticate
 
+from bookstore.models import Review
+
 class LoginForm(forms.Form):
     username = forms.CharField(max_length=100, label='Username')
     password = forms.CharField(max_length=100, widget=forms.PasswordInput())
 
+    def __init__(self, *args, **kwargs):
+        super(LoginForm, self).__init__(*args, **kwargs)
+        #the user authenticated by clean(), so the view needn't hash the
+        #password again
+        self.user_cache = None
+
     def clean(self):
         """authenticate the user info"""
         cleaned_data = super(LoginForm, self).clean()
         username = cleaned_data.get('username')
         password = cleaned_data.get('password')
+        #the field errors are reported on their own
+        if not username or not password:
+            return cleaned_data
 
         user = authenticate(username=username, password=password)
 
@@ -23,5 +34,17 @@ class LoginForm(forms.Form):
         else:
             raise forms.ValidationError('Invalid user information.')
 
+        self.user_cache = user
         return cleaned_data
 
+    def get_user(self):
+        """the user authenticated by a valid form"""
+        return self.user_cache
+
+
+class ReviewForm(forms.ModelForm):
+    """form for the rating and message of a new review"""
+
+    class Meta:
+        model = Review
+        fields = ('rating', 'review_message')
@@ -0,0 +1,232 @@
+#bookstore/importer.py
+#Rolph Recto
+
+import csv
+import json
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from bookstore.models import Author, Book, Review
+from bookstore.signals import books_bulk_created, reviews_bulk_changed
+
+
+class RowError(Exception):
+    """Raised for an input row that can't be imported"""
+    pass
+
+
+def read_rows(stream, format):
+    """iterate over the rows of a CSV (with a header line) or JSONL stream as
+    dicts of unicode strings"""
+    if format == 'csv':
+        for row in csv.DictReader(stream):
+            yield dict((key.decode('utf-8'), (value or '').decode('utf-8'))
+                for key, value in row.items() if key is not None)
+    elif format == 'jsonl':
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError('Unknown format %r' % format)
+
+
+class RejectWriter(object):
+    """Writes rejected rows, with the reason, to a JSONL side file"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def write(self, line_number, row, error):
+        self.count += 1
+        if self.stream is not None:
+            self.stream.write(json.dumps({
+                'line': line_number,
+                'error': error,
+                'row': row,
+            }) + '\n')
+
+
+class CatalogueImporter(object):
+    """Bulk loads authors, books or reviews. Rows are validated with the model
+    fields' own validators, authors, books and users are resolved through
+    in-memory natural key maps, and each batch is inserted with bulk_create in
+    one transaction, followed by one aggregate update for the whole batch."""
+
+    kinds = ('authors', 'books', 'reviews')
+
+    def __init__(self, kind, batch_size=1000, rejects=None):
+        if kind not in self.kinds:
+            raise ValueError('Unknown kind %r' % kind)
+        self.kind = kind
+        self.batch_size = batch_size
+        self.rejects = rejects or RejectWriter(None)
+        self.imported = 0
+        self._authors = None
+        self._books = None
+        self._users = None
+
+    #natural key maps, loaded on first use
+
+    def author_map(self):
+        if self._authors is None:
+            self._authors = dict(((first, last), pk) for pk, first, last in
+                Author.objects.values_list('pk', 'first_name', 'last_name'))
+        return self._authors
+
+    def book_map(self):
+        if self._books is None:
+            self._books = dict(((title, first, last), pk)
+                for pk, title, first, last in Book.objects.values_list('pk',
+                    'title', 'author__first_name', 'author__last_name'))
+        return self._books
+
+    def user_map(self):
+        if self._users is None:
+            self._users = dict((username, pk) for pk, username in
+                User.objects.values_list('pk', 'username'))
+        return self._users
+
+    #validation
+
+    def clean_field(self, model, name, row, key=None):
+        """run the model field's own cleaning and validators (eg.
+        util.not_negative, the rating choices) on a raw value"""
+        field = model._meta.get_field(name)
+        value = row.get(key or name)
+        if value in ('', None) and field.null:
+            #a missing optional value, eg. a book's publication year
+            return None
+        try:
+            return field.clean(value, None)
+        except ValidationError as e:
+            raise RowError('%s: %s' % (key or name, '; '.join(e.messages)))
+
+    def author_key(self, row, prefix='author_'):
+        first = self.clean_field(Author, 'first_name', row,
+            prefix + 'first_name')
+        last = self.clean_field(Author, 'last_name', row, prefix + 'last_name')
+        return (first, last)
+
+    def clean_author(self, row):
+        return self.author_key(row, prefix='')
+
+    def clean_book(self, row):
+        return {
+            'title': self.clean_field(Book, 'title', row),
+            'author': self.author_key(row),
+            'publication_year': self.clean_field(Book, 'publication_year',
+                row),
+        }
+
+    def clean_review(self, row):
+        book_key = (self.clean_field(Book, 'title', row, 'book_title'),) + \
+            self.author_key(row)
+        book_id = self.book_map().get(book_key)
+        if book_id is None:
+            raise RowError('Unknown book "%s" by %s %s' % book_key)
+        user_id = self.user_map().get(row.get('username'))
+        if user_id is None:
+            raise RowError('Unknown user "%s"' % row.get('username'))
+
+        timestamp = self.clean_field(Review, 'timestamp', row)
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp,
+                timezone.get_default_timezone())
+        return Review(book_id=book_id, user_id=user_id, timestamp=timestamp,
+            modified=timezone.now(),
+            rating=self.clean_field(Review, 'rating', row),
+            review_message=self.clean_field(Review, 'review_message', row))
+
+    #loading
+
+    def run(self, rows):
+        """import the rows, batch by batch; returns the number imported"""
+        clean = {
+            'authors': self.clean_author,
+            'books': self.clean_book,
+            'reviews': self.clean_review,
+        }[self.kind]
+        batch = []
+        for line_number, row in enumerate(rows, 1):
+            try:
+                batch.append(clean(row))
+            except RowError as e:
+                self.rejects.write(line_number, row, e.args[0])
+                continue
+            if len(batch) >= self.batch_size:
+                self.insert(batch)
+                batch = []
+        if batch:
+            self.insert(batch)
+        return self.imported
+
+    def insert(self, batch):
+        with transaction.commit_on_success():
+            inserted = getattr(self, 'insert_' + self.kind)(batch)
+        #rows of authors and books already known aren't inserted again
+        self.imported += inserted
+
+    def create_authors(self, keys):
+        """bulk create the authors that aren't in the map yet; returns how
+        many were created"""
+        authors = self.author_map()
+        missing = set(key for key in keys if key not in authors)
+        if not missing:
+            return 0
+        Author.objects.bulk_create([Author(first_name=first, last_name=last)
+            for first, last in missing])
+        #bulk_create doesn't give back the new primary keys
+        last_names = set(last for first, last in missing)
+        author_ids = []
+        for pk, first, last in (Author.objects.filter(last_name__in=last_names)
+                .values_list('pk', 'first_name', 'last_name')):
+            if (first, last) in missing:
+                authors[(first, last)] = pk
+                author_ids.append(pk)
+        books_bulk_created.send(sender=Author, book_ids=[],
+            author_ids=author_ids)
+        return len(missing)
+
+    def insert_authors(self, batch):
+        return self.create_authors(batch)
+
+    def insert_books(self, batch):
+        self.create_authors([values['author'] for values in batch])
+        authors = self.author_map()
+        books = self.book_map()
+        new_books = {}
+        for values in batch:
+            key = (values['title'],) + values['author']
+            if key not in books and key not in new_books:
+                new_books[key] = Book(title=values['title'],
+                    author_id=authors[values['author']],
+                    publication_year=values['publication_year'],
+                    modified=timezone.now())
+        if not new_books:
+            return 0
+        Book.objects.bulk_create(new_books.values())
+        titles = set(title for title, first, last in new_books)
+        book_ids = []
+        for pk, title, first, last in (Book.objects.filter(title__in=titles)
+                .values_list('pk', 'title', 'author__first_name',
+                    'author__last_name')):
+            if (title, first, last) in new_books:
+                books[(title, first, last)] = pk
+                book_ids.append(pk)
+        books_bulk_created.send(sender=Book, book_ids=book_ids, author_ids=[])
+        #the book list shows the new books
+        reviews_bulk_changed.send(sender=Book, book_ids=[], user_ids=[])
+        return len(new_books)
+
+    def insert_reviews(self, batch):
+        Review.objects.bulk_create(batch)
+        #bulk_create skips the model signals, so the books' aggregates (and
+        #whatever else is derived from reviews) are updated once per batch
+        reviews_bulk_changed.send(sender=Review,
+            book_ids=set(review.book_id for review in batch),
+            user_ids=set(review.user_id for review in batch), created=batch)
+        return len(batch)
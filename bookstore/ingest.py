@@ -0,0 +1,186 @@
+#bookstore/ingest.py
+#Rolph Recto
+
+import atexit
+import logging
+import Queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils import timezone
+
+from bookstore.models import Review
+from bookstore.signals import reviews_bulk_changed
+
+logger = logging.getLogger(__name__)
+
+#put on the queue to stop the worker once the reviews before it are written
+_STOP = object()
+
+
+class ReviewQueueFull(Exception):
+    """Raised when a review can't be queued because the worker is too far
+    behind; the client should retry later"""
+    pass
+
+
+def get_sync():
+    """whether reviews are written as they're submitted, without the queue
+    and its worker thread (for tests)"""
+    return getattr(settings, 'BOOKSTORE_INGEST_SYNC', False)
+
+
+def get_queue_size():
+    """the most reviews waiting to be written"""
+    return getattr(settings, 'BOOKSTORE_INGEST_QUEUE_SIZE', 1000)
+
+
+def get_batch_size():
+    """the most reviews written in one transaction"""
+    return getattr(settings, 'BOOKSTORE_INGEST_BATCH_SIZE', 200)
+
+
+def get_batch_wait():
+    """seconds the worker waits for more reviews to fill a batch"""
+    return getattr(settings, 'BOOKSTORE_INGEST_BATCH_WAIT', 0.05)
+
+
+def get_put_timeout():
+    """seconds a submitter waits for room on a full queue"""
+    return getattr(settings, 'BOOKSTORE_INGEST_PUT_TIMEOUT', 0.5)
+
+
+def write_reviews(batch):
+    """insert a batch of reviews in one transaction; the bulk signal brings
+    the derived data up to date once per book rather than once per review"""
+    with transaction.commit_on_success():
+        Review.objects.bulk_create(batch)
+        reviews_bulk_changed.send(sender=Review,
+            book_ids=set(review.book_id for review in batch),
+            user_ids=set(review.user_id for review in batch), created=batch)
+
+
+class ReviewIngestQueue(object):
+    """Bounded queue of reviews to write, drained in batches by a background
+    worker thread that's started with the first review"""
+
+    def __init__(self, writer=write_reviews, maxsize=None, batch_size=None,
+            batch_wait=None):
+        self.writer = writer
+        self.queue = Queue.Queue(maxsize or get_queue_size())
+        self.batch_size = batch_size or get_batch_size()
+        self.batch_wait = get_batch_wait() if batch_wait is None else batch_wait
+        self.lock = threading.Lock()
+        self.worker = None
+        self.written = 0
+        self.failed = 0
+
+    def submit(self, review, timeout=None):
+        """queue an unsaved review; raises ReviewQueueFull if there's no room
+        within timeout seconds"""
+        if timeout is None:
+            timeout = get_put_timeout()
+        self.start()
+        try:
+            self.queue.put(review, timeout=timeout)
+        except Queue.Full:
+            raise ReviewQueueFull('%d reviews are waiting to be written.' %
+                self.queue.maxsize)
+
+    def start(self):
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run,
+                    name='bookstore-review-ingest')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def next_batch(self):
+        """block for a review, then take more until the batch is full or the
+        batch wait runs out; returns (batch, whether to stop after it)"""
+        first = self.queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                review = self.queue.get(timeout=max(0.001,
+                    deadline - time.time()))
+            except Queue.Empty:
+                break
+            if review is _STOP:
+                return batch, True
+            batch.append(review)
+        return batch, False
+
+    def write(self, batch):
+        """write the batch; if that fails its reviews are written one by one,
+        so only the reviews that fail on their own are dropped"""
+        try:
+            self.writer(batch)
+        except Exception:
+            if len(batch) == 1:
+                self.failed += 1
+                logger.exception('Writing a review failed')
+                return
+            logger.warning('Writing %d reviews failed, retrying them one by '
+                'one', len(batch), exc_info=True)
+            for review in batch:
+                self.write([review])
+        else:
+            self.written += len(batch)
+
+    def run(self):
+        stop = False
+        try:
+            while not stop:
+                batch, stop = self.next_batch()
+                try:
+                    if batch:
+                        self.write(batch)
+                finally:
+                    #the batch, and the stop marker if one was taken
+                    for i in range(len(batch) + stop):
+                        self.queue.task_done()
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    def flush(self):
+        """wait until every queued review is written"""
+        if self.worker is not None and self.worker.is_alive():
+            self.queue.join()
+
+    def stop(self, timeout=None):
+        """write the queued reviews and stop the worker"""
+        if self.worker is not None and self.worker.is_alive():
+            self.queue.put(_STOP)
+            self.worker.join(timeout)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_ingest_queue():
+    """the process's review queue, flushed when the process exits"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = ReviewIngestQueue()
+            atexit.register(_queue.stop)
+    return _queue
+
+
+def submit_review(review):
+    """write an unsaved review soon, batched with others; in sync mode it's
+    written now. Raises ReviewQueueFull when the queue is full."""
+    if review.timestamp is None:
+        review.timestamp = timezone.now()
+    if get_sync():
+        write_reviews([review])
+    else:
+        get_ingest_queue().submit(review)
@@ -0,0 +1,167 @@
+#bookstore/instrumentation.py
+#Rolph Recto
+
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.db import connections
+
+METRICS = ('queries', 'db_ms', 'template_ms', 'wall_ms')
+PERCENTILES = (50, 90, 99)
+
+_string = re.compile(r"'(?:[^']|'')*'")
+_number = re.compile(r'\b\d+(?:\.\d+)?\b')
+_in_list = re.compile(r'IN \((?:\?, )*\?\)')
+
+
+def get_sample_rate():
+    """fraction of the requests instrumented"""
+    return getattr(settings, 'BOOKSTORE_INSTRUMENTATION_SAMPLE_RATE', 0.1)
+
+
+def get_window():
+    """number of recent samples per view the percentiles are taken over"""
+    return getattr(settings, 'BOOKSTORE_INSTRUMENTATION_WINDOW', 1000)
+
+
+def get_duplicate_threshold():
+    """how many times one query shape may run in a request before it's
+    flagged as a likely N+1 pattern"""
+    return getattr(settings, 'BOOKSTORE_INSTRUMENTATION_DUPLICATES', 3)
+
+
+def query_shape(sql):
+    """the SQL with its literal values taken out, so the queries of an N+1
+    loop all have the same shape"""
+    shape = _number.sub('?', _string.sub('?', sql))
+    return _in_list.sub('IN (...)', shape)
+
+
+def percentile(values, percent):
+    """nearest rank percentile of a sorted list"""
+    if not values:
+        return None
+    #the smallest value with at least percent of the values at or below it;
+    #percent * n is exact, so a whole rank isn't pushed up by rounding
+    rank = int(math.ceil(percent * len(values) / 100.0)) - 1
+    return values[min(len(values) - 1, max(0, rank))]
+
+
+class ViewStats(object):
+    """Rolling samples of one view's requests, and the query shapes flagged
+    as duplicated in them"""
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.requests = 0
+        #query shape -> number of requests it was duplicated in
+        self.duplicates = defaultdict(int)
+
+    def add(self, sample, duplicates):
+        self.samples.append(sample)
+        self.requests += 1
+        for shape in duplicates:
+            self.duplicates[shape] += 1
+
+    def summary(self):
+        summary = {'requests': self.requests, 'window': len(self.samples)}
+        for metric in METRICS:
+            values = sorted(sample[metric] for sample in self.samples
+                if sample[metric] is not None)
+            summary[metric] = dict(('p%d' % percent, percentile(values,
+                percent)) for percent in PERCENTILES)
+        summary['duplicates'] = [{'query': shape, 'requests': count}
+            for shape, count in sorted(self.duplicates.items(),
+                key=lambda item: -item[1])]
+        return summary
+
+
+class StatsRegistry(object):
+    """The samples of every view, kept in memory by each process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def add(self, view_name, sample, duplicates=()):
+        with self.lock:
+            if view_name not in self.views:
+                self.views[view_name] = ViewStats(get_window())
+            self.views[view_name].add(sample, duplicates)
+
+    def summary(self):
+        """{view name: {'requests', 'window', metric: {'p50', ...},
+        'duplicates'}}"""
+        with self.lock:
+            return dict((name, stats.summary())
+                for name, stats in self.views.items())
+
+    def clear(self):
+        with self.lock:
+            self.views = {}
+
+
+stats = StatsRegistry()
+
+
+class InstrumentationMiddleware(object):
+    """Middleware recording, for a sample of the requests, the number of SQL
+    queries and their time, the template render time and the wall time,
+    under the URL name of the view (eg. 'bookstore:book_list'). Put it first
+    in MIDDLEWARE_CLASSES so the wall time covers the other middleware."""
+
+    def process_request(self, request):
+        if random.random() >= get_sample_rate():
+            return None
+        request._instrumentation = {
+            'start': time.time(),
+            'template_ms': None,
+            #the query log is only kept for debug cursors
+            'debug_cursors': [(connection, connection.use_debug_cursor,
+                len(connection.queries)) for connection in connections.all()],
+        }
+        for connection in connections.all():
+            connection.use_debug_cursor = True
+        return None
+
+    def process_template_response(self, request, response):
+        state = getattr(request, '_instrumentation', None)
+        if state is not None:
+            #the template is rendered after the middleware have seen the
+            #response, and the callbacks run once it is
+            start = time.time()
+
+            def rendered(response):
+                state['template_ms'] = (time.time() - start) * 1000
+            response.add_post_render_callback(rendered)
+        return response
+
+    def process_response(self, request, response):
+        state = getattr(request, '_instrumentation', None)
+        if state is None:
+            return response
+        del request._instrumentation
+
+        queries = []
+        for connection, use_debug_cursor, start in state['debug_cursors']:
+            connection.use_debug_cursor = use_debug_cursor
+            queries.extend(connection.queries[start:])
+        shapes = defaultdict(int)
+        for query in queries:
+            shapes[query_shape(query['sql'])] += 1
+        threshold = get_duplicate_threshold()
+
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match is not None else '(unresolved)'
+        stats.add(view_name, {
+            'queries': len(queries),
+            'db_ms': sum(float(query['time']) for query in queries) * 1000,
+            'template_ms': state['template_ms'],
+            'wall_ms': (time.time() - state['start']) * 1000,
+        }, [shape for shape, count in shapes.items() if count >= threshold])
+        return response
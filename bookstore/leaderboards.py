@@ -0,0 +1,261 @@
+#bookstore/leaderboards.py
+#Rolph Recto
+
+import heapq
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from bookstore.models import Book, Leaderboard, LeaderboardEntry, Review
+from bookstore.signals import reviews_bulk_changed
+
+BOARDS = ('top_rated', 'most_reviewed')
+
+
+def get_size():
+    """the number of books shown on a leaderboard"""
+    return getattr(settings, 'BOOKSTORE_LEADERBOARD_SIZE', 10)
+
+
+def get_capacity():
+    """the number of books kept on a leaderboard: twice the size shown, so a
+    book dropping out rarely leaves too few to show"""
+    return get_size() * 2
+
+
+def get_prior_weight():
+    """how many reviews' worth of weight the prior mean gets in a Bayesian
+    rating: a book needs about this many before its own average counts more"""
+    return getattr(settings, 'BOOKSTORE_LEADERBOARD_PRIOR_WEIGHT', 10)
+
+
+def catalogue_mean():
+    """mean rating of all the reviews, from the books' aggregate columns"""
+    totals = Book.objects.aggregate(count=Sum('review_count'),
+        ratings=Sum('rating_sum'))
+    if not totals['count']:
+        return 0.0
+    return float(totals['ratings']) / totals['count']
+
+
+def bayesian_rating(review_count, rating_sum, prior_mean, weight=None):
+    """the book's average rating pulled towards the prior mean, the more so
+    the fewer reviews it has"""
+    if weight is None:
+        weight = get_prior_weight()
+    return (weight * prior_mean + rating_sum) / float(weight + review_count)
+
+
+def book_score(board, review_count, rating_sum, prior_mean):
+    if board == 'top_rated':
+        return bayesian_rating(review_count, rating_sum, prior_mean)
+    return float(review_count)
+
+
+def book_scopes(author_id, publication_year):
+    """the scopes a book is ranked in"""
+    scopes = ['all', 'author:%s' % author_id]
+    if publication_year is not None:
+        scopes.append('decade:%d' % (publication_year // 10 * 10))
+    return scopes
+
+
+def scope_filter(scope):
+    """Book filter of the books in the scope"""
+    if scope == 'all':
+        return {}
+    kind, value = scope.split(':')
+    if kind == 'author':
+        return {'author': int(value)}
+    if kind == 'decade':
+        return {'publication_year__gte': int(value),
+            'publication_year__lt': int(value) + 10}
+    raise ValueError('Unknown leaderboard scope %r' % scope)
+
+
+def _reviewed_books(**filters):
+    return (Book.objects.filter(review_count__gt=0, **filters).order_by()
+        .values_list('pk', 'author', 'publication_year', 'review_count',
+            'rating_sum'))
+
+
+def build_leaderboard(board, scope, prior_mean=None):
+    """(re)compute one leaderboard from the books in its scope"""
+    if prior_mean is None:
+        prior_mean = catalogue_mean()
+    capacity = get_capacity()
+    scores = [(book_score(board, count, ratings, prior_mean), pk)
+        for pk, author_id, year, count, ratings
+        in _reviewed_books(**scope_filter(scope))]
+    best = heapq.nlargest(capacity, scores)
+    with transaction.commit_on_success():
+        Leaderboard.objects.filter(board=board, scope=scope).delete()
+        leaderboard = Leaderboard.objects.create(board=board, scope=scope,
+            prior_mean=prior_mean, complete=len(scores) <= capacity)
+        LeaderboardEntry.objects.bulk_create([LeaderboardEntry(
+                leaderboard=leaderboard, book_id=pk, score=score)
+            for score, pk in best])
+    return leaderboard
+
+
+def rebuild_leaderboards():
+    """recompute every leaderboard, with the current catalogue mean as the
+    prior, in one pass over the reviewed books; returns the number built"""
+    prior_mean = catalogue_mean()
+    capacity = get_capacity()
+    #(board, scope) -> [(score, book id)], trimmed to the capacity as it grows
+    scores = defaultdict(list)
+    sizes = defaultdict(int)
+    for pk, author_id, year, count, ratings in _reviewed_books().iterator():
+        for scope in book_scopes(author_id, year):
+            for board in BOARDS:
+                key = (board, scope)
+                heap = scores[key]
+                item = (book_score(board, count, ratings, prior_mean), pk)
+                if len(heap) < capacity:
+                    heapq.heappush(heap, item)
+                else:
+                    heapq.heappushpop(heap, item)
+                sizes[key] += 1
+
+    with transaction.commit_on_success():
+        LeaderboardEntry.objects.all().delete()
+        Leaderboard.objects.all().delete()
+        #boards with no reviewed books are still built, empty
+        keys = set(scores) | set((board, 'all') for board in BOARDS)
+        Leaderboard.objects.bulk_create([Leaderboard(board=board, scope=scope,
+                prior_mean=prior_mean, complete=sizes[(board, scope)] <=
+                    capacity)
+            for board, scope in keys])
+        ids = dict(((board, scope), pk) for pk, board, scope
+            in Leaderboard.objects.values_list('pk', 'board', 'scope'))
+        LeaderboardEntry.objects.bulk_create([LeaderboardEntry(
+                leaderboard_id=ids[key], book_id=pk, score=score)
+            for key, heap in scores.items() for score, pk in heap])
+    return len(keys)
+
+
+def update_book(book_id):
+    """move the book on the leaderboards of its scopes after its aggregates
+    (or author, or publication year) changed. The stored entries of a board
+    are always its best books, so the book only goes back on if it scores at
+    least as well as the lowest of the rest; a board left with fewer entries
+    than it shows is rebuilt."""
+    try:
+        pk, author_id, year, count, ratings = (Book.objects.filter(pk=book_id)
+            .values_list('pk', 'author', 'publication_year', 'review_count',
+                'rating_sum').get())
+    except Book.DoesNotExist:
+        return
+    scopes = book_scopes(author_id, year)
+    size = get_size()
+    capacity = get_capacity()
+
+    with transaction.commit_on_success():
+        #the book may have moved out of scopes (a new author or year)
+        LeaderboardEntry.objects.filter(book=book_id).exclude(
+            leaderboard__scope__in=scopes).delete()
+        leaderboards = dict(((leaderboard.board, leaderboard.scope),
+            leaderboard) for leaderboard in Leaderboard.objects.filter(
+                scope__in=scopes))
+        entries = defaultdict(list)
+        for leaderboard_id, entry_book, score in (LeaderboardEntry.objects
+                .filter(leaderboard__in=leaderboards.values())
+                .values_list('leaderboard', 'book', 'score')):
+            if entry_book != book_id:
+                entries[leaderboard_id].append(score)
+        LeaderboardEntry.objects.filter(book=book_id,
+            leaderboard__in=leaderboards.values()).delete()
+
+        new_entries = []
+        for scope in scopes:
+            for board in BOARDS:
+                leaderboard = leaderboards.get((board, scope))
+                if leaderboard is None:
+                    build_leaderboard(board, scope)
+                    continue
+                others = entries[leaderboard.pk]
+                full = len(others) >= capacity
+                score = book_score(board, count, ratings,
+                    leaderboard.prior_mean)
+                if count and ((leaderboard.complete and not full) or
+                        (others and score >= min(others))):
+                    if full:
+                        #make room by dropping the lowest of the others
+                        _drop_lowest(leaderboard)
+                    new_entries.append(LeaderboardEntry(
+                        leaderboard=leaderboard, book_id=book_id, score=score))
+                elif leaderboard.complete:
+                    if count:
+                        #the book didn't make it onto a full board
+                        _mark_incomplete(leaderboard)
+                elif len(others) < size:
+                    build_leaderboard(board, scope, leaderboard.prior_mean)
+        LeaderboardEntry.objects.bulk_create(new_entries)
+
+
+def _drop_lowest(leaderboard):
+    lowest = (LeaderboardEntry.objects.filter(leaderboard=leaderboard)
+        .order_by('score', '-book').values_list('pk', flat=True)[:1])
+    LeaderboardEntry.objects.filter(pk__in=list(lowest)).delete()
+    _mark_incomplete(leaderboard)
+
+
+def _mark_incomplete(leaderboard):
+    if leaderboard.complete:
+        leaderboard.complete = False
+        leaderboard.save(update_fields=['complete'])
+
+
+def get_leaderboard(board, scope='all', size=None):
+    """the entries of a leaderboard, best first, with their books and authors.
+    Reading never writes: a board that was never built is empty until a
+    review of a book in its scope or rebuild_leaderboards builds it."""
+    if board not in BOARDS:
+        raise ValueError('Unknown leaderboard %r' % board)
+    scope_filter(scope)
+    return list(LeaderboardEntry.objects
+        .filter(leaderboard__board=board, leaderboard__scope=scope)
+        .select_related('book__author')
+        .order_by('-score', 'book')[:size or get_size()])
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def update_review_leaderboards(sender, instance, **kwargs):
+    book_ids = set([instance.book_id])
+    #an edit may have moved the review from another book
+    stored = getattr(instance, '_stored_rating', None)
+    if stored is not None:
+        book_ids.add(stored[0])
+    for book_id in book_ids:
+        update_book(book_id)
+
+
+@receiver(post_save, sender=Book)
+def update_book_leaderboards(sender, instance, created, **kwargs):
+    #a new book has no reviews; an edit may change its author or decade
+    if not created:
+        update_book(instance.pk)
+
+
+@receiver(post_delete, sender=Book)
+def refill_book_leaderboards(sender, instance, **kwargs):
+    """the book's entries went with it; rebuild the boards of its scopes left
+    with fewer books than they show"""
+    for leaderboard in Leaderboard.objects.filter(complete=False,
+            scope__in=book_scopes(instance.author_id,
+                instance.publication_year)):
+        if leaderboard.entries.count() < get_size():
+            build_leaderboard(leaderboard.board, leaderboard.scope,
+                leaderboard.prior_mean)
+
+
+@receiver(reviews_bulk_changed)
+def update_bulk_leaderboards(sender, book_ids, **kwargs):
+    for book_id in book_ids:
+        update_book(book_id)
@@ -0,0 +1,112 @@
+#bookstore/management/commands/benchmark.py
+#Rolph Recto
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from bookstore import bench
+
+
+class Command(BaseCommand):
+    """Run one of the bookstore benchmarks"""
+    args = '<benchmark>'
+    help = ('Run a bookstore benchmark. Available: templates, views, logins, '
+        'routing. The views benchmark generates a synthetic data set in a throwaway '
+        'test database (set TEST_NAME for a file rather than memory at the '
+        'larger scales) and GETs every bookstore URL; the logins benchmark '
+        'compares the session engines in one; the routing benchmark times '
+        'resolving and reversing the bookstore URLs.')
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', default=1000,
+            help='Number of rows to render (default 1000).'),
+        make_option('--repeat', type='int', default=5,
+            help='Number of timed runs; the best is reported (default 5).'),
+        make_option('--scale', default='10k',
+            help='Reviews generated for the views benchmark: 10k, 100k, 1m, '
+                '10m or a number (default 10k).'),
+        make_option('--seed', type='int', default=0,
+            help='Seed of the generated data (default 0).'),
+        make_option('--cached', action='store_true', default=False,
+            help='Keep the page cache between requests.'),
+        make_option('--output',
+            help='Save the views benchmark results to this JSON file.'),
+        make_option('--compare',
+            help='Flag regressions against the results in this JSON file.'),
+        make_option('--threshold', type='float', default=0.2,
+            help='Median slowdown flagged as a regression (default 0.2).'),
+        make_option('--calls', type='int', default=10000,
+            help='Resolves or reverses per timed routing run (default '
+                '10000).'),
+        make_option('--logins', type='int', default=50,
+            help='Logins timed per session engine (default 50).'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Name one benchmark to run.')
+        name = args[0]
+
+        if name == 'templates':
+            results = bench.benchmark_templates(options['rows'],
+                options['repeat'])
+            for mode in ('uncached', 'cached'):
+                self.stdout.write('%-10s %8.2f ms per 1,000 rows' % (mode,
+                    results[mode]))
+        elif name == 'views':
+            self.benchmark_views(options)
+        elif name == 'logins':
+            self.benchmark_logins(options)
+        elif name == 'routing':
+            results = bench.benchmark_routing(options['calls'],
+                options['repeat'])
+            for mode, rate in sorted(results.items()):
+                self.stdout.write('%-24s %10.0f ops/s' % (mode, rate))
+        else:
+            raise CommandError('Unknown benchmark %r.' % name)
+
+    def benchmark_logins(self, options):
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = bench.benchmark_logins(options['logins'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        for mode, rate in sorted(results.items(), key=lambda item: item[1]):
+            self.stdout.write('%-24s %8.1f logins/s' % (mode, rate))
+
+    def benchmark_views(self, options):
+        try:
+            reviews = bench.parse_scale(options['scale'])
+        except ValueError as e:
+            raise CommandError(e.args[0])
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = bench.run_view_benchmarks(reviews, options['seed'],
+                options['repeat'], options['cached'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write('%d reviews generated in %.1f s' % (reviews,
+            results['meta']['generate_seconds']))
+        self.stdout.write('%-52s %8s %8s %8s %7s' % ('view', 'p50 ms',
+            'p90 ms', 'p99 ms', 'queries'))
+        for label, result in sorted(results['views'].items()):
+            self.stdout.write('%-52s %8.1f %8.1f %8.1f %7d' % (label,
+                result['p50_ms'], result['p90_ms'], result['p99_ms'],
+                result['queries']))
+        self.stdout.write('peak memory %d KB' % results['peak_memory_kb'])
+        if options.get('output'):
+            bench.save_results(results, options['output'])
+
+        if options.get('compare'):
+            regressions = bench.compare_results(
+                bench.load_results(options['compare']), results,
+                options['threshold'])
+            for regression in regressions:
+                self.stdout.write('REGRESSION %s' % regression)
+            if regressions:
+                raise CommandError('%d regression(s) against %s.' % (
+                    len(regressions), options['compare']))
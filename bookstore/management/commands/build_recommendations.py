@@ -0,0 +1,32 @@
+#bookstore/management/commands/build_recommendations.py
+#Rolph Recto
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bookstore import recommendations
+
+
+class Command(BaseCommand):
+    """Rebuild the book neighbours behind the recommendations"""
+    help = ('Recompute the most similar books of every book from the review '
+        'ratings. NumPy and SciPy are used when installed.')
+    option_list = BaseCommand.option_list + (
+        make_option('-k', '--neighbors', type='int', default=20,
+            help='Neighbours kept per book (default 20).'),
+        make_option('--memory', type='int', default=256,
+            help='Megabytes the similarity blocks may use (default 256).'),
+        make_option('--pure-python', action='store_true', default=False,
+            help="Don't use NumPy and SciPy even if they are installed."),
+    )
+
+    def handle(self, *args, **options):
+        if options['neighbors'] < 1:
+            raise CommandError('Keep at least one neighbour per book.')
+        use_numpy = recommendations.numpy is not None and \
+            not options['pure_python']
+        stored = recommendations.build_neighbors(options['neighbors'],
+            options['memory'] * 1024 * 1024, use_numpy)
+        self.stdout.write('Stored %d neighbours (%s).' % (stored,
+            'NumPy' if use_numpy else 'pure Python'))
@@ -0,0 +1,59 @@
+#bookstore/management/commands/export_reviews.py
+#Rolph Recto
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bookstore.export import (EXPORTS, FORMATS, ExportError, export_chunks,
+    render_export)
+
+
+class Command(BaseCommand):
+    """Export reviews (with their books, authors and users) or books as CSV or
+    JSONL, in primary key order"""
+    args = '[reviews|books]'
+    help = ('Export reviews joined with their book, author and user, or the '
+        'books with their authors, as CSV or JSONL. Rows come in primary key '
+        'order, so an interrupted export can be resumed with --after.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=FORMATS, default='csv',
+            help='Output format (default csv).'),
+        make_option('--output',
+            help='Write to this file instead of standard output.'),
+        make_option('--since',
+            help='Only reviews from this date (YYYY-MM-DD) or datetime on.'),
+        make_option('--until',
+            help='Only reviews up to this date (inclusive) or datetime.'),
+        make_option('--book', type='int', help='Only this book id.'),
+        make_option('--user', type='int',
+            help='Only the reviews of this user id.'),
+        make_option('--after', type='int',
+            help='Resume after this primary key.'),
+        make_option('--chunk-size', type='int', default=1000,
+            help='Rows fetched per query (default 1000).'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError('Name at most one export.')
+        kind = args[0] if args else 'reviews'
+        if kind not in EXPORTS:
+            raise CommandError('Unknown export %r.' % kind)
+
+        try:
+            chunks = export_chunks(kind, after=options.get('after'),
+                chunk_size=options['chunk_size'], since=options.get('since'),
+                until=options.get('until'), book=options.get('book'),
+                user=options.get('user'))
+            output = render_export(kind, chunks, options['format'])
+        except ExportError as e:
+            raise CommandError(e.args[0])
+
+        if options.get('output'):
+            with open(options['output'], 'wb') as stream:
+                for data in output:
+                    stream.write(data)
+        else:
+            for data in output:
+                self.stdout.write(data, ending='')
@@ -0,0 +1,52 @@
+#bookstore/management/commands/import_catalogue.py
+#Rolph Recto
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from bookstore.importer import CatalogueImporter, RejectWriter, read_rows
+
+
+class Command(BaseCommand):
+    """Bulk import authors, books or reviews from a CSV or JSONL file"""
+    args = '<authors|books|reviews> <file>'
+    help = ('Import authors (first_name, last_name), books (title, '
+        'author_first_name, author_last_name, publication_year) or reviews '
+        '(username, book_title, author_first_name, author_last_name, '
+        'timestamp, rating, review_message) from a CSV file with a header '
+        'line or a JSONL file.')
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=('csv', 'jsonl'),
+            help='Input format (default: from the file extension).'),
+        make_option('--batch-size', type='int', default=1000,
+            help='Rows inserted per transaction (default 1000).'),
+        make_option('--rejects',
+            help='Write rejected rows and the reasons to this JSONL file.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Give the kind of rows and the file to import.')
+        kind, path = args
+        if kind not in CatalogueImporter.kinds:
+            raise CommandError('Unknown kind %r.' % kind)
+
+        format = options.get('format')
+        if format is None:
+            format = 'jsonl' if path.endswith('.jsonl') else 'csv'
+
+        rejects_file = None
+        if options.get('rejects'):
+            rejects_file = open(options['rejects'], 'w')
+        rejects = RejectWriter(rejects_file)
+        importer = CatalogueImporter(kind, options['batch_size'], rejects)
+        try:
+            with open(path, 'rb') as stream:
+                imported = importer.run(read_rows(stream, format))
+        finally:
+            if rejects_file is not None:
+                rejects_file.close()
+
+        self.stdout.write('Imported %d %s, rejected %d.' % (imported, kind,
+            rejects.count))
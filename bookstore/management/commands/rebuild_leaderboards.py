@@ -0,0 +1,17 @@
+#bookstore/management/commands/rebuild_leaderboards.py
+#Rolph Recto
+
+from django.core.management.base import NoArgsCommand
+
+from bookstore import leaderboards
+
+
+class Command(NoArgsCommand):
+    """Recompute every leaderboard from the books' rating aggregates"""
+    help = ('Rebuild the top rated and most reviewed leaderboards, with the '
+        'current mean rating as the prior. Run it periodically: between '
+        'rebuilds the boards are updated in place and keep their prior.')
+
+    def handle_noargs(self, **options):
+        built = leaderboards.rebuild_leaderboards()
+        self.stdout.write('Rebuilt %d leaderboard(s).' % built)
@@ -0,0 +1,33 @@
+#bookstore/management/commands/rebuild_rating_aggregates.py
+#Rolph Recto
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from bookstore import aggregates, userstats
+from bookstore.models import Review
+
+
+class Command(BaseCommand):
+    """Recompute the per-book rating aggregates, monthly rollups and per-user
+    review stats from the Review table"""
+    help = ('Rebuild the review count, rating sum and histogram of each book, '
+        'its monthly review counts and rating sums, and the review stats of '
+        'each user (of its reviewers, with --book).')
+    option_list = BaseCommand.option_list + (
+        make_option('--book', action='append', dest='book_ids', type='int',
+            help='Only rebuild this book (may be given more than once).'),
+    )
+
+    def handle(self, *args, **options):
+        updated = aggregates.rebuild_book_aggregates(options.get('book_ids'))
+        self.stdout.write('Rebuilt rating aggregates for %d book(s).' % updated)
+        months = aggregates.rebuild_monthly_ratings(options.get('book_ids'))
+        self.stdout.write('Rebuilt %d monthly rating rollup(s).' % months)
+        user_ids = None
+        if options.get('book_ids'):
+            user_ids = (Review.objects.filter(book__in=options['book_ids'])
+                .order_by().values_list('user', flat=True).distinct())
+        users = userstats.rebuild_user_stats(user_ids)
+        self.stdout.write('Rebuilt review stats for %d user(s).' % users)
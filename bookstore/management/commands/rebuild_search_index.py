@@ -0,0 +1,24 @@
+#bookstore/management/commands/rebuild_search_index.py
+#Rolph Recto
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from bookstore.search import FTS5SearchBackend, get_search_backend
+
+
+class Command(NoArgsCommand):
+    """Rebuild the search index of authors, books and reviews"""
+    help = ('Rebuild the search index from the authors, books and reviews '
+        'tables, creating the FTS5 tables if they are missing.')
+
+    def handle_noargs(self, **options):
+        backend = get_search_backend()
+        if isinstance(backend, FTS5SearchBackend):
+            with transaction.commit_on_success():
+                backend.rebuild()
+            self.stdout.write('Rebuilt the FTS5 search index.')
+        else:
+            #the in-memory index lives in the serving processes
+            self.stdout.write('No FTS5 here; the in-memory index is built by '
+                'each process on its first search.')
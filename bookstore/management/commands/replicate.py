@@ -0,0 +1,41 @@
+#bookstore/management/commands/replicate.py
+#Rolph Recto
+
+import time
+from optparse import make_option
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from bookstore import replicas
+
+
+class Command(BaseCommand):
+    """Copy the primary SQLite database into the read replicas"""
+    args = '[replica ...]'
+    help = ('Copy the primary SQLite database into the named replicas (by '
+        'default those in BOOKSTORE_READ_REPLICAS), a stand-in for real '
+        'replication when trying out read replicas locally.')
+    option_list = BaseCommand.option_list + (
+        make_option('--source', default='default',
+            help='Alias of the primary database (default "default").'),
+        make_option('--interval', type='float', default=0,
+            help='Copy again every this many seconds, until interrupted.'),
+    )
+
+    def handle(self, *args, **options):
+        aliases = args or replicas.get_replicas()
+        if not aliases:
+            raise CommandError('Name the replicas, or set '
+                'BOOKSTORE_READ_REPLICAS.')
+        while True:
+            try:
+                results = replicas.replicate(aliases, options['source'])
+            except ImproperlyConfigured as e:
+                raise CommandError(e.args[0])
+            for alias, copied in sorted(results.items()):
+                self.stdout.write('Copied %d table(s) into %s.' % (copied,
+                    alias))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
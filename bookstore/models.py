@@ -2,7 +2,7 @@
 #Rolph Recto
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 
 from django.core.exceptions import ValidationError
 
@@ -22,22 +22,59 @@ class Author(models.Model):
 class Book(models.Model):
     """Model class for books"""
 
-    title = models.CharField(max_length=150)
+    title = models.CharField(max_length=150, db_index=True)
     author = models.ForeignKey(Author)
     #we're assuming that no book is published before 0 A.D.
     publication_year = models.IntegerField(null=True,
         validators=[util.not_negative])
+    #when the book (or its author, see bookstore/cache.py) last changed
+    modified = models.DateTimeField(auto_now=True)
+
+    #rating aggregates, maintained incrementally from Review writes
+    #(see bookstore/aggregates.py) so listings never have to GROUP BY reviews
+    review_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_1_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_2_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_3_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_4_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_5_count = models.PositiveIntegerField(default=0, editable=False)
+
+    AGGREGATE_FIELDS = ('review_count', 'rating_sum', 'rating_1_count',
+        'rating_2_count', 'rating_3_count', 'rating_4_count', 'rating_5_count')
 
     def __unicode__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        #the aggregates are updated in place by Review writes, so saving a
+        #Book loaded earlier must not write its (possibly stale) copy back
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.fields
+                if not f.primary_key and f.name not in self.AGGREGATE_FIELDS]
+        super(Book, self).save(*args, **kwargs)
+
+    @property
+    def average_rating(self):
+        """average review rating, or None if the book has no reviews"""
+        if not self.review_count:
+            return None
+        return float(self.rating_sum) / self.review_count
+
+    def rating_histogram(self):
+        """list of (rating, number of reviews) pairs, from 1 to 5"""
+        return [(rating, getattr(self, 'rating_%d_count' % rating))
+            for rating in range(1, 6)]
+
 
 class Review(models.Model):
     """Model class for user reviews of books"""
 
-    user = models.ForeignKey(User)
-    book = models.ForeignKey(Book)
-    timestamp = models.DateTimeField()
+    #the composite indexes in Meta lead with these columns, so the usual
+    #single-column foreign key indexes would be redundant
+    user = models.ForeignKey(User, db_index=False)
+    book = models.ForeignKey(Book, db_index=False)
+    timestamp = models.DateTimeField(db_index=True)
     #what the user had to say about the book
     review_message = models.TextField()
     #ratings go from 1-5
@@ -50,6 +87,149 @@ class Review(models.Model):
             (5, '5'),
         )
     )
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        #cover the review listings (newest first) and the rating aggregates
+        index_together = [
+            ('book', 'timestamp'),
+            ('user', 'timestamp'),
+            ('book', 'rating'),
+        ]
+
+    def __unicode__(self):
+        return self.user.username + " : " + self.book.title
+
+    def save(self, *args, **kwargs):
+        #the book's rating aggregates are updated by the save signals; do both
+        #in one transaction so the counters can't drift from the reviews
+        with transaction.commit_on_success(using=kwargs.get('using')):
+            super(Review, self).save(*args, **kwargs)
+
+
+class BookMonthlyRating(models.Model):
+    """Model class for the reviews of a book in one calendar month, kept up to
+    date with the reviews (see bookstore/aggregates.py)"""
+
+    #the unique index on (book, month) serves a book's series
+    book = models.ForeignKey(Book, related_name='monthly_ratings',
+        db_index=False)
+    #first day of the month, in the site's time zone
+    month = models.DateField()
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('book', 'month')]
+
+    def __unicode__(self):
+        return self.book.title + " : " + self.month.strftime('%Y-%m')
+
+
+class UserReviewStats(models.Model):
+    """Model class for the summary of a user's reviews, kept up to date with
+    the reviews (see bookstore/userstats.py); users without reviews have
+    none"""
+
+    user = models.OneToOneField(User, primary_key=True,
+        related_name='review_stats')
+    review_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    first_review = models.DateTimeField(null=True)
+    last_review = models.DateTimeField(null=True)
+    #the author of the most of the user's reviews; ties go to the lowest id
+    favorite_author = models.ForeignKey(Author, null=True, related_name='+',
+        on_delete=models.SET_NULL)
 
     def __unicode__(self):
-        return self.user.username + " : " + self.book.title
\ No newline at end of file
+        return self.user.username
+
+    @property
+    def average_rating(self):
+        """average review rating, or None if the user has no reviews"""
+        if not self.review_count:
+            return None
+        return float(self.rating_sum) / self.review_count
+
+
+class UserAuthorReviewCount(models.Model):
+    """Model class for the number of a user's reviews of an author's books,
+    from which the user's favourite author is picked"""
+
+    #the unique index on (user, author) serves a user's counts
+    user = models.ForeignKey(User, related_name='+', db_index=False)
+    author = models.ForeignKey(Author, related_name='+')
+    review_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('user', 'author')]
+
+    def __unicode__(self):
+        return self.user.username + " : " + unicode(self.author)
+
+
+class Leaderboard(models.Model):
+    """Model class for a precomputed ranking of books (see
+    bookstore/leaderboards.py)"""
+
+    board = models.CharField(max_length=20, choices=(
+        ('top_rated', 'Top rated'),
+        ('most_reviewed', 'Most reviewed'),
+    ))
+    #'all', 'author:<author id>' or 'decade:<first year of the decade>'
+    scope = models.CharField(max_length=30)
+    #the catalogue's mean rating when the board was built: the prior of the
+    #Bayesian ratings, kept so every entry's score uses the same one
+    prior_mean = models.FloatField(default=0)
+    #whether the entries hold every reviewed book in the scope, rather than
+    #only the best ones
+    complete = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('board', 'scope'),)
+
+    def __unicode__(self):
+        return self.board + " : " + self.scope
+
+
+class LeaderboardEntry(models.Model):
+    """Model class for a book's place on a leaderboard"""
+
+    leaderboard = models.ForeignKey(Leaderboard, related_name='entries',
+        db_index=False)
+    book = models.ForeignKey(Book)
+    score = models.FloatField()
+
+    class Meta:
+        #the board is read best first
+        index_together = [('leaderboard', 'score')]
+
+    def __unicode__(self):
+        return unicode(self.leaderboard) + " : " + self.book.title
+
+
+class BookNeighbor(models.Model):
+    """Model class for a book similar to another, from the ratings of readers
+    of both (see bookstore/recommendations.py)"""
+
+    book = models.ForeignKey(Book, related_name='neighbors', db_index=False)
+    neighbor = models.ForeignKey(Book, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        #a book's neighbours are read best first
+        index_together = [('book', 'score')]
+
+    def __unicode__(self):
+        return self.book.title + " : " + self.neighbor.title
+
+
+#import the modules whose signal receivers keep derived data in sync
+import bookstore.aggregates
+import bookstore.cache
+import bookstore.search
+#after bookstore.aggregates, whose book columns the leaderboards are ranked by
+import bookstore.leaderboards
+import bookstore.userstats
+#and the module keeping database connections open between requests
+import bookstore.connections
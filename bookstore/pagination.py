@@ -0,0 +1,167 @@
+#bookstore/pagination.py
+#Rolph Recto
+
+import base64
+import datetime
+import json
+import operator
+from functools import reduce
+
+from django.db.models import Q
+from django.http import Http404
+
+
+class InvalidCursor(Exception):
+    """Raised when a pagination cursor can't be decoded"""
+    pass
+
+
+class KeysetPage(object):
+    """One page of a keyset-paginated queryset"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def _split_ordering(ordering):
+    """turn ('-timestamp', '-pk') into [('timestamp', True), ('pk', True)]"""
+    return [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+
+
+def _reverse_ordering(ordering):
+    return [name[1:] if name.startswith('-') else '-' + name
+        for name in ordering]
+
+
+def _key_field(model, name):
+    if name == 'pk':
+        return model._meta.pk
+    return model._meta.get_field(name)
+
+
+def encode_cursor(direction, values):
+    """encode a direction ('n' for after, 'p' for before) and the key values of
+    a row into an opaque url-safe string"""
+    values = [value.isoformat() if isinstance(value, datetime.datetime)
+        else value for value in values]
+    data = json.dumps([direction] + values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii') \
+        .rstrip('=')
+
+
+def decode_cursor(model, ordering, cursor):
+    """inverse of encode_cursor; returns (direction, key values)"""
+    try:
+        padded = str(cursor) + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))
+        direction, values = data[0], data[1:]
+        if direction not in ('n', 'p') or len(values) != len(ordering):
+            raise ValueError(cursor)
+        values = [_key_field(model, name).to_python(value)
+            for (name, descending), value in zip(_split_ordering(ordering),
+                values)]
+    except Exception:
+        raise InvalidCursor(cursor)
+    return direction, values
+
+
+def keyset_filter(ordering, values):
+    """Q object matching the rows that come after the given key values in the
+    given ordering, eg. for ('-timestamp', '-pk') the rows with an earlier
+    timestamp, or the same timestamp and a smaller pk"""
+    keys = _split_ordering(ordering)
+    clauses = []
+    for i, (name, descending) in enumerate(keys):
+        lookup = dict((keys[j][0], values[j]) for j in range(i))
+        lookup['%s__%s' % (name, 'lt' if descending else 'gt')] = values[i]
+        clauses.append(Q(**lookup))
+    return reduce(operator.or_, clauses)
+
+
+def keyset_paginate(queryset, ordering, page_size, cursor=None):
+    """fetch the page of the queryset that the cursor points at (the first page
+    if there is no cursor); each page is a single index range scan of
+    page_size + 1 rows, however deep into the results it is"""
+    model = queryset.model
+    names = [name.lstrip('-') for name in ordering]
+
+    direction, values = 'n', None
+    if cursor:
+        direction, values = decode_cursor(model, ordering, cursor)
+
+    if direction == 'n':
+        page_ordering = ordering
+    else:
+        page_ordering = _reverse_ordering(ordering)
+
+    if values is not None:
+        queryset = queryset.filter(keyset_filter(page_ordering, values))
+    rows = list(queryset.order_by(*page_ordering)[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == 'p':
+        rows.reverse()
+
+    def row_key(row):
+        return [getattr(row, name) for name in names]
+
+    next_cursor = previous_cursor = None
+    if rows:
+        #we came from the other side of a cursor, so there is a page there
+        if (direction == 'n' and has_more) or (direction == 'p' and values):
+            next_cursor = encode_cursor('n', row_key(rows[-1]))
+        if (direction == 'p' and has_more) or (direction == 'n' and values):
+            previous_cursor = encode_cursor('p', row_key(rows[0]))
+
+    return KeysetPage(rows, next_cursor, previous_cursor)
+
+
+def keyset_iterator(queryset, ordering, chunk_size=500):
+    """iterate over the whole queryset in the given ordering, fetching
+    chunk_size rows per query, so only one chunk is in memory at a time"""
+    names = [name.lstrip('-') for name in ordering]
+    values = None
+    while True:
+        chunk = queryset
+        if values is not None:
+            chunk = chunk.filter(keyset_filter(ordering, values))
+        rows = list(chunk.order_by(*ordering)[:chunk_size])
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        values = [getattr(rows[-1], name) for name in names]
+
+
+class KeysetPaginationMixin(object):
+    """ListView mixin that pages through the queryset with keyset cursors
+    instead of OFFSET, so every page costs the same index seek"""
+    paginate_by = 50
+    keyset_ordering = ('pk',)
+    cursor_kwarg = 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        cursor = self.request.GET.get(self.cursor_kwarg)
+        try:
+            page = keyset_paginate(queryset, self.keyset_ordering, page_size,
+                cursor)
+        except InvalidCursor:
+            raise Http404('Invalid page cursor.')
+        return (None, page, page.object_list, page.has_other_pages())
@@ -0,0 +1,240 @@
+#bookstore/recommendations.py
+#Rolph Recto
+
+import heapq
+import math
+from array import array
+from collections import defaultdict
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = None
+
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+
+from bookstore.cache import invalidate
+from bookstore.models import BookNeighbor, Review
+from bookstore.search import author_name
+
+#ratings are centered on the middle of the scale, so a low rating counts
+#against two books being alike rather than for it
+RATING_CENTER = 2.5
+#the similarity of books with few readers in common is shrunk towards 0, by
+#common / (common + SHRINKAGE)
+SHRINKAGE = 5.0
+#the lowest rating a user is taken to have liked a book with
+LIKED_RATING = 4
+#neighbours written per INSERT
+INSERT_BATCH = 1000
+#rough size of one rating held by the pure Python build, in bytes
+PYTHON_RATING_BYTES = 100
+#readers whose ratings are read per query
+MAX_READERS_QUERIED = 900
+
+
+def load_ratings(chunk_size=10000):
+    """the reviews as three compact parallel arrays (user ids, book ids,
+    centered ratings), read in primary key order a chunk at a time"""
+    users, books, values = array('i'), array('i'), array('f')
+    last = 0
+    while True:
+        rows = list(Review.objects.filter(pk__gt=last).order_by('pk')
+            .values_list('pk', 'user', 'book', 'rating')[:chunk_size])
+        for pk, user, book, rating in rows:
+            users.append(user)
+            books.append(book)
+            values.append(rating - RATING_CENTER)
+        if len(rows) < chunk_size:
+            return users, books, values
+        last = rows[-1][0]
+
+
+def _similarity(dot, common, norm, other_norm):
+    """shrunk cosine similarity of two books' centered rating vectors"""
+    return dot / (norm * other_norm) * common / (common + SHRINKAGE)
+
+
+def _rating_norms():
+    """{book id: norm of its centered rating vector}, from one GROUP BY"""
+    squares = defaultdict(float)
+    for book, rating, count in (Review.objects.order_by()
+            .values_list('book', 'rating').annotate(Count('pk'))):
+        squares[book] += count * (rating - RATING_CENTER) ** 2
+    return dict((book, math.sqrt(square)) for book, square in squares.items())
+
+
+def _corating_loads():
+    """[(book id, number of ratings by its readers)] by book id: the ratings
+    held, and the pairs visited, to score the book"""
+    table = Review._meta.db_table
+    cursor = connection.cursor()
+    cursor.execute('SELECT r.book_id, SUM(u.review_count) FROM %(table)s r '
+        'JOIN (SELECT user_id, COUNT(*) AS review_count FROM %(table)s '
+        'GROUP BY user_id) u ON r.user_id = u.user_id GROUP BY r.book_id '
+        'ORDER BY r.book_id' % {'table': table})
+    return cursor.fetchall()
+
+
+def _book_blocks(memory_budget):
+    """[(first book id, last book id)] of runs of books whose readers'
+    ratings fit in memory_budget bytes together; a book whose readers'
+    don't is a block of its own"""
+    limit = max(1, memory_budget // PYTHON_RATING_BYTES)
+    blocks = []
+    first = last = None
+    held = 0
+    for book, load in _corating_loads():
+        if first is not None and held + load > limit:
+            blocks.append((first, last))
+            first = None
+        if first is None:
+            first, held = book, 0
+        last = book
+        held += load
+    if first is not None:
+        blocks.append((first, last))
+    return blocks
+
+
+def python_neighbors(k, memory_budget):
+    """iterate over (book id, [(score, neighbour id)]) for every book, the
+    best k positive scores first. The books are scored a block at a time:
+    the block's ratings are read in (book, user) order, then every rating of
+    their readers, with the blocks sized so those fit in memory_budget bytes.
+    The work for a book is the number of its readers' ratings, which grows
+    quickly with heavy reviewers; NumPy does the same work much faster."""
+    norms = _rating_norms()
+    for first, last in _book_blocks(memory_budget):
+        by_book = defaultdict(list)
+        for book, user, rating in (Review.objects.filter(book__gte=first,
+                book__lte=last).order_by('book', 'user')
+                .values_list('book', 'user', 'rating')):
+            by_book[book].append((user, rating - RATING_CENTER))
+        readers = sorted(set(user for ratings in by_book.values()
+            for user, value in ratings))
+        by_user = defaultdict(list)
+        #SQLite allows 999 query parameters
+        for start in range(0, len(readers), MAX_READERS_QUERIED):
+            for user, book, rating in (Review.objects.filter(
+                    user__in=readers[start:start + MAX_READERS_QUERIED])
+                    .order_by().values_list('user', 'book', 'rating')):
+                by_user[user].append((book, rating - RATING_CENTER))
+        for book in sorted(by_book):
+            dots = defaultdict(float)
+            common = defaultdict(int)
+            for user, value in by_book[book]:
+                for other, other_value in by_user[user]:
+                    if other != book:
+                        dots[other] += value * other_value
+                        common[other] += 1
+            #a book whose ratings cancel out has no similarity to anything
+            norm = norms[book] or 1.0
+            scores = [(_similarity(dot, common[other], norm,
+                norms[other] or 1.0), other) for other, dot in dots.items()]
+            yield book, heapq.nlargest(k, [(score, other)
+                for score, other in scores if score > 0])
+
+
+def numpy_neighbors(users, books, values, k, memory_budget):
+    """iterate over (book id, [(score, neighbour id)]) like python_neighbors,
+    from sparse rating matrices multiplied a block of books at a time; the
+    blocks are sized so their dense results fit in memory_budget bytes"""
+    book_ids, columns = numpy.unique(numpy.array(books, dtype=numpy.int32),
+        return_inverse=True)
+    user_ids, rows = numpy.unique(numpy.array(users, dtype=numpy.int32),
+        return_inverse=True)
+    ratings = scipy.sparse.csr_matrix((numpy.array(values,
+        dtype=numpy.float32), (rows, columns)),
+        shape=(len(user_ids), len(book_ids)))
+    readers = ratings.copy()
+    readers.data[:] = 1
+    norms = numpy.sqrt(numpy.asarray(ratings.multiply(ratings)
+        .sum(axis=0)).ravel()).astype(numpy.float32)
+    #a book whose ratings cancel out has no similarity to anything
+    norms[norms == 0] = 1
+    ratings_by_book = ratings.tocsc()
+    readers_by_book = readers.tocsc()
+
+    count = len(book_ids)
+    #about five dense float32 arrays of block x count are alive at once
+    block = max(1, int(memory_budget // (count * 4 * 5)))
+    for start in range(0, count, block):
+        stop = min(count, start + block)
+        dots = (ratings_by_book[:, start:stop].T * ratings).toarray()
+        common = (readers_by_book[:, start:stop].T * readers).toarray()
+        scores = dots / numpy.outer(norms[start:stop], norms)
+        del dots
+        scores *= common / (common + SHRINKAGE)
+        del common
+        #a book isn't its own neighbour
+        scores[numpy.arange(stop - start), numpy.arange(start, stop)] = 0
+        for i in range(stop - start):
+            row = scores[i]
+            best = (numpy.argpartition(-row, k)[:k] if count > k
+                else numpy.arange(count))
+            best = best[row[best] > 0]
+            best = best[numpy.argsort(-row[best])]
+            yield int(book_ids[start + i]), [(float(row[j]),
+                int(book_ids[j])) for j in best]
+
+
+def build_neighbors(k=20, memory_budget=256 * 1024 * 1024, use_numpy=None):
+    """recompute the k nearest neighbours of every book from the review
+    ratings (item to item collaborative filtering); NumPy and SciPy are used
+    when they're installed. Either way the books are scored a block at a time
+    sized by memory_budget (bytes); NumPy holds every rating besides, the
+    pure Python build only the ratings of the block's readers. Returns the
+    number of neighbours stored."""
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        neighbors = numpy_neighbors(*load_ratings(), k=k,
+            memory_budget=memory_budget)
+    else:
+        neighbors = python_neighbors(k, memory_budget)
+
+    stored = 0
+    with transaction.commit_on_success():
+        BookNeighbor.objects.all().delete()
+        batch = []
+        for book, best in neighbors:
+            batch.extend(BookNeighbor(book_id=book, neighbor_id=neighbor,
+                score=score) for score, neighbor in best)
+            if len(batch) >= INSERT_BATCH:
+                BookNeighbor.objects.bulk_create(batch)
+                stored += len(batch)
+                batch = []
+        BookNeighbor.objects.bulk_create(batch)
+        stored += len(batch)
+    invalidate('recommendations')
+    return stored
+
+
+def readers_also_liked(book, limit=5):
+    """the books most similar to the book, best first"""
+    return [entry.neighbor for entry in BookNeighbor.objects.filter(book=book)
+        .select_related('neighbor__author').order_by('-score')[:limit]]
+
+
+def recommended_for(user, limit=5):
+    """the books most similar to those the user liked, that the user hasn't
+    reviewed yet, as dicts of the book's id, title and author's name; found
+    with one query over the neighbours of the liked books"""
+    liked = Review.objects.filter(user=user, rating__gte=LIKED_RATING)
+    reviewed = Review.objects.filter(user=user)
+    rows = (BookNeighbor.objects
+        .filter(book__in=liked.values('book'))
+        .exclude(neighbor__in=reviewed.values('book'))
+        .values('neighbor', 'neighbor__title', 'neighbor__author__first_name',
+            'neighbor__author__last_name')
+        .annotate(total=Sum('score'))
+        .order_by('-total', 'neighbor')[:limit])
+    return [{
+        'id': row['neighbor'],
+        'title': row['neighbor__title'],
+        'author': author_name(row['neighbor__author__first_name'],
+            row['neighbor__author__last_name']),
+    } for row in rows]
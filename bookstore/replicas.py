@@ -0,0 +1,195 @@
+#bookstore/replicas.py
+#Rolph Recto
+
+import itertools
+import sqlite3
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from bookstore.routers import pop_wrote, set_replica
+
+SAFE_METHODS = ('GET', 'HEAD')
+SELECTIONS = ('round_robin', 'least_loaded')
+#set on the client after it wrote, so its next reads go to the primary
+STICKY_COOKIE = 'bookstore_primary'
+#the URL names of the views whose GETs may read from a replica
+DEFAULT_REPLICA_VIEWS = (
+    'bookstore:book_list',
+    'bookstore:book_review_list',
+    'bookstore:user_review_list',
+    'bookstore:api_book_list',
+    'bookstore:api_book_review_list',
+    'bookstore:api_user_review_list',
+)
+
+
+def get_replicas():
+    """the database aliases of the read replicas"""
+    return tuple(getattr(settings, 'BOOKSTORE_READ_REPLICAS', ()))
+
+
+def get_selection():
+    """how a request's replica is picked: 'round_robin' or 'least_loaded'"""
+    selection = getattr(settings, 'BOOKSTORE_REPLICA_SELECTION',
+        'round_robin')
+    if selection not in SELECTIONS:
+        raise ImproperlyConfigured('BOOKSTORE_REPLICA_SELECTION must be one '
+            'of %s' % ', '.join(SELECTIONS))
+    return selection
+
+
+def get_sticky_seconds():
+    """how long a client reads from the primary after it wrote; should be
+    longer than the replicas lag behind"""
+    return getattr(settings, 'BOOKSTORE_REPLICA_STICKY_SECONDS', 10)
+
+
+def get_replica_views():
+    return getattr(settings, 'BOOKSTORE_REPLICA_VIEWS', DEFAULT_REPLICA_VIEWS)
+
+
+class ReplicaSelector(object):
+    """Picks the replica for each request, in turn or the one with the fewest
+    requests in flight in this process (ties are taken in turn)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turn = itertools.count()
+        self.in_flight = defaultdict(int)
+
+    def acquire(self, replicas, selection):
+        with self.lock:
+            start = next(self.turn)
+            order = [replicas[(start + i) % len(replicas)]
+                for i in range(len(replicas))]
+            if selection == 'least_loaded':
+                alias = min(order, key=lambda alias: self.in_flight[alias])
+            else:
+                alias = order[0]
+            self.in_flight[alias] += 1
+        return alias
+
+    def release(self, alias):
+        with self.lock:
+            self.in_flight[alias] -= 1
+
+
+selector = ReplicaSelector()
+
+
+class ReplicaMiddleware(object):
+    """Middleware reading the GETs of the replica views (the lists of books
+    and reviews) from a read replica, unless the client wrote in the last
+    few seconds. Put it before SessionMiddleware so session writes count."""
+
+    def process_request(self, request):
+        #forget writes made outside of requests
+        pop_wrote()
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        replicas = get_replicas()
+        match = getattr(request, 'resolver_match', None)
+        if (replicas and request.method in SAFE_METHODS and
+                match is not None and
+                match.view_name in get_replica_views() and
+                STICKY_COOKIE not in request.COOKIES):
+            request._replica = selector.acquire(replicas, get_selection())
+            set_replica(request._replica)
+        return None
+
+    def process_response(self, request, response):
+        alias = getattr(request, '_replica', None)
+        if alias is not None:
+            del request._replica
+            set_replica(None)
+            selector.release(alias)
+        if pop_wrote():
+            response.set_cookie(STICKY_COOKIE, '1',
+                max_age=get_sticky_seconds())
+        return response
+
+
+def _sqlite_path(alias):
+    settings_dict = connections[alias].settings_dict
+    if not settings_dict['ENGINE'].endswith('sqlite3'):
+        raise ImproperlyConfigured('Database %r is not SQLite; only SQLite '
+            'databases can be replicated by copying.' % alias)
+    return settings_dict['NAME']
+
+
+def copy_sqlite_database(source_path, target_path):
+    """make the target SQLite database a copy of the source: changed tables,
+    indexes and triggers are recreated and every table's rows are copied, in
+    one transaction, so the target's readers see the old copy or the new one
+    and never a mix. Returns the number of tables copied."""
+    target = sqlite3.connect(target_path, isolation_level=None)
+    try:
+        target.execute('PRAGMA journal_mode = WAL')
+        target.execute('ATTACH DATABASE ? AS source', (source_path,))
+        target.execute('BEGIN IMMEDIATE')
+        try:
+            copied = _copy_attached(target)
+        except Exception:
+            target.execute('ROLLBACK')
+            raise
+        target.execute('COMMIT')
+        target.execute('DETACH DATABASE source')
+    finally:
+        target.close()
+    return copied
+
+
+def _schema(connection, database):
+    #(type, name, sql) in creation order; a virtual table comes before the
+    #shadow tables it creates
+    return connection.execute("SELECT type, name, sql FROM %s.sqlite_master "
+        "WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%%' "
+        "ORDER BY rowid" % database).fetchall()
+
+
+def _copy_attached(target):
+    source = _schema(target, 'source')
+    wanted = set(source)
+    for kind, name, sql in _schema(target, 'main'):
+        if (kind, name, sql) not in wanted:
+            #dropping a virtual table drops its shadow tables with it
+            target.execute('DROP %s IF EXISTS main."%s"' % (kind.upper(),
+                name))
+    for kind, name, sql in source:
+        exists = target.execute('SELECT 1 FROM main.sqlite_master WHERE '
+            'name = ?', (name,)).fetchone()
+        if not exists:
+            target.execute(sql)
+
+    copied = 0
+    for kind, name, sql in source:
+        if kind != 'table' or sql.upper().startswith('CREATE VIRTUAL'):
+            #a virtual table's rows are in its shadow tables
+            continue
+        target.execute('DELETE FROM main."%s"' % name)
+        target.execute('INSERT INTO main."%s" SELECT * FROM source."%s"' % (
+            name, name))
+        copied += 1
+    return copied
+
+
+def replicate(replicas=None, source=DEFAULT_DB_ALIAS):
+    """copy the primary SQLite database into each replica's file, a stand-in
+    for real replication when trying out replicas locally; returns {alias:
+    number of tables copied}"""
+    if replicas is None:
+        replicas = get_replicas()
+    source_path = _sqlite_path(source)
+    results = {}
+    for alias in replicas:
+        target_path = _sqlite_path(alias)
+        if target_path == source_path:
+            raise ImproperlyConfigured('Replica %r is the primary database '
+                'file.' % alias)
+        results[alias] = copy_sqlite_database(source_path, target_path)
+    return results
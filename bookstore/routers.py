@@ -0,0 +1,62 @@
+#bookstore/routers.py
+#Rolph Recto
+
+import threading
+from contextlib import contextmanager
+
+#django.db imports the routers as it's set up, so this module doesn't import
+#it at the top level
+
+#the replica the current thread's request reads from, and whether it wrote
+_state = threading.local()
+
+
+def current_replica():
+    """the replica the current request reads from, or None"""
+    return getattr(_state, 'replica', None)
+
+
+def set_replica(alias):
+    """read from the replica (or the primary, for None) from now on"""
+    _state.replica = alias
+
+
+def pop_wrote():
+    """whether the current thread wrote since the last call"""
+    wrote = getattr(_state, 'wrote', False)
+    _state.wrote = False
+    return wrote
+
+
+@contextmanager
+def use_replica(alias):
+    """read from the replica inside the block"""
+    previous = current_replica()
+    set_replica(alias)
+    try:
+        yield
+    finally:
+        set_replica(previous)
+
+
+class ReplicaRouter(object):
+    """Database router sending reads to the replica picked for the request
+    by bookstore.replicas.ReplicaMiddleware, and everything else to the
+    primary"""
+
+    def db_for_read(self, model, **hints):
+        return current_replica()
+
+    def db_for_write(self, model, **hints):
+        from django.db import DEFAULT_DB_ALIAS
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        #the replicas hold copies of the primary's rows
+        return True
+
+    def allow_syncdb(self, db, model):
+        #replicas get their tables from the primary
+        from bookstore.replicas import get_replicas
+        return db not in get_replicas()
@@ -0,0 +1,141 @@
+#bookstore/routing.py
+#Rolph Recto
+
+import threading
+
+from django.conf import settings
+from django.core.urlresolvers import (RegexURLResolver, Resolver404,
+    ResolverMatch, get_script_prefix, get_urlconf, reverse)
+from django.utils.translation import get_language
+
+#regex characters that end a pattern's literal prefix
+REGEX_SPECIAL = frozenset('.^$*+?{}[]\\|()')
+#quantifiers that make the character before them optional
+OPTIONAL_QUANTIFIERS = frozenset('*?{')
+#the most first path segments whose candidate patterns are remembered
+MAX_SEGMENTS = 1000
+
+
+def _top_level_alternation(regex):
+    #a | outside groups and character classes
+    depth = 0
+    in_class = escaped = False
+    for char in regex:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif in_class:
+            in_class = char != ']'
+        elif char == '[':
+            in_class = True
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+    return False
+
+
+def literal_prefix(regex):
+    """the text every path matched by an anchored regex starts with, e.g.
+    'api/book/' for r'^api/book/(?P<book_id>[0-9]+)/?$'; '' if the regex
+    isn't anchored, starts with a group or has alternatives outside groups"""
+    if not regex.startswith('^') or _top_level_alternation(regex):
+        return ''
+    prefix = []
+    for char in regex[1:]:
+        if char in REGEX_SPECIAL:
+            if char in OPTIONAL_QUANTIFIERS and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class PrefixURLResolver(RegexURLResolver):
+    """URL resolver that only tries the patterns whose literal prefix fits the
+    path: patterns are indexed by the first segment of their prefix, so a
+    path is matched against a handful of them rather than all in turn. The
+    first match in URLconf order wins, as with RegexURLResolver."""
+
+    def __init__(self, *args, **kwargs):
+        super(PrefixURLResolver, self).__init__(*args, **kwargs)
+        self._index = None
+        self._candidates = {}
+        self._index_lock = threading.Lock()
+
+    def _build_index(self):
+        #{first segment: [(position, pattern)]} for the prefixes with a
+        #slash, and [(position, prefix, pattern)] for the rest
+        segments = {}
+        loose = []
+        for position, pattern in enumerate(self.url_patterns):
+            prefix = literal_prefix(pattern.regex.pattern)
+            if '/' in prefix:
+                segments.setdefault(prefix.split('/', 1)[0], []).append(
+                    (position, pattern))
+            else:
+                loose.append((position, prefix, pattern))
+        return segments, loose
+
+    def candidates(self, path):
+        """the patterns that could match the path, in URLconf order"""
+        segment = path.split('/', 1)[0]
+        candidates = self._candidates.get(segment)
+        if candidates is not None:
+            return candidates
+        with self._index_lock:
+            if self._index is None:
+                self._index = self._build_index()
+        segments, loose = self._index
+        #a prefix without a slash fits the path if it fits the first segment
+        found = segments.get(segment, []) + [(position, pattern)
+            for position, prefix, pattern in loose
+            if segment.startswith(prefix)]
+        candidates = [pattern for position, pattern in sorted(found,
+            key=lambda item: item[0])]
+        if len(self._candidates) < MAX_SEGMENTS:
+            self._candidates[segment] = candidates
+        return candidates
+
+    def resolve(self, path):
+        match = self.regex.search(path)
+        if match:
+            new_path = path[match.end():]
+            for pattern in self.candidates(new_path):
+                try:
+                    sub_match = pattern.resolve(new_path)
+                except Resolver404:
+                    continue
+                if sub_match:
+                    sub_match_dict = dict(match.groupdict(),
+                        **self.default_kwargs)
+                    sub_match_dict.update(sub_match.kwargs)
+                    return ResolverMatch(sub_match.func, sub_match.args,
+                        sub_match_dict, sub_match.url_name,
+                        self.app_name or sub_match.app_name,
+                        [self.namespace] + sub_match.namespaces)
+        #no match: let the linear search raise, with every pattern tried
+        return super(PrefixURLResolver, self).resolve(path)
+
+
+_reversed = {}
+
+
+def cached_reverse(viewname, urlconf=None, current_app=None):
+    """reverse() of a URL name without arguments, remembered per URLconf,
+    script prefix and language"""
+    key = (viewname, urlconf or get_urlconf(), settings.ROOT_URLCONF,
+        current_app, get_script_prefix(), get_language())
+    try:
+        return _reversed[key]
+    except KeyError:
+        url = reverse(viewname, urlconf=urlconf, current_app=current_app)
+        _reversed[key] = url
+        return url
+
+
+def clear_reverse_cache():
+    _reversed.clear()
@@ -0,0 +1,547 @@
+#bookstore/search.py
+#Rolph Recto
+
+import heapq
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save, post_delete, post_syncdb
+from django.dispatch import receiver
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from bookstore.models import Author, Book, Review
+from bookstore.signals import books_bulk_created, reviews_bulk_changed
+
+#snippet() marks the matched terms with these, so the rest of the text can be
+#escaped before the marks are turned into <mark> tags
+MARK_START = u'\x02'
+MARK_END = u'\x03'
+#a match in a book's title or author counts for this many review matches
+BOOK_WEIGHT = 5.0
+#the most rows the admin filters a search down to in Python (SQLite allows
+#999 query parameters)
+MAX_ADMIN_IDS = 900
+
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def get_max_review_matches():
+    """the most matching reviews whose scores are added up into the books'"""
+    return getattr(settings, 'BOOKSTORE_SEARCH_MAX_REVIEW_MATCHES', 1000)
+
+
+def tokenize(text):
+    """the lowercase words of the text"""
+    return _word.findall((text or u'').lower())
+
+
+def highlight(snippet):
+    """the snippet as safe HTML, matched terms in <mark> tags"""
+    return mark_safe(escape(snippet).replace(MARK_START, u'<mark>')
+        .replace(MARK_END, u'</mark>'))
+
+
+def author_name(first_name, last_name):
+    return u' '.join(name for name in (first_name, last_name) if name)
+
+
+class SearchResult(object):
+    """A book matching a search, with its score and the best matching review
+    text (as HTML, or None if only the title or author matched)"""
+
+    def __init__(self, book, score, snippet=None):
+        self.book = book
+        self.score = score
+        self.snippet = snippet
+
+
+class FTS5SearchBackend(object):
+    """Search backend using SQLite FTS5 tables next to the bookstore tables:
+    one for authors, one for books (title and author name) and one for
+    reviews, whose rowids are the indexed rows' primary keys"""
+    author_table = 'bookstore_search_author'
+    book_table = 'bookstore_search_book'
+    review_table = 'bookstore_search_review'
+
+    @classmethod
+    def available(cls):
+        if connection.vendor != 'sqlite':
+            return False
+        cursor = connection.cursor()
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+    def execute(self, sql, params=()):
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def create_tables(self):
+        #the sqlite3 module commits before DDL, so only run it when needed
+        names = [self.author_table, self.book_table, self.review_table]
+        existing = self.execute("SELECT COUNT(*) FROM sqlite_master WHERE "
+            "type = 'table' AND name IN (%s)" % ', '.join(['%s'] * len(names)),
+            names).fetchone()[0]
+        if existing == len(names):
+            return
+        self.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(name, "
+            "prefix='2 3')" % self.author_table)
+        self.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(title, "
+            "author, prefix='2 3')" % self.book_table)
+        self.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING "
+            "fts5(message, book_id UNINDEXED)" % self.review_table)
+
+    def match(self, query, prefix=False):
+        """an FTS5 query matching all the words of the query, or None"""
+        words = tokenize(query)
+        if not words:
+            return None
+        return u' '.join(u'"%s"%s' % (word, '*' if prefix else '')
+            for word in words)
+
+    #indexing
+
+    def index_author(self, author):
+        self.remove_author(author.pk)
+        self.execute('INSERT INTO %s (rowid, name) VALUES (%%s, %%s)' %
+            self.author_table, (author.pk, author_name(author.first_name,
+                author.last_name)))
+
+    def remove_author(self, author_id):
+        self.execute('DELETE FROM %s WHERE rowid = %%s' % self.author_table,
+            (author_id,))
+
+    def index_books(self, book_ids):
+        if not book_ids:
+            return
+        for book_id in book_ids:
+            self.remove_book(book_id)
+        placeholders = ', '.join(['%s'] * len(book_ids))
+        self.execute("INSERT INTO %s (rowid, title, author) SELECT b.id, "
+            "b.title, TRIM(a.first_name || ' ' || a.last_name) "
+            "FROM bookstore_book b JOIN bookstore_author a ON b.author_id = a.id "
+            "WHERE b.id IN (%s)" % (self.book_table, placeholders),
+            list(book_ids))
+
+    def remove_book(self, book_id):
+        self.execute('DELETE FROM %s WHERE rowid = %%s' % self.book_table,
+            (book_id,))
+
+    def index_review(self, review):
+        self.remove_review(review.pk)
+        self.execute('INSERT INTO %s (rowid, message, book_id) VALUES (%%s, '
+            '%%s, %%s)' % self.review_table, (review.pk,
+                review.review_message, review.book_id))
+
+    def remove_review(self, review_id):
+        self.execute('DELETE FROM %s WHERE rowid = %%s' % self.review_table,
+            (review_id,))
+
+    def index_missing(self, book_ids):
+        """index the given books, their authors and their reviews, those that
+        aren't indexed yet (rows bulk inserted without signals)"""
+        book_ids = list(book_ids)
+        if not book_ids:
+            return
+        params = {'books': ', '.join(['%s'] * len(book_ids))}
+        params['table'] = self.book_table
+        self.execute("INSERT INTO %(table)s (rowid, title, author) SELECT "
+            "b.id, b.title, TRIM(a.first_name || ' ' || a.last_name) "
+            "FROM bookstore_book b JOIN bookstore_author a ON b.author_id = a.id "
+            "WHERE b.id IN (%(books)s) AND b.id NOT IN "
+            "(SELECT rowid FROM %(table)s)" % params, book_ids)
+        params['table'] = self.author_table
+        self.execute("INSERT INTO %(table)s (rowid, name) SELECT id, "
+            "TRIM(first_name || ' ' || last_name) FROM bookstore_author "
+            "WHERE id IN (SELECT author_id FROM bookstore_book WHERE id IN "
+            "(%(books)s)) AND id NOT IN (SELECT rowid FROM %(table)s)" % params,
+            book_ids)
+        params['table'] = self.review_table
+        self.execute("INSERT INTO %(table)s (rowid, message, book_id) "
+            "SELECT id, review_message, book_id FROM bookstore_review "
+            "WHERE book_id IN (%(books)s) AND id NOT IN "
+            "(SELECT rowid FROM %(table)s)" % params, book_ids)
+
+    def index_authors(self, author_ids):
+        """index the given authors that aren't indexed yet"""
+        author_ids = list(author_ids)
+        if not author_ids:
+            return
+        self.execute("INSERT INTO %(table)s (rowid, name) SELECT id, "
+            "TRIM(first_name || ' ' || last_name) FROM bookstore_author "
+            "WHERE id IN (%(authors)s) AND id NOT IN "
+            "(SELECT rowid FROM %(table)s)" % {'table': self.author_table,
+                'authors': ', '.join(['%s'] * len(author_ids))}, author_ids)
+
+    def rebuild(self):
+        self.create_tables()
+        for table in (self.author_table, self.book_table, self.review_table):
+            self.execute('DELETE FROM %s' % table)
+        self.execute("INSERT INTO %s (rowid, name) SELECT id, "
+            "TRIM(first_name || ' ' || last_name) FROM bookstore_author" %
+            self.author_table)
+        self.execute("INSERT INTO %s (rowid, title, author) SELECT b.id, "
+            "b.title, TRIM(a.first_name || ' ' || a.last_name) "
+            "FROM bookstore_book b JOIN bookstore_author a ON b.author_id = a.id"
+            % self.book_table)
+        self.execute('INSERT INTO %s (rowid, message, book_id) SELECT id, '
+            'review_message, book_id FROM bookstore_review' % self.review_table)
+
+    #searching
+
+    def search_books(self, query, limit):
+        """[(book id, score)] of the best matching books"""
+        match = self.match(query)
+        if match is None:
+            return []
+        scores = defaultdict(float)
+        #bm25 scores are negative, the best match lowest
+        for book_id, score in self.execute('SELECT rowid, bm25(%(table)s, 2.0, '
+                '1.0) FROM %(table)s WHERE %(table)s MATCH %%s ORDER BY 2 '
+                'LIMIT %%s' % {'table': self.book_table}, (match, limit)):
+            scores[book_id] -= score * BOOK_WEIGHT
+        #only the best review matches are summed up per book, so a common
+        #word doesn't group every review that has it
+        for book_id, score in self.execute('SELECT book_id, SUM(rank) AS '
+                'score FROM (SELECT book_id, rank FROM %(table)s WHERE '
+                '%(table)s MATCH %%s ORDER BY rank LIMIT %%s) GROUP BY book_id '
+                'ORDER BY score LIMIT %%s' % {'table': self.review_table},
+                (match, get_max_review_matches(), limit)):
+            scores[int(book_id)] -= score
+        return sorted(scores.items(), key=lambda item: -item[1])[:limit]
+
+    def snippets(self, query, book_ids):
+        """{book id: snippet of its best matching review}"""
+        match = self.match(query)
+        if match is None or not book_ids:
+            return {}
+        snippets = {}
+        rows = self.execute('SELECT book_id, snippet(%(table)s, 0, %%s, %%s, '
+            '%%s, 12) FROM %(table)s WHERE %(table)s MATCH %%s AND book_id IN '
+            '(%(books)s) ORDER BY rank' % {'table': self.review_table,
+                'books': ', '.join(['%s'] * len(book_ids))},
+            [MARK_START, MARK_END, u'\u2026', match] + list(book_ids))
+        for book_id, snippet in rows:
+            snippets.setdefault(int(book_id), snippet)
+        return snippets
+
+    def filter_queryset(self, queryset, query):
+        """the Author or Book queryset narrowed to the rows matching the
+        query, every word as a prefix"""
+        table = (self.author_table if queryset.model is Author
+            else self.book_table)
+        match = self.match(query, prefix=True)
+        if match is None:
+            return queryset
+        return queryset.extra(where=['%s.id IN (SELECT rowid FROM %s WHERE '
+            '%s MATCH %%s)' % (queryset.model._meta.db_table, table, table)],
+            params=[match])
+
+
+class PythonSearchBackend(object):
+    """Search backend keeping an inverted index in memory, for databases
+    without FTS5. It's built from the database on first use and then kept up
+    to date by the signals below, so it only sees the writes made in its own
+    process; run several processes with the FTS5 backend."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built = False
+
+    def build(self):
+        with self.lock:
+            if not self.built:
+                self.rebuild()
+
+    def rebuild(self):
+        with self.lock:
+            #kind -> term -> {pk: term count}, and kind -> pk -> terms
+            self.postings = {'author': defaultdict(dict),
+                'book': defaultdict(dict), 'review': defaultdict(dict)}
+            self.documents = {'author': {}, 'book': {}, 'review': {}}
+            self.review_books = {}
+            for pk, first, last in Author.objects.values_list('pk',
+                    'first_name', 'last_name'):
+                self.add('author', pk, author_name(first, last))
+            for pk, title, first, last in Book.objects.values_list('pk',
+                    'title', 'author__first_name', 'author__last_name'):
+                #a title word counts twice, as in the FTS5 backend's weights
+                self.add('book', pk, u' '.join((title, title,
+                    author_name(first, last))))
+            for pk, book_id, message in Review.objects.values_list('pk',
+                    'book', 'review_message').iterator():
+                self.add('review', pk, message)
+                self.review_books[pk] = book_id
+            self.built = True
+
+    def add(self, kind, pk, text):
+        self.remove(kind, pk)
+        counts = defaultdict(int)
+        for term in tokenize(text):
+            counts[term] += 1
+        for term, count in counts.items():
+            self.postings[kind][term][pk] = count
+        self.documents[kind][pk] = tuple(counts)
+
+    def remove(self, kind, pk):
+        for term in self.documents[kind].pop(pk, ()):
+            postings = self.postings[kind][term]
+            postings.pop(pk, None)
+            if not postings:
+                del self.postings[kind][term]
+
+    #indexing; before the index is built there's nothing to keep up to date
+
+    def index_author(self, author):
+        with self.lock:
+            if self.built:
+                self.add('author', author.pk, author_name(author.first_name,
+                    author.last_name))
+
+    def remove_author(self, author_id):
+        with self.lock:
+            if self.built:
+                self.remove('author', author_id)
+
+    def index_books(self, book_ids):
+        with self.lock:
+            if self.built:
+                for pk, title, first, last in (Book.objects
+                        .filter(pk__in=list(book_ids)).values_list('pk',
+                            'title', 'author__first_name', 'author__last_name')):
+                    self.add('book', pk, u' '.join((title, title,
+                        author_name(first, last))))
+
+    def remove_book(self, book_id):
+        with self.lock:
+            if self.built:
+                self.remove('book', book_id)
+
+    def index_review(self, review):
+        with self.lock:
+            if self.built:
+                self.add('review', review.pk, review.review_message)
+                self.review_books[review.pk] = review.book_id
+
+    def remove_review(self, review_id):
+        with self.lock:
+            if self.built:
+                self.remove('review', review_id)
+                self.review_books.pop(review_id, None)
+
+    def index_missing(self, book_ids):
+        with self.lock:
+            if not self.built:
+                return
+            book_ids = list(book_ids)
+            self.index_authors(Book.objects.filter(pk__in=book_ids)
+                .values_list('author', flat=True))
+            self.index_books([book_id for book_id in book_ids
+                if book_id not in self.documents['book']])
+            for pk, book_id, message in Review.objects.filter(
+                    book__in=book_ids).values_list('pk', 'book',
+                        'review_message'):
+                if pk not in self.review_books:
+                    self.add('review', pk, message)
+                    self.review_books[pk] = book_id
+
+    def index_authors(self, author_ids):
+        with self.lock:
+            if not self.built:
+                return
+            missing = set(author_ids) - set(self.documents['author'])
+            for pk, first, last in Author.objects.filter(
+                    pk__in=list(missing)).values_list('pk', 'first_name',
+                        'last_name'):
+                self.add('author', pk, author_name(first, last))
+
+    #searching
+
+    def terms(self, kind, word, prefix):
+        if not prefix:
+            return [word] if word in self.postings[kind] else []
+        return [term for term in self.postings[kind] if term.startswith(word)]
+
+    def matches(self, kind, query, prefix=False):
+        """{pk: tf-idf score} of the documents containing every word"""
+        words = tokenize(query)
+        if not words:
+            return {}
+        total = len(self.documents[kind]) or 1
+        scores = None
+        for word in words:
+            word_scores = defaultdict(float)
+            for term in self.terms(kind, word, prefix):
+                postings = self.postings[kind][term]
+                idf = math.log(1.0 + float(total) / len(postings))
+                for pk, count in postings.items():
+                    word_scores[pk] += count * idf
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = dict((pk, score + word_scores[pk])
+                    for pk, score in scores.items() if pk in word_scores)
+            if not scores:
+                return {}
+        return scores
+
+    def search_books(self, query, limit):
+        self.build()
+        with self.lock:
+            scores = defaultdict(float)
+            for pk, score in self.matches('book', query).items():
+                scores[pk] += score * BOOK_WEIGHT
+            reviews = self.matches('review', query)
+            for pk in heapq.nlargest(get_max_review_matches(), reviews,
+                    key=reviews.get):
+                scores[self.review_books[pk]] += reviews[pk]
+        return sorted(scores.items(), key=lambda item: -item[1])[:limit]
+
+    def snippets(self, query, book_ids):
+        self.build()
+        with self.lock:
+            best = {}
+            for pk, score in self.matches('review', query).items():
+                book_id = self.review_books[pk]
+                if book_id in book_ids and (book_id not in best or
+                        score > best[book_id][1]):
+                    best[book_id] = (pk, score)
+        words = set(tokenize(query))
+        messages = dict(Review.objects.filter(pk__in=[pk for pk, score
+            in best.values()]).values_list('pk', 'review_message'))
+        return dict((book_id, self.snippet(messages.get(pk, u''), words))
+            for book_id, (pk, score) in best.items())
+
+    def snippet(self, text, words, size=12):
+        """the stretch of up to size words of the text around the first
+        matched word, matched words marked"""
+        tokens = list(_word.finditer(text))
+        first = 0
+        for i, token in enumerate(tokens):
+            if token.group().lower() in words:
+                first = i
+                break
+        start = max(0, first - size // 4)
+        tokens = tokens[start:start + size]
+        if not tokens:
+            return text
+        pieces = []
+        position = tokens[0].start()
+        for token in tokens:
+            pieces.append(text[position:token.start()])
+            if token.group().lower() in words:
+                pieces.append(MARK_START + token.group() + MARK_END)
+            else:
+                pieces.append(token.group())
+            position = token.end()
+        snippet = u''.join(pieces)
+        if start > 0:
+            snippet = u'\u2026' + snippet
+        if position < len(text.rstrip()):
+            snippet += u'\u2026'
+        return snippet
+
+    def filter_queryset(self, queryset, query):
+        self.build()
+        kind = 'author' if queryset.model is Author else 'book'
+        if not tokenize(query):
+            return queryset
+        with self.lock:
+            scores = self.matches(kind, query, prefix=True)
+        ids = sorted(scores, key=lambda pk: -scores[pk])[:MAX_ADMIN_IDS]
+        return queryset.filter(pk__in=ids)
+
+
+_backend = None
+
+
+def get_search_backend():
+    """the search backend named by settings.BOOKSTORE_SEARCH_BACKEND: 'fts5',
+    'python' or (the default) 'auto', FTS5 wherever SQLite has it"""
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'BOOKSTORE_SEARCH_BACKEND', 'auto')
+        if name == 'auto':
+            name = 'fts5' if FTS5SearchBackend.available() else 'python'
+        if name == 'fts5':
+            _backend = FTS5SearchBackend()
+        elif name == 'python':
+            _backend = PythonSearchBackend()
+        else:
+            raise ValueError('Unknown search backend %r' % name)
+    return _backend
+
+
+def search(query, limit=20):
+    """the SearchResults of the books best matching the query: its words in
+    the title, author name or review text"""
+    backend = get_search_backend()
+    scores = backend.search_books(query, limit)
+    if not scores:
+        return []
+    book_ids = [book_id for book_id, score in scores]
+    books = Book.objects.select_related('author').in_bulk(book_ids)
+    snippets = backend.snippets(query, book_ids)
+    return [SearchResult(books[book_id], score,
+            highlight(snippets[book_id]) if book_id in snippets else None)
+        for book_id, score in scores if book_id in books]
+
+
+@receiver(post_syncdb)
+def create_search_tables(sender, **kwargs):
+    """syncdb doesn't know about the FTS5 tables"""
+    if sender.__name__ == 'bookstore.models' and \
+            isinstance(get_search_backend(), FTS5SearchBackend):
+        get_search_backend().create_tables()
+
+
+@receiver(post_save, sender=Author)
+def index_author(sender, instance, created, **kwargs):
+    backend = get_search_backend()
+    backend.index_author(instance)
+    #the books are found by their author's name too
+    if not created:
+        backend.index_books(list(Book.objects.filter(author=instance)
+            .values_list('pk', flat=True)))
+
+
+@receiver(post_delete, sender=Author)
+def unindex_author(sender, instance, **kwargs):
+    get_search_backend().remove_author(instance.pk)
+
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, **kwargs):
+    get_search_backend().index_books([instance.pk])
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    get_search_backend().remove_book(instance.pk)
+
+
+@receiver(post_save, sender=Review)
+def index_review(sender, instance, **kwargs):
+    get_search_backend().index_review(instance)
+
+
+@receiver(post_delete, sender=Review)
+def unindex_review(sender, instance, **kwargs):
+    get_search_backend().remove_review(instance.pk)
+
+
+@receiver(reviews_bulk_changed)
+def index_bulk_reviews(sender, book_ids, **kwargs):
+    get_search_backend().index_missing(book_ids)
+
+
+@receiver(books_bulk_created)
+def index_bulk_books(sender, book_ids, author_ids, **kwargs):
+    backend = get_search_backend()
+    backend.index_authors(author_ids)
+    backend.index_missing(book_ids)
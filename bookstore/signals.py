@@ -0,0 +1,16 @@
+#bookstore/signals.py
+#Rolph Recto
+
+from django.dispatch import Signal
+
+#sent after reviews are written in bulk (bulk_create, queryset updates),
+#which bypasses the per-instance model signals; receivers bring whatever
+#they derive from the reviews of these books and users up to date in one go.
+#When the batch only inserted reviews, 'created' is the list of them, so
+#receivers can add them in rather than recount.
+reviews_bulk_changed = Signal(providing_args=['book_ids', 'user_ids',
+    'created'])
+
+#sent after authors or books are inserted in bulk, which bypasses their
+#post_save signals
+books_bulk_created = Signal(providing_args=['book_ids', 'author_ids'])
@@ -0,0 +1,86 @@
+#bookstore/templatetags/bookstore_admin.py
+#Rolph Recto
+
+import datetime
+
+from django import template
+from django.conf import settings
+from django.contrib.admin.templatetags.admin_list import date_hierarchy
+from django.contrib.admin.views.main import IGNORED_PARAMS
+from django.utils import formats, timezone
+from django.utils.text import capfirst
+from django.utils.translation import ugettext as _
+
+from bookstore.models import BookMonthlyRating
+
+register = template.Library()
+
+
+def _month_range(year, month):
+    """the start of the month and of the next, in the site's time zone"""
+    start = datetime.datetime(year, month, 1)
+    end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+    if not settings.USE_TZ:
+        return start, end
+    zone = timezone.get_default_timezone()
+    return timezone.make_aware(start, zone), timezone.make_aware(end, zone)
+
+
+@register.inclusion_tag('admin/date_hierarchy.html')
+def review_date_hierarchy(cl):
+    """the admin's date hierarchy of the reviews, with the years and months
+    read from the monthly rollups (see bookstore/aggregates.py) rather than
+    with DISTINCT queries over every review. Filtered or searched lists fall
+    back to the admin's own queries."""
+    field_name = cl.date_hierarchy
+    field_generic = '%s__' % field_name
+    year_field = '%s__year' % field_name
+    month_field = '%s__month' % field_name
+    day_field = '%s__day' % field_name
+    filtered = cl.query or [name for name in cl.params
+        if name not in IGNORED_PARAMS and not name.startswith(field_generic)]
+    if filtered or cl.params.get(day_field):
+        return date_hierarchy(cl)
+
+    link = lambda params: cl.get_query_string(params, [field_generic])
+    year_lookup = cl.params.get(year_field)
+    month_lookup = cl.params.get(month_field)
+    months = BookMonthlyRating.objects.all()
+
+    if year_lookup and month_lookup:
+        year, month = int(year_lookup), int(month_lookup)
+        start, end = _month_range(year, month)
+        #one month of reviews, through the timestamp index
+        days = cl.query_set.filter(**{field_name + '__gte': start,
+            field_name + '__lt': end}).dates(field_name, 'day')
+        return {
+            'show': True,
+            'back': {
+                'link': link({year_field: year_lookup}),
+                'title': str(year_lookup),
+            },
+            'choices': [{
+                'link': link({year_field: year_lookup,
+                    month_field: month_lookup, day_field: day.day}),
+                'title': capfirst(formats.date_format(day, 'MONTH_DAY_FORMAT')),
+            } for day in days],
+        }
+    elif year_lookup:
+        return {
+            'show': True,
+            'back': {'link': link({}), 'title': _('All dates')},
+            'choices': [{
+                'link': link({year_field: year_lookup,
+                    month_field: month.month}),
+                'title': capfirst(formats.date_format(month,
+                    'YEAR_MONTH_FORMAT')),
+            } for month in months.filter(month__year=int(year_lookup))
+                .dates('month', 'month')],
+        }
+    return {
+        'show': True,
+        'choices': [{
+            'link': link({year_field: str(year.year)}),
+            'title': str(year.year),
+        } for year in months.dates('month', 'year')],
+    }
@@ -0,0 +1,40 @@
+#bookstore/templatetags/bookstore_urls.py
+#Rolph Recto
+
+from django import template
+from django.core.urlresolvers import NoReverseMatch
+from django.template.defaulttags import URLNode, url as url_tag
+
+from bookstore.routing import cached_reverse
+
+register = template.Library()
+
+
+class CachedURLNode(URLNode):
+    """{% url %} without arguments, reversed once per URL name rather than on
+    every render"""
+
+    def render(self, context):
+        view_name = self.view_name.resolve(context)
+        if not view_name:
+            #let the url tag raise its error
+            return super(CachedURLNode, self).render(context)
+        try:
+            url = cached_reverse(view_name, current_app=context.current_app)
+        except NoReverseMatch:
+            #the url tag's fallbacks and errors
+            return super(CachedURLNode, self).render(context)
+        if self.asvar:
+            context[self.asvar] = url
+            return ''
+        return url
+
+
+@register.tag
+def url(parser, token):
+    """the url tag, with the URLs of names without arguments memoized; load
+    it after the built-in one to replace it"""
+    node = url_tag(parser, token)
+    if node.args or node.kwargs:
+        return node
+    return CachedURLNode(node.view_name, node.args, node.kwargs, node.asvar)
@@ -1,13 +1,88 @@
 #bookstore/tests.py
 #Rolph Recto
 
+import csv
 import datetime
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from StringIO import StringIO
+from contextlib import contextmanager
 
-from django.test import TestCase
+from django.contrib import admin
+from django.test import TestCase, TransactionTestCase
+from django.template import Context
+from django.template.loader import get_template
+from django.test.client import RequestFactory
+from django.http import Http404, HttpResponse
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.views.generic.base import TemplateView, View
+from django.core.management import call_command
+from django.core.signals import request_finished, request_started
+from django import db
+from django.db import connection, reset_queries, router
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.db.models import Count
+from django.utils.unittest import skipUnless
+from django.utils import timezone
+from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User, UserManager
-from bookstore.models import Author, Book, Review
+from bookstore import (bench, bundles, connections, importer, ingest,
+    instrumentation, leaderboards, recommendations, replicas, routers,
+    routing, search, userstats)
+from bookstore.aggregates import monthly_ratings, review_month
+from bookstore.api import ConditionalResponseMixin
+from bookstore.cache import CachedResponseMixin, get_bookstore_cache
+from bookstore.signals import books_bulk_created, reviews_bulk_changed
+from bookstore.util import LRUCache
+from bookstore.models import (Author, Book, BookMonthlyRating, Leaderboard,
+    LeaderboardEntry, Review, UserAuthorReviewCount, UserReviewStats)
+from bookstore.pagination import keyset_paginate, keyset_iterator
+from bookstore.views import (BookReviewListView, UserReviewListView,
+    BookListView, ReviewSubjectMixin)
 from django.core.exceptions import ValidationError
-from django.core.urlresolvers import reverse, NoReverseMatch
+from django.core.urlresolvers import reverse, resolve, NoReverseMatch
+
+@contextmanager
+def empty_replica(*tables):
+    """give the 'replica' database the tables, without any of their rows: a
+    replica lagging behind the primary"""
+    replica = db.connections['replica']
+    for table in tables:
+        sql, = connection.cursor().execute("SELECT sql FROM sqlite_master "
+            "WHERE name = %s", [table]).fetchone()
+        replica.cursor().execute(sql)
+    try:
+        yield
+    finally:
+        for table in tables:
+            replica.cursor().execute('DROP TABLE %s' % table)
+
+
+class BookstoreTestCase(TestCase):
+    """TestCase that starts every test with an empty page cache, since the
+    cache outlives the rolled back test database"""
+
+    def _pre_setup(self):
+        super(BookstoreTestCase, self)._pre_setup()
+        get_bookstore_cache().clear()
+        cache.clear()
+
+
+class CountingBackend(ModelBackend):
+    """ModelBackend counting the passwords it checks"""
+    calls = 0
+
+    def authenticate(self, username=None, password=None):
+        CountingBackend.calls += 1
+        return super(CountingBackend, self).authenticate(username, password)
+
 
 class BookstoreModelsTest(TestCase):
     """Test suite for Bookstore models"""
@@ -155,7 +230,7 @@ class BookstoreModelsTest(TestCase):
         self.assertRaises(ValidationError, r2.full_clean)
 
 
-class BookstoreViewsTest(TestCase):
+class BookstoreViewsTest(BookstoreTestCase):
     """Test suite for Bookstore views"""
 
     def setUp(self):
@@ -254,6 +329,48 @@ class BookstoreViewsTest(TestCase):
         self.assertEqual(response.context['queried_user'].username, 'user')
         self.assertEqual(response.context['queried_user'].pk, 1)
 
+    @override_settings(AUTHENTICATION_BACKENDS=(
+        'bookstore.tests.CountingBackend',))
+    def testLogin(self):
+        """Test whether logging in checks the password once, with either
+        session engine"""
+        self.user.set_password('password')
+        self.user.save()
+        for engine in ('cached_db', 'signed_cookies'):
+            with self.settings(SESSION_ENGINE='django.contrib.sessions.'
+                    'backends.' + engine):
+                self.client.logout()
+                CountingBackend.calls = 0
+                response = self.client.post(reverse('bookstore:login'),
+                    {'username': 'user', 'password': 'password'})
+                self.assertRedirects(response,
+                    reverse('bookstore:login_success'))
+                self.assertEqual(CountingBackend.calls, 1)
+                #the session holds the login
+                response = self.client.get(reverse('bookstore:index'))
+                self.assertEqual(response.context['user'].pk, self.user.pk)
+
+        response = self.client.post(reverse('bookstore:login'),
+            {'username': 'user', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors)
+
+    def testReviewStats(self):
+        """Test the review count and average rating of the review lists"""
+        self.review.save()
+        Review.objects.create(user=self.user, book=self.book,
+            timestamp=timezone.now(), review_message='', rating=2)
+
+        response = self.client.get(reverse('bookstore:book_review_list',
+            kwargs={'book_id': self.book.pk}))
+        self.assertEqual(response.context['review_count'], 2)
+        self.assertEqual(response.context['average_rating'], 3.5)
+
+        response = self.client.get(reverse('bookstore:user_review_list',
+            kwargs={'user_id': self.user.pk}))
+        self.assertEqual(response.context['review_count'], 2)
+        self.assertEqual(response.context['average_rating'], 3.5)
+
     def testBookList(self):
         """Test book list view"""
         #make sure the context has a list of books, in alphabetical order
@@ -267,3 +384,1841 @@ class BookstoreViewsTest(TestCase):
             'The Sun Also Rises')
 
 
+
+
+    def testSubjectHooks(self):
+        """Test the review subject is looked up from the class attributes,
+        which a view must set"""
+        view = ReviewSubjectMixin()
+        view.kwargs = {'pk': self.book.pk}
+        self.assertRaises(ImproperlyConfigured, lambda: view.subject)
+        self.assertRaises(ImproperlyConfigured, view.get_subject_filter,
+            self.book)
+        view.subject_model = Book
+        view.subject_field = 'book'
+        self.assertEqual(view.subject, self.book)
+        self.assertEqual(view.get_subject_filter(self.book),
+            {'book': self.book})
+
+class BookstoreQueryCountTest(BookstoreTestCase):
+    """Test suite bounding the number of queries each view issues"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user', password='password')
+        self.author = Author.objects.create(first_name='Ernest',
+            last_name='Hemingway')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=self.author, publication_year=1929)
+
+    def countQueries(self, url):
+        """GET the url and return the number of queries it issued"""
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        request_started.disconnect(reset_queries)
+        starting_queries = len(connection.queries)
+        try:
+            response = self.client.get(url)
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+            request_started.connect(reset_queries)
+        self.assertEqual(response.status_code, 200)
+        return len(connection.queries) - starting_queries
+
+    def assertQueriesBounded(self, url, grow, max_queries,
+            sizes=(1, 10, 50)):
+        """call grow(size) to enlarge the fixture before each GET of the url,
+        and assert the view never issues more than max_queries queries"""
+        for size in sizes:
+            grow(size)
+            count = self.countQueries(url)
+            self.assertTrue(count <= max_queries,
+                '%s issued %d queries with %d rows, expected at most %d' % (
+                    url, count, size, max_queries))
+
+    def growReviews(self, size):
+        """make sure the book has size reviews, each by a different user"""
+        for i in range(Review.objects.count(), size):
+            user = User.objects.create(username='reader%d' % i)
+            book = Book.objects.create(title='Book %d' % i,
+                author=Author.objects.create(first_name='A', last_name=str(i)))
+            Review.objects.create(user=user, book=self.book,
+                timestamp=timezone.now(), review_message='', rating=4)
+            Review.objects.create(user=self.user, book=book,
+                timestamp=timezone.now(), review_message='', rating=3)
+
+    def testBookReviewListQueries(self):
+        """Test whether the book review list query count is bounded"""
+        url = reverse('bookstore:book_review_list',
+            kwargs={'book_id': self.book.pk})
+        #the book, a page of reviews, the "readers also liked" books and the
+        #monthly rating rollups
+        self.assertQueriesBounded(url, self.growReviews, 4)
+
+    def testUserReviewListQueries(self):
+        """Test whether the user review list query count is bounded"""
+        url = reverse('bookstore:user_review_list',
+            kwargs={'user_id': self.user.pk})
+        self.assertQueriesBounded(url, self.growReviews, 3)
+
+    def testBookListQueries(self):
+        """Test whether the book list query count is bounded"""
+        url = reverse('bookstore:book_list')
+        self.assertQueriesBounded(url, self.growReviews, 2)
+
+
+class BookstorePaginationTest(BookstoreTestCase):
+    """Test suite for keyset pagination"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user', password='password')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=Author.objects.create(first_name='Ernest',
+                last_name='Hemingway'))
+        #reviews 0 and 1 share a timestamp, so the pk has to break the tie
+        now = timezone.now()
+        self.reviews = []
+        for i in range(5):
+            self.reviews.append(Review.objects.create(user=self.user,
+                book=self.book, review_message=str(i), rating=3,
+                timestamp=now + datetime.timedelta(minutes=max(i, 1))))
+
+    def testWalkPages(self):
+        """Test whether next and previous cursors walk every review once"""
+        queryset = Review.objects.filter(book=self.book)
+        ordering = ('-timestamp', '-pk')
+        newest_first = list(reversed(self.reviews))
+
+        page = keyset_paginate(queryset, ordering, 2)
+        self.assertEqual(list(page), newest_first[0:2])
+        self.assertFalse(page.has_previous())
+
+        page = keyset_paginate(queryset, ordering, 2, page.next_cursor)
+        self.assertEqual(list(page), newest_first[2:4])
+
+        page = keyset_paginate(queryset, ordering, 2, page.next_cursor)
+        self.assertEqual(list(page), newest_first[4:5])
+        self.assertFalse(page.has_next())
+
+        page = keyset_paginate(queryset, ordering, 2, page.previous_cursor)
+        self.assertEqual(list(page), newest_first[2:4])
+        page = keyset_paginate(queryset, ordering, 2, page.previous_cursor)
+        self.assertEqual(list(page), newest_first[0:2])
+        self.assertFalse(page.has_previous())
+
+    def testStreamReviews(self):
+        """Test whether the streamed user review list has every review, after
+        the header"""
+        url = reverse('bookstore:user_review_list',
+            kwargs={'user_id': self.user.pk})
+        response = self.client.get(url, {'stream': 1})
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(content.index('5 reviews') < content.index('review-1'))
+        self.assertTrue('id="review-5"' in content)
+        self.assertFalse('pagination' in content)
+
+    def testStreamChunks(self):
+        """Test whether keyset_iterator visits every row across chunks"""
+        reviews = keyset_iterator(Review.objects.all(), ('-timestamp', '-pk'),
+            chunk_size=2)
+        self.assertEqual(list(reviews), list(reversed(self.reviews)))
+
+    def testViewCursor(self):
+        """Test whether the review list view pages with a cursor"""
+        url = reverse('bookstore:book_review_list',
+            kwargs={'book_id': self.book.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.context['review_count'], 5)
+        self.assertFalse(response.context['is_paginated'])
+
+        #a cursor that can't be decoded is a missing page
+        response = self.client.get(url, {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES={
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'bookstore_tests'),
+    }
+})
+class BookstoreCacheTest(BookstoreTestCase):
+    """Test suite for the page cache and its invalidation"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.user.set_password('password')
+        self.user.save()
+        self.author = Author.objects.create(first_name='Ernest',
+            last_name='Hemingway')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=self.author)
+        self.book_url = reverse('bookstore:book_review_list',
+            kwargs={'book_id': self.book.pk})
+        self.user_url = reverse('bookstore:user_review_list',
+            kwargs={'user_id': self.user.pk})
+
+    def addReview(self, rating):
+        return Review.objects.create(user=self.user, book=self.book,
+            timestamp=timezone.now(), review_message='', rating=rating)
+
+    def testCacheHit(self):
+        """Test whether a cached page is served without any queries"""
+        response = self.client.get(self.book_url)
+        with self.assertNumQueries(0):
+            cached = self.client.get(self.book_url)
+        self.assertEqual(cached.content, response.content)
+
+    def testCacheScopes(self):
+        """Test a cached view must name the scopes its page shows"""
+        class ScopedView(CachedResponseMixin, TemplateView):
+            template_name = 'bookstore/index.html'
+        self.assertRaises(ImproperlyConfigured,
+            ScopedView().get_cache_scopes)
+        ScopedView.cache_scopes = ('books',)
+        self.assertEqual(ScopedView().get_cache_scopes(), ['books'])
+
+    def testReviewInvalidates(self):
+        """Test whether a new review refreshes the pages that show it"""
+        for url in (self.book_url, self.user_url,
+                reverse('bookstore:book_list')):
+            self.client.get(url)
+        self.addReview(4)
+
+        self.assertContains(self.client.get(self.book_url), '4 out of 5')
+        self.assertContains(self.client.get(self.user_url), '4 out of 5')
+        self.assertContains(self.client.get(reverse('bookstore:book_list')),
+            'Average rating: 4.0')
+
+    def testAuthorInvalidates(self):
+        """Test whether renaming an author refreshes the book pages"""
+        self.client.get(self.book_url)
+        self.author.first_name = 'E.'
+        self.author.save()
+        self.assertContains(self.client.get(self.book_url), 'E. Hemingway')
+
+    def testReviewFragmentFollowsRename(self):
+        """Test whether the cached review rows show a renamed reviewer's new
+        username"""
+        review = self.addReview(4)
+        template = get_template('bookstore/book_review_list.html')
+
+        def render():
+            return template.render(Context({'book': self.book,
+                'review_list': [Review.objects.select_related('user')
+                    .get(pk=review.pk)]}))
+
+        self.assertIn('user (', render())
+        self.user.username = 'reader'
+        self.user.save()
+        self.assertIn('reader (', render())
+
+    def testFragmentInvalidates(self):
+        """Test whether the cached rows of the book list follow author and
+        rating changes"""
+        url = reverse('bookstore:book_list')
+        self.client.get(url)
+        self.author.last_name = 'Hemingway Jr.'
+        self.author.save()
+        self.assertContains(self.client.get(url), 'Hemingway Jr.')
+        self.addReview(2)
+        self.assertContains(self.client.get(url), 'Average rating: 2.0')
+
+    def testOtherBookUntouched(self):
+        """Test whether a review leaves other books' pages cached"""
+        other = Book.objects.create(title='The Sun Also Rises',
+            author=self.author)
+        other_url = reverse('bookstore:book_review_list',
+            kwargs={'book_id': other.pk})
+        self.client.get(other_url)
+        self.addReview(4)
+        with self.assertNumQueries(0):
+            self.client.get(other_url)
+
+    def testVisitorKey(self):
+        """Test whether logged in visitors don't get the anonymous page"""
+        self.client.get(self.book_url)
+        self.client.login(username='user', password='password')
+        self.assertContains(self.client.get(self.book_url), 'Logout')
+
+    def testBookBundle(self):
+        """Test whether a book's bundle is served from the cache until the
+        book or its reviews change"""
+        self.addReview(4)
+        self.assertEqual(bundles.get_book_bundle(0, 50), None)
+        bundle = bundles.get_book_bundle(self.book.pk, 50)
+        with self.assertNumQueries(0):
+            cached = bundles.get_book_bundle(self.book.pk, 50)
+        self.assertEqual(cached.book.title, 'A Farewell to Arms')
+        self.assertEqual(unicode(cached.book.author), 'Ernest Hemingway')
+        self.assertEqual(cached.book.average_rating, 4.0)
+        self.assertEqual([(review.pk, review.user.username, review.rating)
+            for review in cached.reviews], [(review.pk, 'user', 4)
+            for review in bundle.reviews])
+        self.assertEqual(cached.monthly_ratings, bundle.monthly_ratings)
+
+        self.addReview(2)
+        bundle = bundles.get_book_bundle(self.book.pk, 50)
+        self.assertEqual([review.rating for review in bundle.reviews], [2, 4])
+        self.assertEqual(bundle.book.review_count, 2)
+        #a bundle of another page size is rebuilt
+        bundle = bundles.get_book_bundle(self.book.pk, 1)
+        self.assertEqual([review.rating for review in bundle.reviews], [2])
+        self.assertEqual(bundle.next_cursor, keyset_paginate(
+            Review.objects.filter(book=self.book), ('-timestamp', '-pk'),
+            1).next_cursor)
+
+    def testReplicaBundleNotCached(self):
+        """Test a bundle built from a replica isn't stored for the clients
+        reading from the primary"""
+        self.addReview(4)
+        with empty_replica('auth_user', 'bookstore_author', 'bookstore_book',
+                'bookstore_review', 'bookstore_bookmonthlyrating',
+                'bookstore_bookneighbor'):
+            with routers.use_replica('replica'):
+                self.assertEqual(bundles.get_book_bundle(self.book.pk, 50),
+                    None)
+            #the book exists on the replica, without its review
+            replica = db.connections['replica'].cursor()
+            for table in ('bookstore_author', 'bookstore_book'):
+                for row in connection.cursor().execute('SELECT * FROM %s' %
+                        table).fetchall():
+                    replica.execute('INSERT INTO %s VALUES (%s)' % (table,
+                        ', '.join(['%s'] * len(row))), row)
+            with routers.use_replica('replica'):
+                bundle = bundles.get_book_bundle(self.book.pk, 50)
+            self.assertEqual(bundle.reviews, [])
+        bundle = bundles.get_book_bundle(self.book.pk, 50)
+        self.assertEqual([review.rating for review in bundle.reviews], [4])
+
+    def testBookPageFromBundle(self):
+        """Test whether the first page of a book's reviews is rendered from
+        its bundle without queries"""
+        self.addReview(4)
+        self.client.get(self.book_url)
+        #another URL of the first page misses the page cache
+        with self.assertNumQueries(0):
+            response = self.client.get(self.book_url, {'from': 'bundle'})
+        self.assertContains(response, 'Ernest Hemingway')
+        self.assertContains(response, '4 out of 5')
+        self.assertContains(response, 'Average rating: 4.0')
+
+
+class BookstoreAPITest(BookstoreTestCase):
+    """Test suite for the JSON API"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=Author.objects.create(first_name='Ernest',
+                last_name='Hemingway'), publication_year=1929)
+        self.review = Review.objects.create(user=self.user, book=self.book,
+            timestamp=timezone.now(), review_message='Good Book', rating=5)
+        self.url = reverse('bookstore:api_book_review_list',
+            kwargs={'book_id': self.book.pk})
+
+    def getJSON(self, url, data=None):
+        response = self.client.get(url, data or {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content.decode('utf-8'))
+
+    def testLists(self):
+        """Test whether the endpoints list books and reviews"""
+        data = self.getJSON(reverse('bookstore:api_book_list'))
+        self.assertEqual(data['results'][0]['author'], 'Ernest Hemingway')
+        self.assertEqual(data['results'][0]['average_rating'], 5.0)
+
+        data = self.getJSON(self.url)
+        self.assertEqual(data['review_count'], 1)
+        self.assertEqual(data['results'][0]['username'], 'user')
+
+        data = self.getJSON(reverse('bookstore:api_user_review_list',
+            kwargs={'user_id': self.user.pk}))
+        self.assertEqual(data['results'][0]['book_title'],
+            'A Farewell to Arms')
+
+    def testFields(self):
+        """Test whether ?fields selects the fields of each result"""
+        data = self.getJSON(self.url, {'fields': 'id,rating'})
+        self.assertEqual(data['results'],
+            [{'id': self.review.pk, 'rating': 5}])
+
+        response = self.client.get(self.url, {'fields': 'id,password'})
+        self.assertEqual(response.status_code, 400)
+
+    def testConditionalGet(self):
+        """Test whether an unchanged list answers 304 until a review changes"""
+        response = self.client.get(self.url)
+        #the newest timestamps don't move on deletes, so they aren't sent
+        self.assertFalse(response.has_header('Last-Modified'))
+        etag = response['ETag']
+
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.review.review_message = 'Great Book'
+        self.review.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        #a delete changes the tag too, and If-Modified-Since is ignored
+        etag = response['ETag']
+        self.review.delete()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag,
+            HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['results'], [])
+
+    def testValidatorHooks(self):
+        """Test a conditional view must name the rows its response reads"""
+        class ValidatedView(ConditionalResponseMixin, View):
+            pass
+        view = ValidatedView()
+        self.assertRaises(ImproperlyConfigured, view.get_validator_values)
+        ValidatedView.validator_aggregates = {'count': Count('pk')}
+        self.assertRaises(ImproperlyConfigured, view.get_validator_values)
+        ValidatedView.validator_queryset = Book.objects.all()
+        self.assertEqual(view.get_validator_values(),
+            [('count', Book.objects.count())])
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN output is SQLite\'s')
+class BookstoreIndexTest(TransactionTestCase):
+    """Test suite checking the view queries are answered from indexes"""
+    #the sqlite3 module commits before running EXPLAIN, so these tests
+    #can't run inside TestCase's transaction
+
+    def setUp(self):
+        self.user = User.objects.create(username='user', password='password')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=Author.objects.create(first_name='Ernest',
+                last_name='Hemingway'))
+
+    def explain(self, queryset):
+        """SQLite's query plan for the queryset, as one string"""
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return ' '.join(str(row[-1]) for row in cursor.fetchall())
+
+    def assertIndexed(self, view, table, lookup=''):
+        """assert the first page of the view is read from an index of the
+        table (searched with the given lookup), without sorting"""
+        queryset = (view.get_queryset().order_by(*view.keyset_ordering)
+            [:view.paginate_by + 1])
+        plan = self.explain(queryset)
+        self.assertTrue('%s USING INDEX' % table in plan, plan)
+        self.assertTrue(lookup in plan, plan)
+        self.assertFalse('TEMP B-TREE' in plan, plan)
+
+    def testBookReviewListIndex(self):
+        """Test whether the book review list seeks (book, timestamp)"""
+        view = BookReviewListView(kwargs={'book_id': self.book.pk})
+        self.assertIndexed(view, 'bookstore_review', '(book_id=?)')
+
+    def testUserReviewListIndex(self):
+        """Test whether the user review list seeks (user, timestamp)"""
+        view = UserReviewListView(kwargs={'user_id': self.user.pk})
+        self.assertIndexed(view, 'bookstore_review', '(user_id=?)')
+
+    def testBookListIndex(self):
+        """Test whether the book list walks the title index"""
+        self.assertIndexed(BookListView(), 'bookstore_book')
+
+    def testRatingAggregateIndex(self):
+        """Test whether the rating aggregate rebuild reads (book, rating)"""
+        queryset = (Review.objects.filter(book=self.book).order_by()
+            .values_list('book', 'rating').annotate(Count('pk')))
+        self.assertTrue('COVERING INDEX' in self.explain(queryset))
+
+
+class BookstoreImportTest(TestCase):
+    """Test suite for the bulk import command"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def importFile(self, kind, name, content, *args):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        rejects = os.path.join(self.directory, 'rejects.jsonl')
+        call_command('import_catalogue', kind, path, rejects=rejects,
+            batch_size=2, stdout=StringIO(), *args)
+        with open(rejects) as f:
+            return [json.loads(line) for line in f]
+
+    def testImport(self):
+        """Test importing books and reviews, with invalid rows rejected"""
+        rejects = self.importFile('books', 'books.csv',
+            b'title,author_first_name,author_last_name,publication_year\n'
+            b'A Farewell to Arms,Ernest,Hemingway,1929\n'
+            b'The Sun Also Rises,Ernest,Hemingway,\n'
+            b'Negative,Ernest,Hemingway,-10\n'
+            b'A Farewell to Arms,Ernest,Hemingway,1929\n')
+        self.assertEqual([reject['line'] for reject in rejects], [3])
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(Book.objects.count(), 2)
+        self.assertEqual(Book.objects.get(title='The Sun Also Rises')
+            .publication_year, None)
+
+        row = {'username': 'user', 'book_title': 'A Farewell to Arms',
+            'author_first_name': 'Ernest', 'author_last_name': 'Hemingway',
+            'timestamp': '2013-03-16 22:20:00', 'review_message': 'Good'}
+        lines = []
+        for rating, username in ((5, 'user'), (3, 'user'), (7, 'user'),
+                (4, 'nobody')):
+            lines.append(json.dumps(dict(row, rating=rating,
+                username=username)))
+        rejects = self.importFile('reviews', 'reviews.jsonl',
+            '\n'.join(lines).encode('utf-8'))
+        self.assertEqual([reject['line'] for reject in rejects], [3, 4])
+
+        #the aggregates were maintained batch by batch
+        book = Book.objects.get(title='A Farewell to Arms')
+        self.assertEqual(book.review_count, 2)
+        self.assertEqual(book.rating_sum, 8)
+        self.assertEqual(book.rating_3_count, 1)
+
+    def testImportedCount(self):
+        """Test only the rows actually inserted are counted"""
+        Author.objects.create(first_name='Ernest', last_name='Hemingway')
+        rows = [{'first_name': 'Ernest', 'last_name': 'Hemingway'},
+            {'first_name': 'Martha', 'last_name': 'Gellhorn'},
+            {'first_name': 'Martha', 'last_name': 'Gellhorn'}]
+        self.assertEqual(importer.CatalogueImporter('authors',
+            batch_size=2).run(rows), 1)
+        rows = [{'title': 'Liana', 'author_first_name': 'Martha',
+                'author_last_name': 'Gellhorn', 'publication_year': ''}] * 3
+        self.assertEqual(importer.CatalogueImporter('books',
+            batch_size=2).run(rows), 1)
+        self.assertEqual(Book.objects.count(), 1)
+
+
+class BookstoreExportTest(TestCase):
+    """Test suite for the bulk export"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.other = User.objects.create(username='other')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=Author.objects.create(first_name='Ernest',
+                last_name='Hemingway'), publication_year=1929)
+        for day in range(1, 6):
+            Review.objects.create(user=self.user if day % 2 else self.other,
+                book=self.book, rating=day, review_message='Review %d' % day,
+                timestamp=timezone.make_aware(datetime.datetime(2013, 3, day),
+                    timezone.get_default_timezone()))
+        self.ids = list(Review.objects.order_by('pk')
+            .values_list('pk', flat=True))
+
+    def export(self, *args, **options):
+        out = StringIO()
+        call_command('export_reviews', stdout=out, chunk_size=2, *args,
+            **options)
+        return out.getvalue()
+
+    def exportIds(self, **options):
+        lines = self.export(format='jsonl', **options).splitlines()
+        return [json.loads(line)['id'] for line in lines]
+
+    def testCSV(self):
+        """Test the CSV export joins the book, author and user"""
+        rows = list(csv.reader(StringIO(self.export())))
+        self.assertEqual(rows[0][:4], ['id', 'timestamp', 'rating',
+            'review_message'])
+        self.assertEqual([int(row[0]) for row in rows[1:]], self.ids)
+        row = dict(zip(rows[0], rows[1]))
+        self.assertEqual(row['book_title'], 'A Farewell to Arms')
+        self.assertEqual(row['author_last_name'], 'Hemingway')
+        self.assertEqual(row['username'], 'user')
+
+    def testFilters(self):
+        """Test the date range, book, user and resume filters"""
+        self.assertEqual(self.exportIds(since='2013-03-02',
+            until='2013-03-04'), self.ids[1:4])
+        self.assertEqual(self.exportIds(user=self.other.pk),
+            [self.ids[1], self.ids[3]])
+        self.assertEqual(self.exportIds(book=self.book.pk + 1), [])
+        self.assertEqual(self.exportIds(after=self.ids[2]), self.ids[3:])
+
+    def testChunkQueries(self):
+        """Test the rows are fetched a chunk per query"""
+        #5 rows in chunks of 2
+        with self.assertNumQueries(3):
+            self.export()
+
+    def testBooks(self):
+        """Test the book export"""
+        lines = self.export('books', format='jsonl').splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['review_count'], 5)
+
+    def testView(self):
+        """Test the export endpoint is streamed to staff only"""
+        url = reverse('bookstore:export', kwargs={'kind': 'reviews',
+            'format': 'csv'})
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        User.objects.create_user('staff', password='password')
+        User.objects.filter(username='staff').update(is_staff=True)
+        self.client.login(username='staff', password='password')
+        response = self.client.get(url, {'user': self.user.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        self.assertEqual(len(content.splitlines()), 4)
+        self.assertEqual(self.client.get(url, {'since': 'march'}).status_code,
+            400)
+
+
+class BookstoreSearchTest(BookstoreTestCase):
+    """Test suite for the search index, with the FTS5 backend"""
+    backend_class = search.FTS5SearchBackend
+
+    def setUp(self):
+        if not getattr(self.backend_class, 'available', lambda: True)():
+            self.skipTest('SQLite was built without FTS5')
+        self.saved_backend = search._backend
+        search._backend = self.backend_class()
+
+        self.user = User.objects.create(username='user')
+        self.hemingway = Author.objects.create(first_name='Ernest',
+            last_name='Hemingway')
+        self.farewell = Book.objects.create(title='A Farewell to Arms',
+            author=self.hemingway, publication_year=1929)
+        self.sun = Book.objects.create(title='The Sun Also Rises',
+            author=self.hemingway, publication_year=1926)
+        self.review = Review.objects.create(user=self.user, book=self.sun,
+            timestamp=timezone.now(), rating=4,
+            review_message='Bulls, <b>fiestas</b> and a farewell to Paris')
+
+    def tearDown(self):
+        search._backend = self.saved_backend
+
+    def searchTitles(self, query):
+        return [result.book.title for result in search.search(query)]
+
+    def testRanking(self):
+        """Test a title match outranks a review match"""
+        self.assertEqual(self.searchTitles('farewell'), ['A Farewell to Arms',
+            'The Sun Also Rises'])
+        self.assertEqual(self.searchTitles('hemingway sun'),
+            ['The Sun Also Rises'])
+        self.assertEqual(self.searchTitles('nothing'), [])
+        self.assertEqual(self.searchTitles('  '), [])
+
+    def testSnippet(self):
+        """Test the review snippet highlights the match and escapes the text"""
+        result = search.search('fiestas')[0]
+        self.assertEqual(result.book, self.sun)
+        self.assertIn('<mark>fiestas</mark>', result.snippet)
+        self.assertIn('&lt;b&gt;', result.snippet)
+        self.assertEqual(search.search('arms')[0].snippet, None)
+
+    def testSignals(self):
+        """Test the index follows edits and deletes"""
+        self.review.review_message = 'Lost generation'
+        self.review.save()
+        self.assertEqual(self.searchTitles('fiestas'), [])
+        self.assertEqual(self.searchTitles('generation'),
+            ['The Sun Also Rises'])
+        self.review.delete()
+        self.assertEqual(self.searchTitles('generation'), [])
+
+        self.hemingway.last_name = 'Hadley'
+        self.hemingway.save()
+        self.assertEqual(len(self.searchTitles('hadley')), 2)
+        self.assertEqual(self.searchTitles('hemingway'), [])
+
+    def testBulkChanges(self):
+        """Test bulk inserted reviews are indexed from the bulk signal"""
+        Review.objects.bulk_create([Review(user=self.user, book=self.farewell,
+            timestamp=timezone.now(), rating=3, review_message='Caporetto')])
+        reviews_bulk_changed.send(sender=Review, book_ids=[self.farewell.pk],
+            user_ids=[self.user.pk], created=[])
+        self.assertEqual(self.searchTitles('caporetto'),
+            ['A Farewell to Arms'])
+
+    def testBulkBooks(self):
+        """Test bulk inserted books are indexed from their own signal, and a
+        review batch only indexes its own books"""
+        self.assertEqual(self.searchTitles('war'), [])
+        Author.objects.bulk_create([Author(first_name='Martha',
+            last_name='Gellhorn')])
+        gellhorn = Author.objects.get(last_name='Gellhorn')
+        Book.objects.bulk_create([Book(title='The Face of War',
+                author=gellhorn), Book(title='Liana', author=self.hemingway)])
+        face = Book.objects.get(title='The Face of War')
+        reviews_bulk_changed.send(sender=Review, book_ids=[self.sun.pk],
+            user_ids=[], created=[])
+        self.assertEqual(self.searchTitles('war'), [])
+        books_bulk_created.send(sender=Book, book_ids=[face.pk],
+            author_ids=[])
+        self.assertEqual(self.searchTitles('gellhorn'), ['The Face of War'])
+        self.assertEqual(list(search.get_search_backend().filter_queryset(
+            Author.objects.all(), 'gell')), [gellhorn])
+        self.assertEqual(self.searchTitles('liana'), [])
+
+    @override_settings(BOOKSTORE_SEARCH_MAX_REVIEW_MATCHES=1)
+    def testReviewMatchBound(self):
+        """Test only the best review matches are ranked"""
+        Review.objects.create(user=self.user, book=self.farewell,
+            timestamp=timezone.now(), rating=3, review_message='Paris')
+        self.assertEqual(len(self.searchTitles('paris')), 1)
+
+    def testAdminSearch(self):
+        """Test the admin's search matches word prefixes through the index"""
+        backend = search.get_search_backend()
+        self.assertEqual(set(backend.filter_queryset(Book.objects.all(),
+            'hem far')), set([self.farewell]))
+        self.assertEqual(list(backend.filter_queryset(Author.objects.all(),
+            'ern')), [self.hemingway])
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get('/admin/bookstore/book/', {'q': 'rises'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.sun])
+
+        #an author's id is looked up as is
+        response = self.client.get('/admin/bookstore/author/',
+            {'q': str(self.hemingway.pk)})
+        self.assertEqual(list(response.context['cl'].result_list),
+            [self.hemingway])
+        response = self.client.get('/admin/bookstore/author/',
+            {'q': str(self.hemingway.pk + 1)})
+        self.assertEqual(list(response.context['cl'].result_list), [])
+
+    def testView(self):
+        """Test the search page"""
+        response = self.client.get(reverse('bookstore:search'),
+            {'q': 'fiestas'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'The Sun Also Rises')
+        self.assertContains(response, '<mark>fiestas</mark>')
+
+
+class BookstorePythonSearchTest(BookstoreSearchTest):
+    """Test suite for the search index, with the in-memory backend"""
+    backend_class = search.PythonSearchBackend
+
+
+@override_settings(BOOKSTORE_LEADERBOARD_SIZE=2)
+class BookstoreLeaderboardTest(BookstoreTestCase):
+    """Test suite for the leaderboards"""
+
+    def setUp(self):
+        self.users = [User.objects.create(username='user%d' % i)
+            for i in range(6)]
+        self.authors = [Author.objects.create(first_name='Author',
+            last_name=str(i)) for i in range(2)]
+        self.books = [Book.objects.create(title='Book %d' % i,
+                author=self.authors[i % 2], publication_year=1920 + i * 3)
+            for i in range(8)]
+
+    def addReview(self, book, rating, user=0):
+        return Review.objects.create(user=self.users[user], book=book,
+            timestamp=timezone.now(), rating=rating, review_message='Review')
+
+    def assertBoardsCorrect(self):
+        """every board holds the best scores of its scope under its prior"""
+        for leaderboard in Leaderboard.objects.all():
+            books = Book.objects.filter(review_count__gt=0,
+                **leaderboards.scope_filter(leaderboard.scope))
+            expected = sorted((leaderboards.book_score(leaderboard.board,
+                book.review_count, book.rating_sum, leaderboard.prior_mean)
+                for book in books), reverse=True)[:2]
+            scores = [entry.score for entry in leaderboards.get_leaderboard(
+                leaderboard.board, leaderboard.scope)]
+            self.assertEqual(scores, expected, leaderboard)
+
+    def testBayesianRating(self):
+        """Test a single 5 star review doesn't beat many good ones"""
+        self.addReview(self.books[0], 5)
+        for user in range(6):
+            self.addReview(self.books[1], 5, user)
+            self.addReview(self.books[2], 2, user)
+        leaderboards.rebuild_leaderboards()
+        self.assertEqual([entry.book for entry in
+            leaderboards.get_leaderboard('top_rated')], [self.books[1],
+                self.books[0]])
+        self.assertEqual([entry.book for entry in
+            leaderboards.get_leaderboard('most_reviewed')], [self.books[1],
+                self.books[2]])
+
+    def testIncrementalUpdates(self):
+        """Test the boards stay correct through review writes"""
+        generator = random.Random(0)
+        reviews = []
+        for step in range(60):
+            action = generator.random()
+            if action < 0.6 or not reviews:
+                reviews.append(self.addReview(generator.choice(self.books),
+                    generator.randint(1, 5), generator.randint(0, 5)))
+            elif action < 0.8:
+                review = generator.choice(reviews)
+                review.rating = generator.randint(1, 5)
+                review.book = generator.choice(self.books)
+                review.save()
+            else:
+                reviews.pop(generator.randrange(len(reviews))).delete()
+            self.assertBoardsCorrect()
+
+        #a book changing decade leaves its old scope
+        book = self.books[0]
+        book.publication_year = 1990
+        book.save()
+        self.assertBoardsCorrect()
+        self.assertFalse(LeaderboardEntry.objects.filter(book=book,
+            leaderboard__scope='decade:1920').exists())
+
+    def testRebuildCommand(self):
+        """Test the rebuild command and that a board is read in one query"""
+        for i, book in enumerate(self.books):
+            self.addReview(book, i % 5 + 1)
+        call_command('rebuild_leaderboards', stdout=StringIO())
+        self.assertBoardsCorrect()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(leaderboards.get_leaderboard('top_rated',
+                'author:%d' % self.authors[0].pk)), 2)
+
+    def testView(self):
+        """Test the leaderboard pages"""
+        self.addReview(self.books[3], 5)
+        for kwargs in ({}, {'author_id': self.authors[1].pk},
+                {'decade': 1929}):
+            kwargs['board'] = 'top_rated'
+            response = self.client.get(reverse('bookstore:leaderboard',
+                kwargs=kwargs))
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'Book 3')
+        response = self.client.get(reverse('bookstore:leaderboard',
+            kwargs={'board': 'most_reviewed', 'decade': 1930}))
+        self.assertNotContains(response, 'Book 3')
+
+    def testReadsNeverBuild(self):
+        """Test reading a leaderboard never writes one, and unknown scopes
+        are 404s"""
+        self.addReview(self.books[0], 5)
+        Leaderboard.objects.all().delete()
+        self.assertEqual(leaderboards.get_leaderboard('top_rated'), [])
+        response = self.client.get(reverse('bookstore:leaderboard',
+            kwargs={'board': 'top_rated', 'author_id': self.authors[0].pk}))
+        self.assertEqual(response.status_code, 200)
+        for kwargs in ({'author_id': 999}, {'decade': 1800}):
+            kwargs['board'] = 'top_rated'
+            response = self.client.get(reverse('bookstore:leaderboard',
+                kwargs=kwargs))
+            self.assertEqual(response.status_code, 404)
+        self.assertFalse(Leaderboard.objects.exists())
+
+
+class BookstoreRecommendationTest(BookstoreTestCase):
+    """Test suite for the book recommendations"""
+
+    def setUp(self):
+        self.users = [User.objects.create_user('user%d' % i,
+            password='password') for i in range(5)]
+        author = Author.objects.create(first_name='Ernest',
+            last_name='Hemingway')
+        self.books = [Book.objects.create(title='Book %d' % i, author=author)
+            for i in range(4)]
+        #the first three users like books 0 and 1, the last two dislike book
+        #1 and like books 2 and 3
+        for user in self.users[:3]:
+            self.addReview(user, 0, 5)
+            self.addReview(user, 1, 4)
+        for user in self.users[3:]:
+            self.addReview(user, 1, 1)
+            self.addReview(user, 2, 5)
+            self.addReview(user, 3, 5)
+        self.reader = User.objects.create_user('reader', password='password')
+        self.addReview(self.reader, 0, 5)
+
+    def addReview(self, user, book, rating):
+        Review.objects.create(user=user, book=self.books[book], rating=rating,
+            timestamp=timezone.now(), review_message='Review')
+
+    def testNeighbors(self):
+        """Test the neighbours follow the readers' ratings"""
+        call_command('build_recommendations', pure_python=True,
+            stdout=StringIO())
+        with self.assertNumQueries(1):
+            self.assertEqual(recommendations.readers_also_liked(
+                self.books[0]), [self.books[1]])
+        self.assertEqual(recommendations.readers_also_liked(self.books[2]),
+            [self.books[3]])
+        with self.assertNumQueries(1):
+            self.assertEqual([book['id'] for book in
+                recommendations.recommended_for(self.reader)],
+                [self.books[1].pk])
+
+    def testPythonBlocks(self):
+        """Test the pure Python build scores the books a block at a time, with
+        the same neighbours whatever the block size"""
+        def neighbors(memory_budget):
+            return dict((book, [(round(score, 4), neighbor)
+                    for score, neighbor in best])
+                for book, best in recommendations.python_neighbors(10,
+                    memory_budget))
+        book_ids = [book.pk for book in self.books]
+        #the readers of books 0 to 3 rated 7, 12, 6 and 6 times, and a rating
+        #is taken as 100 bytes
+        self.assertEqual(recommendations._book_blocks(1),
+            [(book_id, book_id) for book_id in book_ids])
+        self.assertEqual(recommendations._book_blocks(1900),
+            [(book_ids[0], book_ids[1]), (book_ids[2], book_ids[3])])
+        self.assertEqual(len(recommendations._book_blocks(2 ** 20)), 1)
+        expected = neighbors(2 ** 20)
+        self.assertEqual(neighbors(1), expected)
+        self.assertEqual(neighbors(1900), expected)
+        self.assertEqual([neighbor for score, neighbor in
+            expected[book_ids[0]]], [book_ids[1]])
+
+    @skipUnless(recommendations.numpy, 'NumPy and SciPy are not installed')
+    def testNumpyNeighbors(self):
+        """Test the NumPy build agrees with the pure Python one"""
+        ratings = recommendations.load_ratings()
+
+        def rounded(neighbors):
+            return dict((book, set((neighbor, round(score, 4))
+                for score, neighbor in best)) for book, best in neighbors)
+        expected = rounded(recommendations.python_neighbors(k=10,
+            memory_budget=2 ** 20))
+        #one book per block, two books per block (4 books, 80 bytes each),
+        #and every book in one block
+        for memory_budget in (1, 160, 2 ** 20):
+            self.assertEqual(rounded(recommendations.numpy_neighbors(*ratings,
+                k=10, memory_budget=memory_budget)), expected)
+        #fewer neighbours than books
+        self.assertEqual(rounded(recommendations.numpy_neighbors(*ratings,
+            k=1, memory_budget=1)), rounded(recommendations.python_neighbors(
+                k=1, memory_budget=2 ** 20)))
+
+        recommendations.build_neighbors(use_numpy=True)
+        self.assertEqual(recommendations.readers_also_liked(self.books[0]),
+            [self.books[1]])
+
+    def testViews(self):
+        """Test the book page and the reader's own page show the books"""
+        recommendations.build_neighbors(use_numpy=False)
+        response = self.client.get(reverse('bookstore:book_review_list',
+            kwargs={'book_id': self.books[0].pk}))
+        self.assertContains(response, 'Readers also liked')
+        self.assertContains(response, 'Book 1')
+
+        url = reverse('bookstore:user_review_list',
+            kwargs={'user_id': self.reader.pk})
+        self.assertNotContains(self.client.get(url), 'Recommended for you')
+        self.client.login(username='reader', password='password')
+        response = self.client.get(url)
+        self.assertContains(response, 'Recommended for you')
+        self.assertContains(response, 'Book 1')
+
+
+@override_settings(BOOKSTORE_INSTRUMENTATION_SAMPLE_RATE=1.0)
+class BookstoreInstrumentationTest(BookstoreTestCase):
+    """Test suite for the request instrumentation"""
+
+    def setUp(self):
+        instrumentation.stats.clear()
+        Book.objects.create(title='A Farewell to Arms',
+            author=Author.objects.create(first_name='Ernest',
+                last_name='Hemingway'))
+
+    def testViewStats(self):
+        """Test a request is recorded under its URL name"""
+        self.client.get(reverse('bookstore:book_list'))
+        summary = instrumentation.stats.summary()['bookstore:book_list']
+        self.assertEqual(summary['requests'], 1)
+        self.assertEqual(summary['queries']['p50'], 2)
+        self.assertTrue(summary['template_ms']['p50'] is not None)
+        self.assertTrue(summary['wall_ms']['p99'] >=
+            summary['db_ms']['p99'])
+        self.assertEqual(summary['duplicates'], [])
+
+    def testPercentile(self):
+        """Test the nearest rank percentiles of known values"""
+        values = range(1, 11)
+        self.assertEqual([instrumentation.percentile(values, percent)
+            for percent in (1, 10, 50, 90, 91, 99, 100)],
+            [1, 1, 5, 9, 10, 10, 10])
+        self.assertEqual(instrumentation.percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(instrumentation.percentile([7], 99), 7)
+        self.assertEqual(instrumentation.percentile([], 50), None)
+
+    @override_settings(BOOKSTORE_INSTRUMENTATION_SAMPLE_RATE=0)
+    def testSampling(self):
+        """Test unsampled requests aren't recorded"""
+        self.client.get(reverse('bookstore:book_list'))
+        self.assertEqual(instrumentation.stats.summary(), {})
+
+    def testDuplicates(self):
+        """Test a query repeated with different values is flagged"""
+        self.assertEqual(instrumentation.query_shape(
+            "SELECT * FROM t WHERE a = 12 AND b = 'x''y' AND c IN (1, 2)"),
+            "SELECT * FROM t WHERE a = ? AND b = ? AND c IN (...)")
+        middleware = instrumentation.InstrumentationMiddleware()
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        for book in Book.objects.all():
+            for i in range(3):
+                list(Review.objects.filter(book=book, rating=i + 1))
+        middleware.process_response(request, HttpResponse())
+        summary = instrumentation.stats.summary()['(unresolved)']
+        self.assertEqual(len(summary['duplicates']), 1)
+        self.assertIn('"bookstore_review"."rating" = ?',
+            summary['duplicates'][0]['query'])
+
+    def testStatsPage(self):
+        """Test the statistics are shown to staff, as HTML and JSON"""
+        url = reverse('bookstore:stats')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        User.objects.create_user('staff', password='password')
+        User.objects.filter(username='staff').update(is_staff=True)
+        self.client.login(username='staff', password='password')
+        self.client.get(reverse('bookstore:book_list'))
+        self.assertContains(self.client.get(url), 'bookstore:book_list')
+        response = self.client.get(reverse('bookstore:stats',
+            kwargs={'format': 'json'}))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('bookstore:book_list', json.loads(response.content))
+
+
+class BookstoreBenchmarkTest(BookstoreTestCase):
+    """Test suite for the benchmark harness"""
+
+    def testGenerateData(self):
+        """Test the synthetic data is reproducible and skewed"""
+        counts = bench.generate_data(reviews=500, seed=1)
+        self.assertEqual(Review.objects.count(), 500)
+        self.assertEqual(Book.objects.count(), counts['books'])
+        ratings = list(Review.objects.order_by('pk').values_list('book',
+            'user', 'rating'))
+        Review.objects.all().delete()
+        bench.generate_data(reviews=500, seed=1)
+        self.assertEqual([rating[2] for rating in Review.objects
+            .order_by('pk').values_list('book', 'user', 'rating')],
+            [rating[2] for rating in ratings])
+        #the aggregates are rebuilt, and the most popular book has many more
+        #reviews than the median one
+        review_counts = sorted(Book.objects.filter(review_count__gt=0)
+            .values_list('review_count', flat=True))
+        self.assertEqual(sum(review_counts), 500)
+        self.assertTrue(review_counts[-1] > 5 * review_counts[
+            len(review_counts) // 2])
+
+    def testBenchmarkViews(self):
+        """Test every URL is benchmarked, and regressions are flagged"""
+        bench.generate_data(reviews=200)
+        results = bench.benchmark_views(repeat=1)
+        labels = set(results)
+        for label in ('bookstore:book_list', 'bookstore:search',
+                'bookstore:book_review_list(book_id)',
+                'bookstore:user_review_list(username)',
+                'bookstore:export(format)(kind)'):
+            self.assertIn(label, labels)
+        for result in results.values():
+            self.assertEqual(result['status'], 200, result['path'])
+            self.assertTrue(result['queries'] > 0)
+
+        old = {'views': results}
+        new = {'views': dict((label, dict(result, p50_ms=result['p50_ms'] * 2
+            + 1)) for label, result in results.items())}
+        new['views']['bookstore:book_list']['queries'] += 1
+        regressions = bench.compare_results(old, new)
+        self.assertEqual(len(regressions), len(results) + 1)
+        self.assertEqual(bench.compare_results(old, old), [])
+
+    @override_settings(PASSWORD_HASHERS=(
+        'django.contrib.auth.hashers.MD5PasswordHasher',))
+    def testBenchmarkLogins(self):
+        """Test every session engine is benchmarked"""
+        results = bench.benchmark_logins(logins=2)
+        self.assertEqual(set(results), set(bench.SESSION_ENGINES) |
+            set(['db, authenticated twice']))
+        for rate in results.values():
+            self.assertTrue(rate > 0)
+
+
+class BookstoreAggregatesTest(TestCase):
+    """Test suite for the denormalized book rating aggregates"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user', password='password')
+        self.author = Author.objects.create(first_name='Ernest',
+            last_name='Hemingway')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=self.author, publication_year=1929)
+        self.book2 = Book.objects.create(title='The Sun Also Rises',
+            author=self.author, publication_year=1926)
+
+    def addReview(self, rating, book=None):
+        return Review.objects.create(user=self.user, book=book or self.book,
+            timestamp=timezone.now(), review_message='', rating=rating)
+
+    def reload(self, book):
+        return Book.objects.get(pk=book.pk)
+
+    def testCreateReview(self):
+        """Test whether creating reviews updates the book aggregates"""
+        self.addReview(5)
+        self.addReview(2)
+
+        book = self.reload(self.book)
+        self.assertEqual(book.review_count, 2)
+        self.assertEqual(book.rating_sum, 7)
+        self.assertEqual(book.average_rating, 3.5)
+        self.assertEqual(book.rating_histogram(),
+            [(1, 0), (2, 1), (3, 0), (4, 0), (5, 1)])
+
+    def testEditReview(self):
+        """Test whether editing a review moves its rating"""
+        review = self.addReview(5)
+        review.rating = 1
+        review.save()
+        self.assertEqual(self.reload(self.book).rating_histogram(),
+            [(1, 1), (2, 0), (3, 0), (4, 0), (5, 0)])
+
+        #moving the review to another book updates both books
+        review.book = self.book2
+        review.save()
+        self.assertEqual(self.reload(self.book).review_count, 0)
+        self.assertEqual(self.reload(self.book2).rating_sum, 1)
+
+    def testDeleteReview(self):
+        """Test whether deleting reviews, singly or in bulk, updates the book"""
+        self.addReview(4).delete()
+        self.assertEqual(self.reload(self.book).review_count, 0)
+
+        self.addReview(3)
+        self.addReview(4)
+        Review.objects.filter(book=self.book).delete()
+        book = self.reload(self.book)
+        self.assertEqual(book.review_count, 0)
+        self.assertEqual(book.average_rating, None)
+
+    def testBookSaveKeepsAggregates(self):
+        """Test whether saving a stale Book doesn't overwrite its aggregates"""
+        stale = self.reload(self.book)
+        self.addReview(5)
+        stale.title = 'Farewell'
+        stale.save()
+        book = self.reload(self.book)
+        self.assertEqual(book.title, 'Farewell')
+        self.assertEqual(book.review_count, 1)
+
+    def testRebuildCommand(self):
+        """Test whether the rebuild command repairs drifted aggregates"""
+        self.addReview(5)
+        self.addReview(3, book=self.book2)
+        Book.objects.update(review_count=10, rating_sum=0, rating_5_count=7)
+
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        book = self.reload(self.book)
+        self.assertEqual(book.review_count, 1)
+        self.assertEqual(book.rating_5_count, 1)
+        self.assertEqual(self.reload(self.book2).rating_sum, 3)
+
+    def monthly(self, book):
+        return [(month['month'], month['review_count'], month['rating_sum'])
+            for month in monthly_ratings(book.pk)]
+
+    def testMonthlyRatings(self):
+        """Test whether review writes keep the monthly rollups, and whether
+        the series fills in the months without reviews"""
+        march = timezone.make_aware(datetime.datetime(2013, 3, 15),
+            timezone.get_default_timezone())
+        review = self.addReview(4)
+        review.timestamp = march
+        review.save()
+        Review.objects.create(user=self.user, book=self.book, rating=2,
+            timestamp=march + datetime.timedelta(days=62), review_message='')
+        self.assertEqual(self.monthly(self.book), [
+            (datetime.date(2013, 3, 1), 1, 4),
+            (datetime.date(2013, 4, 1), 0, 0),
+            (datetime.date(2013, 5, 1), 1, 2)])
+
+        #an edit moving the review to another book moves its month too
+        review.book = self.book2
+        review.save()
+        self.assertEqual(self.monthly(self.book2),
+            [(datetime.date(2013, 3, 1), 1, 4)])
+        self.assertEqual(self.monthly(self.book),
+            [(datetime.date(2013, 5, 1), 1, 2)])
+
+        review.delete()
+        self.assertEqual(self.monthly(self.book2), [])
+        self.assertFalse(BookMonthlyRating.objects.filter(
+            book=self.book2).exists())
+
+    @override_settings(BOOKSTORE_MONTHLY_WINDOW=3)
+    def testMonthlyWindow(self):
+        """Test the series only covers the window up to the last review"""
+        for year, month in ((2011, 1), (2012, 12), (2013, 2)):
+            Review.objects.create(user=self.user, book=self.book, rating=3,
+                timestamp=timezone.make_aware(datetime.datetime(year, month,
+                    15), timezone.get_default_timezone()), review_message='')
+        self.assertEqual(self.monthly(self.book), [
+            (datetime.date(2012, 12, 1), 1, 3),
+            (datetime.date(2013, 1, 1), 0, 0),
+            (datetime.date(2013, 2, 1), 1, 3)])
+
+    def testMonthlyRatingsBulk(self):
+        """Test whether bulk inserted reviews are added to the rollups"""
+        reviews = [Review(user=self.user, book=self.book, rating=rating,
+            timestamp=timezone.now(), review_message='') for rating in (3, 5)]
+        Review.objects.bulk_create(reviews)
+        reviews_bulk_changed.send(sender=Review, book_ids=[self.book.pk],
+            user_ids=[self.user.pk], created=reviews)
+        month = review_month(timezone.now())
+        self.assertEqual(self.monthly(self.book), [(month, 2, 8)])
+
+        #unknown changes are recounted
+        Review.objects.filter(rating=3).update(rating=1)
+        reviews_bulk_changed.send(sender=Review, book_ids=[self.book.pk],
+            user_ids=[self.user.pk])
+        self.assertEqual(self.monthly(self.book), [(month, 2, 6)])
+
+    def testRebuildMonthlyRatings(self):
+        """Test whether the rebuild command repairs drifted rollups"""
+        self.addReview(5)
+        self.addReview(3, book=self.book2)
+        BookMonthlyRating.objects.update(review_count=9, rating_sum=0)
+
+        call_command('rebuild_rating_aggregates', stdout=StringIO())
+        month = review_month(timezone.now())
+        self.assertEqual(self.monthly(self.book), [(month, 1, 5)])
+        self.assertEqual(self.monthly(self.book2), [(month, 1, 3)])
+
+    def testBookRatingsAPI(self):
+        """Test whether the ratings endpoint serves the rollups as JSON,
+        without reading the reviews"""
+        self.addReview(5)
+        self.addReview(4)
+        url = reverse('bookstore:api_book_ratings',
+            kwargs={'book_id': self.book.pk})
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        data = json.loads(response.content)
+        self.assertEqual(data['review_count'], 2)
+        self.assertEqual(data['average_rating'], 4.5)
+        self.assertEqual([rating['review_count'] for rating
+            in data['histogram']], [0, 0, 0, 1, 1])
+        self.assertEqual(data['monthly'], [{
+            'month': review_month(timezone.now()).strftime('%Y-%m'),
+            'review_count': 2, 'rating_sum': 9, 'average_rating': 4.5}])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(reverse('bookstore:book_review_list',
+            kwargs={'book_id': self.book.pk}))
+        self.assertEqual(response.context['monthly_ratings'][0]['review_count'],
+            2)
+
+
+class BookstoreUserStatsTest(TestCase):
+    """Test suite for the per-user review stats and username cache"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user', password='password')
+        self.hemingway = Author.objects.create(first_name='Ernest',
+            last_name='Hemingway')
+        self.woolf = Author.objects.create(first_name='Virginia',
+            last_name='Woolf')
+        self.farewell = Book.objects.create(title='A Farewell to Arms',
+            author=self.hemingway, publication_year=1929)
+        self.sun = Book.objects.create(title='The Sun Also Rises',
+            author=self.hemingway, publication_year=1926)
+        self.waves = Book.objects.create(title='The Waves',
+            author=self.woolf, publication_year=1931)
+        self.now = timezone.now().replace(microsecond=0)
+        userstats.get_username_cache().clear()
+
+    def addReview(self, rating, book, days_ago=0):
+        return Review.objects.create(user=self.user, book=book,
+            timestamp=self.now - datetime.timedelta(days=days_ago),
+            review_message='', rating=rating)
+
+    def stats(self):
+        stats = list(UserReviewStats.objects.filter(user=self.user)
+            .values_list('review_count', 'rating_sum', 'first_review',
+                'last_review', 'favorite_author'))
+        return stats[0] if stats else None
+
+    def assertRebuilt(self):
+        """the incremental stats match a recount"""
+        stats = self.stats()
+        userstats.rebuild_user_stats([self.user.pk])
+        self.assertEqual(self.stats(), stats)
+
+    def testReviewWrites(self):
+        """Test whether review writes keep the stats up to date"""
+        self.assertEqual(self.stats(), None)
+        waves = self.addReview(5, self.waves, days_ago=10)
+        self.addReview(2, self.farewell, days_ago=5)
+        #one review of each author: the tie goes to the lowest id
+        self.assertEqual(self.stats(), (2, 7, self.now -
+            datetime.timedelta(days=10), self.now - datetime.timedelta(
+            days=5), self.hemingway.pk))
+        self.assertRebuilt()
+
+        #a second Hemingway review, the earliest
+        sun = self.addReview(3, self.sun, days_ago=20)
+        self.assertEqual(self.stats()[1:], (10, self.now -
+            datetime.timedelta(days=20), self.now - datetime.timedelta(
+            days=5), self.hemingway.pk))
+        self.assertRebuilt()
+
+        #edits move the rating, the timestamps and the author counts
+        sun.book = self.waves
+        sun.rating = 1
+        sun.timestamp = self.now
+        sun.save()
+        self.assertEqual(self.stats()[1:], (8, self.now -
+            datetime.timedelta(days=10), self.now, self.woolf.pk))
+        self.assertRebuilt()
+
+        waves.delete()
+        self.assertEqual(self.stats()[:3], (2, 3, self.now -
+            datetime.timedelta(days=5)))
+        self.assertRebuilt()
+        Review.objects.filter(user=self.user).delete()
+        self.assertEqual(self.stats(), None)
+        self.assertEqual(UserAuthorReviewCount.objects.filter(
+            user=self.user).count(), 0)
+
+    def testBulkWrites(self):
+        """Test whether bulk review writes update the stats"""
+        self.addReview(4, self.waves, days_ago=1)
+        reviews = [Review(user=self.user, book=book, rating=rating,
+                timestamp=self.now - datetime.timedelta(days=days_ago),
+                review_message='')
+            for book, rating, days_ago in ((self.sun, 1, 30),
+                (self.farewell, 5, 0))]
+        Review.objects.bulk_create(reviews)
+        reviews_bulk_changed.send(sender=Review, book_ids=[self.sun.pk,
+            self.farewell.pk], user_ids=[self.user.pk], created=reviews)
+        self.assertEqual(self.stats(), (3, 10, self.now -
+            datetime.timedelta(days=30), self.now, self.hemingway.pk))
+        self.assertRebuilt()
+
+    def testBookAuthorChange(self):
+        """Test whether giving a book to another author moves the counts"""
+        self.addReview(4, self.waves)
+        self.addReview(4, self.farewell)
+        self.addReview(4, self.sun)
+        self.assertEqual(self.stats()[4], self.hemingway.pk)
+        self.sun.author = self.woolf
+        self.sun.save()
+        self.assertEqual(self.stats()[4], self.woolf.pk)
+
+    def testLRUCache(self):
+        """Test the LRU cache drops the least recently used and expired
+        entries"""
+        cache = LRUCache(maxsize=2, timeout=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')),
+            (1, None, 3))
+        cache.timeout = 0
+        cache.set('d', 4)
+        self.assertEqual(cache.get('d', 'expired'), 'expired')
+        self.assertEqual(len(cache), 1)
+
+    def testProfileQueries(self):
+        """Test a user's page looks the user and their stats up in one query
+        once the username is remembered"""
+        self.addReview(5, self.waves)
+
+        def summary(**kwargs):
+            view = UserReviewListView(kwargs=kwargs)
+            return view.subject, view.get_review_stats()
+
+        #the first lookup by username remembers the id from the same row
+        with self.assertNumQueries(1):
+            summary(username='user')
+        with self.assertNumQueries(1):
+            user, stats = summary(username='user')
+            self.assertEqual(stats['review_count'], 1)
+            self.assertEqual(stats['average_rating'], 5.0)
+            self.assertEqual(stats['favorite_author'], self.woolf)
+        with self.assertNumQueries(1):
+            summary(user_id=self.user.pk)
+
+        #a renamed user's old name is forgotten, and the new one found
+        self.user.username = 'reader'
+        self.user.save()
+        self.assertRaises(Http404, summary, username='user')
+        self.assertEqual(summary(username='reader')[0], self.user)
+        self.assertEqual(summary(username='reader')[1]['review_count'], 1)
+        User.objects.create(username='new')
+        self.assertEqual(summary(username='new')[1]['review_count'], 0)
+
+
+class BookstoreConnectionsTest(TestCase):
+    """Test suite for the persistent database connections"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.connection = DatabaseWrapper(dict(connection.settings_dict,
+            NAME=os.path.join(self.directory, 'pool.sqlite')), alias='pool')
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.directory)
+
+    def pragma(self, name):
+        cursor = self.connection.cursor()
+        cursor.execute('PRAGMA %s' % name)
+        return cursor.fetchone()[0]
+
+    def testSqlitePragmas(self):
+        """Test new SQLite connections are put in WAL mode"""
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+
+    @override_settings(BOOKSTORE_CONN_MAX_AGE=600)
+    def testReleaseConnection(self):
+        """Test connections are kept between requests, unless they're too old
+        or the pool is full"""
+        with self.settings(BOOKSTORE_CONN_POOL_SIZE=0):
+            self.connection.cursor()
+            self.assertFalse(connections.release_connection(self.connection))
+            self.assertEqual(self.connection.connection, None)
+
+        self.connection.cursor()
+        raw = self.connection.connection
+        self.assertTrue(connections.release_connection(self.connection))
+        self.assertTrue(connections.check_connection(self.connection))
+        self.assertTrue(self.connection.connection is raw)
+
+        with self.settings(BOOKSTORE_CONN_MAX_AGE=0):
+            self.connection.cursor()
+            self.assertFalse(connections.release_connection(self.connection))
+            self.assertEqual(self.connection.connection, None)
+
+    @override_settings(BOOKSTORE_CONN_MAX_AGE=600)
+    def testCheckConnection(self):
+        """Test expired, broken and inherited connections are dropped when a
+        request starts"""
+        self.connection.cursor()
+        opened, pid = self.connection._bookstore_opened
+        self.connection._bookstore_opened = (opened - 600, pid)
+        self.assertFalse(connections.check_connection(self.connection))
+        self.assertEqual(self.connection.connection, None)
+
+        self.connection.cursor()
+        self.connection.connection.close()
+        self.assertFalse(connections.check_connection(self.connection))
+        self.assertEqual(self.connection.connection, None)
+
+        #a connection of the parent process is left open for the parent
+        self.connection.cursor()
+        raw = self.connection.connection
+        self.connection._bookstore_opened = (time.time(), pid + 1)
+        self.assertFalse(connections.check_connection(self.connection))
+        self.assertEqual(self.connection.connection, None)
+        raw.execute('SELECT 1')
+        raw.close()
+
+
+    @override_settings(BOOKSTORE_CONN_MAX_AGE=600)
+    def testRequestSignals(self):
+        """Test the request signals keep a connection between requests, with
+        the receivers connected as at runtime"""
+        #the test client connects Django's close_connection again after each
+        #request, which connections.py disconnected at import
+        request_finished.disconnect(db.close_connection)
+        self.addCleanup(request_finished.connect, db.close_connection)
+        default = db.connections['default']
+        self.addCleanup(db.connections.__setitem__, 'default', default)
+        db.connections['default'] = self.connection
+
+        self.connection.cursor()
+        raw = self.connection.connection
+        request_finished.send(sender=self.__class__)
+        request_started.send(sender=self.__class__)
+        self.assertTrue(self.connection.connection is raw)
+
+        with self.settings(BOOKSTORE_CONN_MAX_AGE=0):
+            request_finished.send(sender=self.__class__)
+        self.assertEqual(self.connection.connection, None)
+
+
+class BookstoreReplicasTest(BookstoreTestCase):
+    """Test suite for the read replica routing"""
+
+    def setUp(self):
+        self.middleware = replicas.ReplicaMiddleware()
+        self.path = reverse('bookstore:book_list')
+
+    def request(self, path, **cookies):
+        request = RequestFactory().get(path)
+        request.COOKIES.update(cookies)
+        request.resolver_match = resolve(path)
+        self.middleware.process_request(request)
+        self.middleware.process_view(request, None, (), {})
+        return request
+
+    def testRouter(self):
+        """Test reads go to the request's replica and writes to the
+        primary"""
+        self.assertEqual(Book.objects.all().db, 'default')
+        with routers.use_replica('replica'):
+            self.assertEqual(Book.objects.all().db, 'replica')
+            self.assertEqual(router.db_for_write(Book), 'default')
+        self.assertEqual(Book.objects.all().db, 'default')
+
+    def testSelection(self):
+        """Test replicas are picked in turn, or by requests in flight"""
+        selector = replicas.ReplicaSelector()
+        picked = [selector.acquire(('a', 'b'), 'round_robin')
+            for i in range(4)]
+        self.assertEqual(picked, ['a', 'b', 'a', 'b'])
+
+        selector = replicas.ReplicaSelector()
+        self.assertEqual(selector.acquire(('a', 'b'), 'least_loaded'), 'a')
+        #'a' is still busy, so it's passed over even on its turn
+        self.assertEqual(selector.acquire(('a', 'b'), 'least_loaded'), 'b')
+        selector.release('b')
+        self.assertEqual(selector.acquire(('a', 'b'), 'least_loaded'), 'b')
+
+    @override_settings(BOOKSTORE_READ_REPLICAS=('replica',))
+    def testMiddleware(self):
+        """Test the list views read from a replica until the client writes"""
+        request = self.request(self.path)
+        self.assertEqual(routers.current_replica(), 'replica')
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertEqual(routers.current_replica(), None)
+        self.assertFalse(replicas.STICKY_COOKIE in response.cookies)
+
+        #other views, and clients that just wrote, read from the primary
+        request = self.request(reverse('bookstore:search'))
+        self.assertEqual(routers.current_replica(), None)
+        request = self.request(self.path, **{replicas.STICKY_COOKIE: '1'})
+        self.assertEqual(routers.current_replica(), None)
+
+        request = self.request(reverse('bookstore:login'))
+        Author.objects.create(first_name='Ernest', last_name='Hemingway')
+        response = self.middleware.process_response(request, HttpResponse())
+        self.assertTrue(replicas.STICKY_COOKIE in response.cookies)
+
+    @override_settings(BOOKSTORE_READ_REPLICAS=('replica',))
+    def testStaleReplicaPageNotCached(self):
+        """Test a page read from a replica that lags behind isn't cached
+        for the visitors reading from the primary"""
+        with empty_replica('bookstore_author', 'bookstore_book'):
+            Book.objects.create(title='A Farewell to Arms',
+                author=Author.objects.create(first_name='Ernest',
+                    last_name='Hemingway'))
+            response = self.client.get(self.path)
+            self.assertNotContains(response, 'A Farewell to Arms')
+            #the replica caught up, or the client reads from the primary
+            with self.settings(BOOKSTORE_READ_REPLICAS=()):
+                response = self.client.get(self.path)
+            self.assertContains(response, 'A Farewell to Arms')
+
+    def testCopyDatabase(self):
+        """Test the replication stand-in copies rows, indexes and changed
+        tables"""
+        directory = tempfile.mkdtemp()
+        try:
+            source_path = os.path.join(directory, 'source.sqlite')
+            target_path = os.path.join(directory, 'target.sqlite')
+            source = sqlite3.connect(source_path)
+            source.execute('CREATE TABLE book (id integer PRIMARY KEY, '
+                'title text)')
+            source.execute('CREATE INDEX book_title ON book (title)')
+            source.execute('CREATE VIRTUAL TABLE book_search USING '
+                'fts5(title)')
+            source.execute("INSERT INTO book VALUES (1, 'A Farewell to Arms')")
+            source.execute("INSERT INTO book_search (rowid, title) VALUES "
+                "(1, 'A Farewell to Arms')")
+            source.commit()
+
+            self.assertEqual(replicas.copy_sqlite_database(source_path,
+                target_path), 1 + 5)
+            target = sqlite3.connect(target_path)
+            self.assertEqual(target.execute('SELECT title FROM book')
+                .fetchall(), [('A Farewell to Arms',)])
+            self.assertEqual(target.execute("SELECT rowid FROM book_search "
+                "WHERE book_search MATCH 'farewell'").fetchall(), [(1,)])
+            self.assertEqual(target.execute("SELECT name FROM sqlite_master "
+                "WHERE type = 'index'").fetchall(), [('book_title',)])
+            target.close()
+
+            source.execute('DROP TABLE book')
+            source.execute('CREATE TABLE book (id integer PRIMARY KEY, '
+                'title text, year integer)')
+            source.execute("INSERT INTO book VALUES (1, 'Arms', 1929)")
+            source.commit()
+            source.close()
+            replicas.copy_sqlite_database(source_path, target_path)
+            target = sqlite3.connect(target_path)
+            self.assertEqual(target.execute('SELECT * FROM book').fetchall(),
+                [(1, 'Arms', 1929)])
+            target.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class BookstoreIngestTest(BookstoreTestCase):
+    """Test suite for the queued review writes"""
+
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        self.user.set_password('password')
+        self.user.save()
+        self.author = Author.objects.create(first_name='Ernest',
+            last_name='Hemingway')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=self.author, publication_year=1929)
+        self.batches = []
+
+    def review(self, rating=4):
+        return Review(user=self.user, book=self.book, rating=rating,
+            timestamp=timezone.now(), review_message='')
+
+    def testBatches(self):
+        """Test the worker writes queued reviews in batches, and stops once
+        they're written"""
+        queue = ingest.ReviewIngestQueue(writer=self.batches.append,
+            batch_size=3, batch_wait=0.5)
+        for i in range(7):
+            queue.submit(self.review())
+        queue.flush()
+        self.assertEqual([len(batch) for batch in self.batches], [3, 3, 1])
+        queue.submit(self.review())
+        queue.stop(timeout=5)
+        self.assertFalse(queue.worker.is_alive())
+        self.assertEqual(queue.written, 8)
+
+    def sharedWriter(self):
+        """write_reviews, run by the worker on the test's connection: its
+        in-memory database is the only one with the tables"""
+        connection = db.connections['default']
+        connection.allow_thread_sharing = True
+        self.addCleanup(setattr, connection, 'allow_thread_sharing', False)
+
+        def writer(batch):
+            db.connections['default'] = connection
+            ingest.write_reviews(batch)
+        return writer
+
+    def testWorkerWrites(self):
+        """Test the worker writes the reviews with the book's aggregates, and
+        a failed batch is retried review by review"""
+        queue = ingest.ReviewIngestQueue(writer=self.sharedWriter(),
+            batch_size=3, batch_wait=0.5)
+        #the review without a user can't be inserted, nor its batch
+        invalid = self.review(rating=1)
+        invalid.user_id = None
+        for review in (self.review(rating=5), invalid, self.review(rating=3),
+                self.review(rating=4)):
+            queue.submit(review)
+        queue.stop(timeout=5)
+        self.assertEqual((queue.written, queue.failed), (3, 1))
+        self.assertEqual(sorted(Review.objects.filter(book=self.book)
+            .values_list('rating', flat=True)), [3, 4, 5])
+        book = Book.objects.get(pk=self.book.pk)
+        self.assertEqual((book.review_count, book.rating_sum), (3, 12))
+
+    def testBackpressure(self):
+        """Test a full queue refuses reviews, and the API asks to retry"""
+        queue = ingest.ReviewIngestQueue(writer=self.batches.append,
+            maxsize=1)
+        #a worker that isn't draining the queue
+        queue.start = lambda: None
+        queue.submit(self.review(), timeout=0)
+        self.assertRaises(ingest.ReviewQueueFull, queue.submit,
+            self.review(), timeout=0)
+
+    @override_settings(BOOKSTORE_INGEST_SYNC=True)
+    def testSubmitReview(self):
+        """Test the API queues reviews, written at once in sync mode with
+        the book's aggregates"""
+        url = reverse('bookstore:api_review_submit',
+            kwargs={'book_id': self.book.pk})
+        response = self.client.post(url, {'rating': 5,
+            'review_message': 'Caporetto'})
+        self.assertEqual(response.status_code, 403)
+
+        self.client.login(username='user', password='password')
+        response = self.client.post(url, {'rating': 9})
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue('rating' in json.loads(response.content)['errors'])
+
+        response = self.client.post(url, {'rating': 5,
+            'review_message': 'Caporetto'})
+        self.assertEqual(response.status_code, 202)
+        review = Review.objects.get(book=self.book)
+        self.assertEqual((review.user, review.rating), (self.user, 5))
+        self.assertEqual(Book.objects.get(pk=self.book.pk).rating_sum, 5)
+
+
+class BookstoreAdminTest(BookstoreTestCase):
+    """Test suite for the admin changelists of the large tables"""
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin',
+            'admin@example.com', 'password')
+        self.author = Author.objects.create(first_name='Ernest',
+            last_name='Hemingway')
+        self.book = Book.objects.create(title='A Farewell to Arms',
+            author=self.author, publication_year=1929)
+        self.march = timezone.make_aware(datetime.datetime(2013, 3, 15),
+            timezone.get_default_timezone())
+        self.client.login(username='admin', password='password')
+
+    def addReviews(self, count, timestamp=None):
+        for i in range(count):
+            user = User.objects.create(username='reader%d' %
+                User.objects.count())
+            Review.objects.create(user=user, book=self.book, rating=4,
+                timestamp=timestamp or self.march, review_message='')
+
+    def countQueries(self, url):
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get(url)
+            #the test client resets the query log at the request start
+            queries = len(connection.queries)
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+        self.assertEqual(response.status_code, 200)
+        return queries
+
+    def testChangelistQueries(self):
+        """Test the changelists don't look up each row's related objects"""
+        for url in ('/admin/bookstore/review/', '/admin/bookstore/book/'):
+            self.addReviews(1)
+            few = self.countQueries(url)
+            self.addReviews(10)
+            self.assertEqual(self.countQueries(url), few, url)
+
+    def testCounts(self):
+        """Test the review count is precomputed, and counts of a large table
+        are cached"""
+        self.addReviews(3)
+        reviews = admin.site._registry[Review].queryset(None)
+        with self.assertNumQueries(1):
+            self.assertEqual(reviews.count(), 3)
+
+        with self.settings(BOOKSTORE_ADMIN_COUNT_THRESHOLD=0):
+            march = reviews.filter(timestamp__year=2013)
+            self.assertEqual(march.count(), 3)
+            self.addReviews(1)
+            self.assertEqual(march.count(), 3)
+        self.assertEqual(march.count(), 4)
+
+    def testDateHierarchy(self):
+        """Test the date hierarchy's years and months come from the monthly
+        rollups"""
+        self.addReviews(2)
+        self.addReviews(1, self.march.replace(year=2011))
+        response = self.client.get('/admin/bookstore/review/')
+        self.assertContains(response, '?timestamp__year=2011')
+        self.assertContains(response, '?timestamp__year=2013')
+        response = self.client.get('/admin/bookstore/review/',
+            {'timestamp__year': 2013})
+        self.assertContains(response, 'timestamp__month=3')
+        response = self.client.get('/admin/bookstore/review/',
+            {'timestamp__year': 2013, 'timestamp__month': 3})
+        self.assertContains(response, 'timestamp__day=15')
+
+        BookMonthlyRating.objects.filter(month__year=2011).delete()
+        response = self.client.get('/admin/bookstore/review/')
+        self.assertNotContains(response, '?timestamp__year=2011')
+
+
+class BookstoreRoutingTest(TestCase):
+    """Test suite for the prefix-indexed URL resolver and memoized reverse"""
+
+    def testLiteralPrefix(self):
+        """Test the literal prefixes of the bookstore patterns"""
+        self.assertEqual(routing.literal_prefix(r'^api/book/(?P<id>[0-9]+)/?$'),
+            'api/book/')
+        self.assertEqual(routing.literal_prefix(r'^books?/?$'), 'book')
+        self.assertEqual(routing.literal_prefix(r'^login/?$'), 'login')
+        self.assertEqual(routing.literal_prefix(r'^stats\.(?P<f>json)$'),
+            'stats')
+        self.assertEqual(routing.literal_prefix(r'^$'), '')
+        self.assertEqual(routing.literal_prefix(r'^index/?$|^$'), '')
+        self.assertEqual(routing.literal_prefix(r'^(?:a|b)/[|]$'), '')
+        self.assertEqual(routing.literal_prefix(r'^a/(b|c)/[|]\|$'), 'a/')
+        self.assertEqual(routing.literal_prefix(r'book/'), '')
+
+    def testResolversAgree(self):
+        """Test the prefix resolver matches what the linear one does"""
+        from django.core.urlresolvers import RegexURLResolver, Resolver404
+        linear = RegexURLResolver(r'^', 'bookstore.urls')
+        indexed = routing.PrefixURLResolver(r'^', 'bookstore.urls')
+        paths = [path[len('/bookstore/'):] for label, path in
+            bench.benchmark_urls(bench.ROUTING_SAMPLES)]
+        paths += ['', 'index', 'login/', 'login/success', 'logout', 'book',
+            'books/', 'user/ernest.h/', 'user/42', 'api/book/3/reviews/new/',
+            'stats.json']
+        for path in paths:
+            path = path.split('?', 1)[0]
+            expected = linear.resolve(path)
+            match = indexed.resolve(path)
+            self.assertEqual((match.url_name, match.func, match.kwargs),
+                (expected.url_name, expected.func, expected.kwargs), path)
+        for path in ('nowhere/', 'book/x', 'user/a/b', 'api/book/3'):
+            self.assertRaises(Resolver404, linear.resolve, path)
+            self.assertRaises(Resolver404, indexed.resolve, path)
+
+    def testURLs(self):
+        """Test every URL name still reverses and resolves through the
+        bookstore namespace"""
+        self.assertEqual(reverse('bookstore:index'), '/bookstore/index')
+        self.assertEqual(resolve('/bookstore/index/').url_name, 'index')
+        self.assertEqual(resolve('/bookstore/').url_name, 'index')
+        self.assertEqual(resolve('/bookstore/books').url_name, 'book_list')
+        match = resolve('/bookstore/user/ernest.h/')
+        self.assertEqual(match.url_name, 'user_review_list')
+        self.assertEqual(match.kwargs, {'username': 'ernest.h'})
+        self.assertEqual(match.namespace, 'bookstore')
+        match = resolve(reverse('bookstore:api_review_submit',
+            kwargs={'book_id': 12}))
+        self.assertEqual(match.url_name, 'api_review_submit')
+        self.assertEqual(match.kwargs, {'book_id': '12'})
+        self.assertEqual(match.app_name, 'bookstore')
+
+    def testCachedReverse(self):
+        """Test memoized reverses match reverse() and follow the script
+        prefix"""
+        from django.core.urlresolvers import set_script_prefix
+        for name in ('index', 'login', 'logout', 'book_list', 'search'):
+            self.assertEqual(routing.cached_reverse('bookstore:' + name),
+                reverse('bookstore:' + name))
+        set_script_prefix('/shop/')
+        try:
+            self.assertEqual(routing.cached_reverse('bookstore:login'),
+                '/shop/bookstore/login')
+        finally:
+            set_script_prefix('/')
+        self.assertEqual(routing.cached_reverse('bookstore:login'),
+            '/bookstore/login')
+        self.assertRaises(NoReverseMatch, routing.cached_reverse,
+            'bookstore:nowhere')
+
+    def testBenchmarkRouting(self):
+        """Test resolves and reverses are benchmarked"""
+        results = bench.benchmark_routing(calls=20, repeat=1)
+        self.assertEqual(set(results), set(['resolve, linear',
+            'resolve, prefix index', 'reverse', 'reverse, memoized']))
+        for rate in results.values():
+            self.assertTrue(rate > 0)
@@ -6,13 +6,13 @@ from django.views.generic.base import TemplateView
 
 from bookstore.models import Book, Author, Review
 from bookstore.views import *
+from bookstore.api import (BookListAPIView, BookRatingsAPIView,
+    BookReviewListAPIView, ReviewSubmitAPIView, UserReviewListAPIView)
 
 urlpatterns = patterns('bookstore.views',
-    #index/homepage
-    url(r'^$',
-        TemplateView.as_view(template_name='bookstore/index.html'),
-        name='index'),
-    url(r'^index/?$',
+    #index/homepage, at index or the root; reverse() stops at the first $, so
+    #the index is reversed to index
+    url(r'^index/?$|^$',
         TemplateView.as_view(template_name='bookstore/index.html'),
         name='index'),
 
@@ -32,17 +32,18 @@ urlpatterns = patterns('bookstore.views',
         name='logout'),
 
     #list of reviews for a certain book
-    url(r'^book/(?P<book_id>[0-9]+?)/?$',
+    url(r'^book/(?P<book_id>[0-9]+)/?$',
         BookReviewListView.as_view(),
         name='book_review_list'
     ),
 
-    #list of reviews for a certain user
-    url(r'^user/(?P<user_id>[0-9]+?)/?$',
+    #list of reviews for a certain user, by id or username; two patterns, as
+    #reverse() can't take either keyword from one
+    url(r'^user/(?P<user_id>[0-9]+)/?$',
         UserReviewListView.as_view(),
         name='user_review_list'
     ),
-    url(r'^user/(?P<username>.+?)/?$',
+    url(r'^user/(?P<username>[^/]+)/?$',
         UserReviewListView.as_view(),
         name='user_review_list'
     ),
@@ -52,4 +53,65 @@ urlpatterns = patterns('bookstore.views',
         BookListView.as_view(),
         name='book_list'
     ),
+
+    #leaderboards: top rated or most reviewed books, overall, for an author
+    #or for a decade of publication
+    url(r'^leaderboard/(?P<board>top_rated|most_reviewed)/?$',
+        LeaderboardView.as_view(),
+        name='leaderboard'
+    ),
+    url(r'^leaderboard/(?P<board>top_rated|most_reviewed)/author/'
+        r'(?P<author_id>[0-9]+)/?$',
+        LeaderboardView.as_view(),
+        name='leaderboard'
+    ),
+    url(r'^leaderboard/(?P<board>top_rated|most_reviewed)/decade/'
+        r'(?P<decade>[0-9]+)/?$',
+        LeaderboardView.as_view(),
+        name='leaderboard'
+    ),
+
+    #search books by title, author and review text
+    url(r'^search/?$',
+        SearchView.as_view(),
+        name='search'
+    ),
+
+    #bulk export, for staff
+    url(r'^export/(?P<kind>reviews|books)\.(?P<format>csv|jsonl)$',
+        ExportView.as_view(),
+        name='export'
+    ),
+
+    #request statistics, for staff
+    url(r'^stats/?$',
+        StatsView.as_view(),
+        name='stats'
+    ),
+    url(r'^stats\.(?P<format>json)$',
+        StatsView.as_view(),
+        name='stats'
+    ),
+
+    #JSON API
+    url(r'^api/books/?$',
+        BookListAPIView.as_view(),
+        name='api_book_list'
+    ),
+    url(r'^api/book/(?P<book_id>[0-9]+)/reviews/?$',
+        BookReviewListAPIView.as_view(),
+        name='api_book_review_list'
+    ),
+    url(r'^api/book/(?P<book_id>[0-9]+)/reviews/new/?$',
+        ReviewSubmitAPIView.as_view(),
+        name='api_review_submit'
+    ),
+    url(r'^api/book/(?P<book_id>[0-9]+)/ratings/?$',
+        BookRatingsAPIView.as_view(),
+        name='api_book_ratings'
+    ),
+    url(r'^api/user/(?P<user_id>[0-9]+)/reviews/?$',
+        UserReviewListAPIView.as_view(),
+        name='api_user_review_list'
+    ),
 )
\ No newline at end of file
@@ -0,0 +1,287 @@
+#bookstore/userstats.py
+#Rolph Recto
+
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Sum
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from bookstore.models import (Book, Review, UserAuthorReviewCount,
+    UserReviewStats)
+from bookstore.signals import reviews_bulk_changed
+from bookstore.util import LRUCache
+
+
+def get_username_cache_size():
+    """the most usernames whose user ids are remembered"""
+    return getattr(settings, 'BOOKSTORE_USERNAME_CACHE_SIZE', 10000)
+
+
+def get_username_cache_timeout():
+    """seconds a username's user id is remembered for"""
+    return getattr(settings, 'BOOKSTORE_USERNAME_CACHE_TIMEOUT', 300)
+
+
+_usernames = None
+_usernames_lock = threading.Lock()
+
+
+def get_username_cache():
+    """the process's cache of user ids by username"""
+    global _usernames
+    with _usernames_lock:
+        if _usernames is None:
+            _usernames = LRUCache(get_username_cache_size(),
+                get_username_cache_timeout())
+    return _usernames
+
+
+def user_for_username(username, users=None):
+    """the user with this username, from the users queryset (eg. one with
+    select_related) or every user, or None: fetched by primary key when its
+    id is remembered, else by username, remembering its id; one query unless
+    the remembered id is stale"""
+    if users is None:
+        users = User.objects.all()
+    cache = get_username_cache()
+    user_id = cache.get(username)
+    if user_id is not None:
+        found = list(users.filter(pk=user_id)[:1])
+        if found and found[0].username == username:
+            return found[0]
+        #renamed or deleted since
+        cache.delete(username)
+    found = list(users.filter(username=username)[:1])
+    if not found:
+        #unknown usernames aren't remembered: the user may sign up
+        return None
+    cache.set(username, found[0].pk)
+    return found[0]
+
+
+def review_summary(user):
+    """dict of the user's review_count, average_rating, first_review,
+    last_review and favorite_author, from the stats row (fetched with the user
+    if it was selected with select_related('review_stats'))"""
+    try:
+        stats = user.review_stats
+    except UserReviewStats.DoesNotExist:
+        stats = UserReviewStats(user=user)
+    return {
+        'review_count': stats.review_count,
+        'average_rating': stats.average_rating,
+        'first_review': stats.first_review,
+        'last_review': stats.last_review,
+        'favorite_author': stats.favorite_author,
+    }
+
+
+def _author_ids(book_ids):
+    """{book id: author id} of the books"""
+    return dict(Book.objects.filter(pk__in=list(book_ids))
+        .values_list('pk', 'author'))
+
+
+def _review_author_id(review):
+    """the author of the review's book, without a query if the book was
+    fetched already"""
+    book = getattr(review, '_book_cache', None)
+    if book is not None and book.pk == review.book_id:
+        return book.author_id
+    return _author_ids([review.book_id]).get(review.book_id)
+
+
+def _favorite_author_id(user_id):
+    #the author of the most of the user's reviews; ties go to the lowest id
+    favorite = list(UserAuthorReviewCount.objects.filter(user=user_id)
+        .order_by('-review_count', 'author')
+        .values_list('author', flat=True)[:1])
+    return favorite[0] if favorite else None
+
+
+def apply_author_delta(user_id, author_id, delta):
+    """add delta to the number of the user's reviews of the author's books,
+    creating the count on the first and deleting it at zero"""
+    counts = UserAuthorReviewCount.objects.filter(user=user_id,
+        author=author_id)
+    if counts.update(review_count=F('review_count') + delta):
+        if delta < 0:
+            counts.filter(review_count=0).delete()
+    elif delta > 0:
+        UserAuthorReviewCount.objects.get_or_create(user_id=user_id,
+            author_id=author_id)
+        counts.update(review_count=F('review_count') + delta)
+
+
+def add_reviews(user_id, reviews):
+    """add the user's new reviews, as (author id, rating, timestamp), into
+    their stats; the counts are added with single UPDATEs, so concurrent
+    writers don't race, and the stats row is created with the first review"""
+    authors = defaultdict(int)
+    for author_id, rating, timestamp in reviews:
+        authors[author_id] += 1
+    for author_id, count in authors.items():
+        apply_author_delta(user_id, author_id, count)
+
+    first = min(timestamp for author_id, rating, timestamp in reviews)
+    last = max(timestamp for author_id, rating, timestamp in reviews)
+    updates = {
+        'review_count': F('review_count') + len(reviews),
+        'rating_sum': F('rating_sum') + sum(rating
+            for author_id, rating, timestamp in reviews),
+        'favorite_author': _favorite_author_id(user_id),
+    }
+    rows = UserReviewStats.objects.filter(user=user_id)
+    #usually the new reviews are the user's newest, and one UPDATE does
+    if rows.filter(first_review__lte=first, last_review__lte=last).update(
+            last_review=last, **updates):
+        return
+    if not rows.update(**updates):
+        UserReviewStats.objects.get_or_create(user_id=user_id)
+        rows.update(**updates)
+    (rows.filter(Q(first_review__isnull=True) | Q(first_review__gt=first))
+        .update(first_review=first))
+    (rows.filter(Q(last_review__isnull=True) | Q(last_review__lt=last))
+        .update(last_review=last))
+
+
+def remove_review(user_id, author_id, rating):
+    """take one of the user's reviews out of their stats; the first and last
+    review are looked up again on the (user, timestamp) index"""
+    rows = UserReviewStats.objects.filter(user=user_id)
+    if not rows.update(review_count=F('review_count') - 1,
+            rating_sum=F('rating_sum') - rating):
+        #the stats went first, with the user
+        return
+    #users without reviews aren't stored
+    rows.filter(review_count=0).delete()
+    if not rows.exists():
+        UserAuthorReviewCount.objects.filter(user=user_id).delete()
+        return
+    apply_author_delta(user_id, author_id, -1)
+    updates = Review.objects.filter(user=user_id).aggregate(
+        first_review=Min('timestamp'), last_review=Max('timestamp'))
+    updates['favorite_author'] = _favorite_author_id(user_id)
+    rows.update(**updates)
+
+
+def rebuild_user_stats(user_ids=None):
+    """recompute the stats from the Review table, either for the given users
+    or for every user; returns the number of users with reviews"""
+    reviews = Review.objects.all()
+    stats = UserReviewStats.objects.all()
+    counts = UserAuthorReviewCount.objects.all()
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        reviews = reviews.filter(user__in=user_ids)
+        stats = stats.filter(user__in=user_ids)
+        counts = counts.filter(user__in=user_ids)
+
+    #one GROUP BY for the users, one for their authors
+    totals = dict((row['user'], row) for row in reviews.order_by()
+        .values('user').annotate(review_count=Count('pk'),
+            rating_sum=Sum('rating'), first_review=Min('timestamp'),
+            last_review=Max('timestamp')))
+    author_counts = list(reviews.order_by().values_list('user',
+        'book__author').annotate(Count('pk')))
+    favorites = {}
+    for user_id, author_id, count in author_counts:
+        best = favorites.get(user_id)
+        if best is None or (count, -author_id) > (best[1], -best[0]):
+            favorites[user_id] = (author_id, count)
+
+    with transaction.commit_on_success():
+        stats.delete()
+        counts.delete()
+        UserReviewStats.objects.bulk_create([UserReviewStats(user_id=user_id,
+                review_count=row['review_count'], rating_sum=row['rating_sum'],
+                first_review=row['first_review'],
+                last_review=row['last_review'],
+                favorite_author_id=favorites[user_id][0])
+            for user_id, row in totals.items()])
+        UserAuthorReviewCount.objects.bulk_create([UserAuthorReviewCount(
+                user_id=user_id, author_id=author_id, review_count=count)
+            for user_id, author_id, count in author_counts])
+    return len(totals)
+
+
+@receiver(post_save, sender=Review)
+def update_user_stats(sender, instance, raw, created, **kwargs):
+    """move the review into its user's stats"""
+    if raw:
+        return
+    stored = getattr(instance, '_stored_rating', None)
+    if stored is not None:
+        stored = (getattr(instance, '_stored_user_id', None), stored[0],
+            stored[1], getattr(instance, '_stored_timestamp', None))
+        current = (instance.user_id, instance.book_id, instance.rating,
+            instance.timestamp)
+        if stored == current:
+            return
+    elif not created:
+        #an edit of a review whose stored copy wasn't read
+        rebuild_user_stats([instance.user_id])
+        return
+
+    author_id = _review_author_id(instance)
+    if stored is not None:
+        if stored[1] != instance.book_id:
+            #moved from another book
+            remove_review(stored[0], _author_ids([stored[1]]).get(stored[1]),
+                stored[2])
+        else:
+            remove_review(stored[0], author_id, stored[2])
+    add_reviews(instance.user_id, [(author_id, instance.rating,
+        instance.timestamp)])
+
+
+@receiver(post_delete, sender=Review)
+def remove_user_stats(sender, instance, **kwargs):
+    """take a deleted review out of its user's stats"""
+    author_id = _review_author_id(instance)
+    if author_id is None:
+        #the book is being deleted too
+        rebuild_user_stats([instance.user_id])
+    else:
+        remove_review(instance.user_id, author_id, instance.rating)
+
+
+@receiver(pre_save, sender=Book)
+def remember_book_author(sender, instance, raw, **kwargs):
+    instance._stored_author_id = None
+    if not raw and instance.pk is not None:
+        stored = list(Book.objects.filter(pk=instance.pk)
+            .values_list('author', flat=True)[:1])
+        if stored:
+            instance._stored_author_id = stored[0]
+
+
+@receiver(post_save, sender=Book)
+def update_book_user_stats(sender, instance, created, **kwargs):
+    """the reviewers of a book given to another author have new counts"""
+    stored = getattr(instance, '_stored_author_id', None)
+    if not created and stored is not None and stored != instance.author_id:
+        rebuild_user_stats(Review.objects.filter(book=instance).order_by()
+            .values_list('user', flat=True).distinct())
+
+
+@receiver(reviews_bulk_changed)
+def update_bulk_user_stats(sender, user_ids, created=None, **kwargs):
+    """bring the stats of a batch's users up to date with one set of UPDATEs
+    per user, or recount them"""
+    if created is None:
+        if user_ids:
+            rebuild_user_stats(user_ids)
+        return
+    authors = _author_ids(set(review.book_id for review in created))
+    reviews = defaultdict(list)
+    for review in created:
+        reviews[review.user_id].append((authors.get(review.book_id),
+            review.rating, review.timestamp))
+    for user_id, user_reviews in reviews.items():
+        add_reviews(user_id, user_reviews)
@@ -1,9 +1,55 @@
 #bookstore/util.py
 #Rolph Recto
 
+import threading
+import time
+from collections import OrderedDict
+
 from django.core.exceptions import ValidationError
 
 def not_negative(value):
     """validator function to make sure the number value is not negative"""
     if value < 0:
-        raise ValidationError('Value cannot be negative')
\ No newline at end of file
+        raise ValidationError('Value cannot be negative')
+
+
+class LRUCache(object):
+    """In-process cache of at most maxsize entries that drops the least
+    recently used one when full, and any entry timeout seconds after it was
+    set; safe to share between threads"""
+
+    def __init__(self, maxsize=1000, timeout=300):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        #key -> (value, expiry time), least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+            if entry[1] <= time.time():
+                return default
+            #move it to the most recently used end
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.timeout)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
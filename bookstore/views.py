@@ -1,76 +1,398 @@
 #bookstore/views.py
 #Rolph Recto
 
+import json
+
 from django.contrib.auth.models import User
-from django.views.generic.base import TemplateView
+from django.core.exceptions import ImproperlyConfigured
+from django.views.generic.base import TemplateView, View
 from django.views.generic.list import ListView
 from django.views.generic.edit import FormView
-from django.db.models import Avg
+from django.db.models import Avg, Count
 from django.shortcuts import get_object_or_404
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+    HttpResponseForbidden, StreamingHttpResponse)
+from django.template import Context, RequestContext
+from django.template.loader import get_template, render_to_string
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.contrib.auth import authenticate, login, logout
+from django.contrib.auth import login, logout
 
 from bookstore.models import Author, Book, Review
+from bookstore.aggregates import monthly_ratings
+from bookstore.leaderboards import get_leaderboard, scope_filter
+from bookstore.recommendations import readers_also_liked, recommended_for
+from bookstore.bundles import bundle_scopes, get_book_bundle
+from bookstore.cache import CachedResponseMixin
+from bookstore.export import ExportError, export_chunks, render_export
+from bookstore.instrumentation import (METRICS, PERCENTILES,
+    stats as request_stats)
 from bookstore.forms import LoginForm
+from bookstore.pagination import (KeysetPage, KeysetPaginationMixin,
+    keyset_iterator)
+from bookstore.search import search
+from bookstore.userstats import review_summary, user_for_username
 
 
-class BookReviewListView(ListView):
-    """View for a list of reviews for a book"""
+class ReviewSubjectMixin(object):
+    """Mixin for views listing the reviews about one subject (a book or a
+    user): the subject is looked up once, and its review count and average
+    rating are computed together in one query, both cached on the view"""
     model = Review
-    template_name = 'bookstore/book_review_list.html'
+    subject_context_name = 'subject'
+    #the subject's model, the URLconf argument holding its primary key and
+    #the Review field pointing at it
+    subject_model = None
+    subject_pk_url_kwarg = 'pk'
+    subject_field = None
+
+    def get_subject_queryset(self):
+        """the queryset the subject is looked up in"""
+        if self.subject_model is None:
+            raise ImproperlyConfigured('%s is missing a subject_model. '
+                'Define %s.subject_model, or override '
+                '%s.get_subject_queryset().' % ((self.__class__.__name__,) * 3))
+        return self.subject_model._default_manager.all()
+
+    def get_subject(self):
+        """look up the subject from the URLconf arguments"""
+        return get_object_or_404(self.get_subject_queryset(),
+            pk=self.kwargs[self.subject_pk_url_kwarg])
+
+    def get_subject_filter(self, subject):
+        """Review lookup arguments selecting the subject's reviews"""
+        if self.subject_field is None:
+            raise ImproperlyConfigured('%s is missing a subject_field. '
+                'Define %s.subject_field, or override '
+                '%s.get_subject_filter().' % ((self.__class__.__name__,) * 3))
+        return {self.subject_field: subject}
+
+    @property
+    def subject(self):
+        if not hasattr(self, '_subject'):
+            self._subject = self.get_subject()
+        return self._subject
+
+    def get_review_stats(self):
+        """dict with the subject's review_count and average_rating"""
+        if not hasattr(self, '_review_stats'):
+            self._review_stats = (Review.objects
+                .filter(**self.get_subject_filter(self.subject))
+                .aggregate(review_count=Count('pk'),
+                    average_rating=Avg('rating')))
+        return self._review_stats
 
     def get_queryset(self):
-        self.book = get_object_or_404(Book, pk=self.kwargs['book_id'])
-        return Review.objects.filter(book=self.book)
+        return Review.objects.filter(**self.get_subject_filter(self.subject))
+
+    def get_context_data(self, **kwargs):
+        context = super(ReviewSubjectMixin, self).get_context_data(**kwargs)
+        context[self.subject_context_name] = self.subject
+        context.update(self.get_review_stats())
+        return context
+
+
+class BookReviewListView(CachedResponseMixin, ReviewSubjectMixin,
+        KeysetPaginationMixin, ListView):
+    """View for a list of reviews for a book"""
+    template_name = 'bookstore/book_review_list.html'
+    keyset_ordering = ('-timestamp', '-pk')
+    subject_context_name = 'book'
+    subject_model = Book
+    subject_pk_url_kwarg = 'book_id'
+    subject_field = 'book'
+
+    #show the "readers also liked" books
+    show_recommendations = True
+    #show the rating histogram and monthly series
+    show_rating_history = True
+    #serve the first page from the book's cached bundle (see
+    #bookstore/bundles.py)
+    use_bundle = True
+
+    def get_cache_scopes(self):
+        return bundle_scopes(self.kwargs['book_id'])
+
+    def get_bundle(self):
+        """the book's bundle when the first page is shown, else None"""
+        if not hasattr(self, '_bundle'):
+            self._bundle = None
+            request = getattr(self, 'request', None)
+            if (self.use_bundle and request is not None and
+                    not request.GET.get(self.cursor_kwarg)):
+                self._bundle = get_book_bundle(self.kwargs['book_id'],
+                    self.paginate_by)
+        return self._bundle
+
+    def get_subject_queryset(self):
+        return Book.objects.select_related('author')
+
+    def get_subject(self):
+        bundle = self.get_bundle()
+        if bundle is not None:
+            return bundle.book
+        return super(BookReviewListView, self).get_subject()
+
+    def get_review_stats(self):
+        #the book keeps its own aggregates, so no query is needed
+        return {
+            'review_count': self.subject.review_count,
+            'average_rating': self.subject.average_rating,
+        }
+
+    def paginate_queryset(self, queryset, page_size):
+        bundle = self.get_bundle()
+        if bundle is None or bundle.page_size != page_size:
+            return super(BookReviewListView, self).paginate_queryset(queryset,
+                page_size)
+        page = KeysetPage(bundle.reviews, bundle.next_cursor)
+        return (None, page, page.object_list, page.has_other_pages())
 
     def get_context_data(self, **kwargs):
-        # Call the base implementation first to get a context
         context = super(BookReviewListView, self).get_context_data(**kwargs)
-        # Add in the book
-        context['book'] = self.book
-        agg_list = self.get_queryset().aggregate(Avg('rating'))
-        context['average_rating'] = agg_list['rating__avg']
+        bundle = self.get_bundle()
+        if self.show_recommendations:
+            context['also_liked'] = (bundle.also_liked if bundle is not None
+                else readers_also_liked(self.subject))
+        if self.show_rating_history:
+            #both come from the rollups, never from the reviews themselves
+            context['rating_histogram'] = self.subject.rating_histogram()
+            context['monthly_ratings'] = (bundle.monthly_ratings
+                if bundle is not None else monthly_ratings(self.subject.pk))
         return context
 
+    def get_queryset(self):
+        #fetch each reviewer's username in the same query, and only the
+        #columns the template shows
+        return (super(BookReviewListView, self).get_queryset()
+            .select_related('user')
+            .only('timestamp', 'rating', 'review_message', 'modified',
+                'user__username'))
+
 
-class UserReviewListView(ListView):
+class UserReviewListView(CachedResponseMixin, ReviewSubjectMixin,
+        KeysetPaginationMixin, ListView):
     """View for a list of reviews for a user"""
-    model = Review
     template_name = 'bookstore/user_review_list.html'
+    keyset_ordering = ('-timestamp', '-pk')
+    subject_context_name = 'queried_user'
+    subject_model = User
+    subject_pk_url_kwarg = 'user_id'
+    subject_field = 'user'
+    stream_kwarg = 'stream'
+    stream_row_template_name = 'bookstore/user_review_row.html'
+    #reviews fetched per query when streaming
+    stream_chunk_size = 500
+    #show users their "recommended for you" books on their own page
+    show_recommendations = True
 
-    def get_queryset(self):
-        #URLconf captured user id
+    def get_cache_scopes(self):
         if 'user_id' in self.kwargs:
-            self.user = get_object_or_404(User, pk=self.kwargs['user_id'])
-        #URLconf captured username
-        else:
-            self.user = get_object_or_404(User, username=self.kwargs['username'])
+            return ['user:%s' % self.kwargs['user_id'], 'recommendations']
+        #pages are invalidated by user id, so a username has to be looked up
+        return ['user:%s' % self.subject.pk, 'recommendations']
 
-        return Review.objects.filter(user=self.user)
+    def get_recommendations(self):
+        if (self.show_recommendations and
+                self.request.user.pk == self.subject.pk):
+            return recommended_for(self.subject)
+        return None
 
     def get_context_data(self, **kwargs):
-        # Call the base implementation first to get a context
         context = super(UserReviewListView, self).get_context_data(**kwargs)
+        context['recommended'] = self.get_recommendations()
+        return context
 
-        # Add in the user
-        context['queried_user'] = self.user
+    def get_subject_queryset(self):
+        #fetch the user's review stats, and their favourite author, in the
+        #same query
+        return User.objects.select_related('review_stats__favorite_author')
 
-        agg_list = self.get_queryset().aggregate(Avg('rating'))
-        context['average_rating'] = agg_list['rating__avg']
+    def get_subject(self):
+        #URLconf captured user id
+        if 'user_id' in self.kwargs:
+            return super(UserReviewListView, self).get_subject()
+        #URLconf captured username, whose user id is usually remembered
+        user = user_for_username(self.kwargs['username'],
+            self.get_subject_queryset())
+        if user is None:
+            raise Http404
+        return user
 
-        return context
+    def get_review_stats(self):
+        #the user's stats are kept up to date with the reviews, so no query
+        #is needed
+        return review_summary(self.subject)
+
+    def get(self, request, *args, **kwargs):
+        #?stream=1 sends every review, rendered one chunk of rows at a time
+        if (self.stream_kwarg and request.GET.get(self.stream_kwarg) and
+                self.get_review_stats()['review_count']):
+            return self.stream_reviews()
+        return super(UserReviewListView, self).get(request, *args, **kwargs)
+
+    def stream_reviews(self):
+        """respond with the complete review list as it is rendered, so a
+        heavy user's page starts at once and uses constant memory"""
+        marker = '<!-- reviews -->'
+        context = {
+            self.subject_context_name: self.subject,
+            'stream_marker': marker,
+            'recommended': self.get_recommendations(),
+        }
+        context.update(self.get_review_stats())
+        page = render_to_string(self.template_name, context,
+            RequestContext(self.request))
+        head, tail = page.split(marker, 1)
+        row_template = get_template(self.stream_row_template_name)
+        reviews = keyset_iterator(self.get_queryset(), self.keyset_ordering,
+            self.stream_chunk_size)
+
+        def content():
+            yield head
+            for counter, review in enumerate(reviews, 1):
+                yield row_template.render(Context({
+                    'review': review,
+                    'forloop': {'counter': counter},
+                }))
+            yield tail
 
+        return StreamingHttpResponse(content())
 
-class BookListView(ListView):
+    def get_queryset(self):
+        #fetch each book title in the same query, and only the columns the
+        #template shows
+        return (super(UserReviewListView, self).get_queryset()
+            .select_related('book')
+            .only('timestamp', 'rating', 'review_message', 'modified',
+                'book__title', 'book__modified'))
+
+
+class BookListView(CachedResponseMixin, KeysetPaginationMixin, ListView):
     """View for a list of books"""
     model = Book
     template_name = 'bookstore/book_list.html'
+    keyset_ordering = ('title', 'pk')
+    cache_scopes = ('books',)
 
     def get_queryset(self):
+        #the average rating comes from the book's own aggregate columns, and
+        #the author is joined in rather than fetched once per book
         return (Book.objects.all()
-            .annotate(Avg('review__rating'))
+            .select_related('author')
+            .only('title', 'modified', 'review_count', 'rating_sum',
+                'author__first_name', 'author__last_name')
             .order_by('title'))
 
+    def get_context_data(self, **kwargs):
+        context = super(BookListView, self).get_context_data(**kwargs)
+        context['book_count'] = Book.objects.count()
+        return context
+
+
+class LeaderboardView(CachedResponseMixin, TemplateView):
+    """View for a leaderboard of books: overall, for an author or for a
+    decade of publication"""
+    template_name = 'bookstore/leaderboard.html'
+    #every review write bumps the book list's scope
+    cache_scopes = ('books',)
+
+    def get_scope(self):
+        if self.kwargs.get('author_id'):
+            return 'author:%s' % self.kwargs['author_id']
+        if self.kwargs.get('decade'):
+            return 'decade:%d' % (int(self.kwargs['decade']) // 10 * 10)
+        return 'all'
+
+    def get_context_data(self, **kwargs):
+        context = super(LeaderboardView, self).get_context_data(**kwargs)
+        board = self.kwargs['board']
+        scope = self.get_scope()
+        #unknown scopes are turned away before the board is looked up
+        if self.kwargs.get('author_id'):
+            context['author'] = get_object_or_404(Author,
+                pk=self.kwargs['author_id'])
+        elif self.kwargs.get('decade'):
+            if not Book.objects.filter(**scope_filter(scope)).exists():
+                raise Http404('No books were published in the %ss.' %
+                    scope.split(':')[1])
+            context['decade'] = scope.split(':')[1]
+        context['board'] = board
+        context['entry_list'] = get_leaderboard(board, scope)
+        return context
+
+
+class SearchView(CachedResponseMixin, TemplateView):
+    """View for searching the books by title, author and review text"""
+    template_name = 'bookstore/search.html'
+    query_kwarg = 'q'
+    result_limit = 20
+    #every book, author and review write bumps the book list's scope
+    cache_scopes = ('books',)
+
+    def get_context_data(self, **kwargs):
+        context = super(SearchView, self).get_context_data(**kwargs)
+        query = self.request.GET.get(self.query_kwarg, '').strip()
+        context['query'] = query
+        context['results'] = search(query, self.result_limit) if query else []
+        return context
+
+
+class ExportView(View):
+    """Streams a bulk export (see bookstore/export.py) to staff users; the
+    filters and the pk to resume after come from the query string"""
+    http_method_names = ['get']
+    chunk_size = 1000
+    content_types = {
+        'csv': 'text/csv; charset=utf-8',
+        'jsonl': 'application/x-ndjson; charset=utf-8',
+    }
+
+    def get(self, request, kind, format):
+        if not (request.user.is_authenticated() and request.user.is_staff):
+            return HttpResponseForbidden()
+        try:
+            output = render_export(kind, export_chunks(kind,
+                after=request.GET.get('after') or None,
+                chunk_size=self.chunk_size, since=request.GET.get('since'),
+                until=request.GET.get('until'), book=request.GET.get('book'),
+                user=request.GET.get('user')), format)
+        except ExportError as e:
+            return HttpResponseBadRequest(e.args[0])
+        response = StreamingHttpResponse(output,
+            content_type=self.content_types[format])
+        response['Content-Disposition'] = ('attachment; filename="%s.%s"' %
+            (kind, format))
+        return response
+
+
+class StatsView(TemplateView):
+    """Staff page of the per-view request statistics gathered by
+    bookstore.instrumentation.InstrumentationMiddleware, as HTML or JSON"""
+    template_name = 'bookstore/stats.html'
+
+    def get(self, request, format='html', *args, **kwargs):
+        if not (request.user.is_authenticated() and request.user.is_staff):
+            return HttpResponseForbidden()
+        if format == 'json':
+            return HttpResponse(json.dumps(request_stats.summary()),
+                content_type='application/json')
+        return super(StatsView, self).get(request, *args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(StatsView, self).get_context_data(**kwargs)
+        percentiles = ['p%d' % percent for percent in PERCENTILES]
+        context['percentiles'] = percentiles
+        context['metrics'] = METRICS
+        context['views'] = [{
+            'name': name,
+            'requests': summary['requests'],
+            'window': summary['window'],
+            'metrics': [(metric, [summary[metric][percentile]
+                for percentile in percentiles]) for metric in METRICS],
+            'duplicates': summary['duplicates'],
+        } for name, summary in sorted(request_stats.summary().items())]
+        return context
+
 
 class LoginView(FormView):
     """View for the login page"""
@@ -79,13 +401,9 @@ class LoginView(FormView):
     success_url = reverse_lazy('bookstore:login_success')
 
     def form_valid(self, form):
-        #try to log the user in
-        user = authenticate(
-            username=form.cleaned_data['username'],
-            password=form.cleaned_data['password']
-        )
-        #no need to check user because we already authenticated it in the form
-        login(self.request, user)
+        #the form already authenticated the user; hashing the password is
+        #the costly part of a login, so it isn't done twice
+        login(self.request, form.get_user())
 
         return super(LoginView, self).form_valid(form)
 
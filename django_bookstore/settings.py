@@ -18,9 +18,70 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',
         'PORT': '',
+    },
+    # A read replica for trying out bookstore.replicas locally: fill it with
+    # "manage.py replicate replica" (add --interval to keep it in step) and
+    # list it in BOOKSTORE_READ_REPLICAS.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'django_bookstore_replica.sqlite',
+        'TEST_MIRROR': 'default',
+    },
+}
+
+# Reads of the book and review lists go to one of these database aliases,
+# picked per request 'round_robin' or 'least_loaded'
+# (BOOKSTORE_REPLICA_SELECTION), except for clients that wrote in the last
+# BOOKSTORE_REPLICA_STICKY_SECONDS. Writes always go to 'default'.
+DATABASE_ROUTERS = ['bookstore.routers.ReplicaRouter']
+BOOKSTORE_READ_REPLICAS = ()
+BOOKSTORE_REPLICA_SELECTION = 'round_robin'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'django_bookstore',
+        #room for the per-row template fragments of many pages
+        'OPTIONS': {'MAX_ENTRIES': 20000},
     }
 }
 
+# Database connections are kept open between requests for up to this many
+# seconds (0 closes them after every request), at most
+# BOOKSTORE_CONN_POOL_SIZE of them per process, and pinged before each request
+# uses them. New SQLite connections get the BOOKSTORE_SQLITE_PRAGMAS, WAL mode
+# by default, so readers aren't blocked by a writer. See
+# bookstore/connections.py.
+BOOKSTORE_CONN_MAX_AGE = 600
+BOOKSTORE_CONN_POOL_SIZE = 10
+
+# Reviews posted to /bookstore/api/book/<id>/reviews/new are queued (at most
+# BOOKSTORE_INGEST_QUEUE_SIZE) and written by a background thread in batches
+# of up to BOOKSTORE_INGEST_BATCH_SIZE, one transaction each; see
+# bookstore/ingest.py. With BOOKSTORE_INGEST_SYNC they're written at once.
+BOOKSTORE_INGEST_SYNC = False
+
+# Cache alias holding the rendered bookstore pages; pages are invalidated by
+# model signals, so the timeout only bounds how long unused pages linger.
+BOOKSTORE_CACHE = 'default'
+
+# Share of requests whose query count and timings are recorded by
+# bookstore.instrumentation.InstrumentationMiddleware (see /bookstore/stats/).
+BOOKSTORE_INSTRUMENTATION_SAMPLE_RATE = 0.1
+
+# Sessions are kept in the database, which every worker process shares.
+# 'django.contrib.sessions.backends.cached_db' reads them from the cache and
+# writes them through to the database, but only with SESSION_CACHE_ALIAS
+# pointing at a cache all the workers share (memcached, say): in the
+# per-process 'default' cache above, a logout in one worker leaves the
+# session cached, and logged in, in the others.
+# 'django.contrib.sessions.backends.signed_cookies' stores nothing on the
+# server at all: the session lives in the client's cookie, signed with
+# SECRET_KEY but readable by the client and limited to about 4KB, and can't
+# be revoked before it expires. 'manage.py benchmark logins' compares the
+# three.
+SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -92,7 +153,19 @@ TEMPLATE_LOADERS = (
 #     'django.template.loaders.eggs.Loader',
 )
 
+# Outside of development, keep the compiled templates in memory rather than
+# reading and parsing them from disk on every request.
+if not TEMPLATE_DEBUG:
+    TEMPLATE_LOADERS = (
+        ('django.template.loaders.cached.Loader', TEMPLATE_LOADERS),
+    )
+
 MIDDLEWARE_CLASSES = (
+    #first, so its wall time covers the other middleware
+    'bookstore.instrumentation.InstrumentationMiddleware',
+    #before the session middleware, so a session write keeps the client on
+    #the primary
+    'bookstore.replicas.ReplicaMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -1,5 +1,7 @@
 from django.conf.urls import patterns, include, url
 
+from bookstore.routing import PrefixURLResolver
+
 # Uncomment the next two lines to enable the admin:
 from django.contrib import admin
 admin.autodiscover()
@@ -15,8 +17,7 @@ urlpatterns = patterns('',
     # Uncomment the next line to enable the admin:
     url(r'^admin/', include(admin.site.urls)),
 
-    #bookstore app
-    url(r'^bookstore/',
-        include('bookstore.urls', namespace='bookstore', app_name='bookstore')
-    ),
+    #bookstore app, resolved through an index of its patterns' prefixes
+    PrefixURLResolver(r'^bookstore/', 'bookstore.urls',
+        app_name='bookstore', namespace='bookstore'),
 )